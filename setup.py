@@ -102,13 +102,16 @@ setup(
     url="https://github.com/neptunya/waveware",
     packages=setuptools.find_packages(),
     install_requires=install_requires,
+    #parquet / arrow uploads (WAVEWARE_UPLOAD_FORMAT) and `wavecompact`: pip install waveware[archive]
+    extras_require={"archive": ["pyarrow"]},
     #dependency_links = dependency_links, #DEPRICIATED PIP >19
     include_package_data=True,
     long_description=read("README.md"),
     entry_points={
         "console_scripts": ["wavedaq=waveware.fw_main:main",
                             "wavedash=waveware.live_dashboard:main",
-                            "wavepost=waveware.post_processing:main"]
+                            "wavepost=waveware.post_processing:main",
+                            "wavecompact=waveware.archive:main"]
                             #"hwstream=waveware.hardware:main"]
     },
 )
@@ -0,0 +1,12 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    """a fresh event loop set as the current one, the rig's objects create futures & tasks on it when they're built"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
@@ -0,0 +1,73 @@
+"""tick unwrapping and the tick > perf > utc fits of waveware.clock"""
+import numpy as np
+import pytest
+
+from waveware.clock import tick_unwrapper, linear_fit, clock_model, TICK_WRAP
+
+
+def test_unwrap_across_the_wrap():
+    un = tick_unwrapper()
+    ticks = [TICK_WRAP-100,TICK_WRAP-10,5,50,50+(1<<31)-1]
+    out = [un(t) for t in ticks]
+    assert out == [TICK_WRAP-100,TICK_WRAP-10,TICK_WRAP+5,TICK_WRAP+50,TICK_WRAP+50+(1<<31)-1]
+
+def test_older_ticks_resolve_without_moving_the_reference():
+    un = tick_unwrapper()
+    un(TICK_WRAP-10)
+    un(20)
+    assert un(TICK_WRAP-5) == TICK_WRAP-5
+    assert un.ref == TICK_WRAP+20
+    assert un(30) == TICK_WRAP+30
+
+def test_unwrap_arrays():
+    un = tick_unwrapper()
+    assert len(un(np.array([],dtype=np.int64))) == 0
+    out = un(np.array([TICK_WRAP-2,TICK_WRAP-1,0,1]))
+    assert out.tolist() == [TICK_WRAP-2,TICK_WRAP-1,TICK_WRAP,TICK_WRAP+1]
+    #arrays never advance the reference
+    assert un.ref_tick == TICK_WRAP-2
+
+def test_linear_fit():
+    x = np.array([1000.,1001.,1002.,1003.])
+    icpt,slope,x0,rms = linear_fit(x,5. + 2.*(x-1000.))
+    assert (icpt,slope,x0) == pytest.approx((5.,2.,1000.))
+    assert rms == pytest.approx(0.,abs=1E-9)
+    assert linear_fit(np.array([3.]),np.array([7.])) == (7.,1.,3.,0.)
+
+
+def test_tick_fit_uses_the_quick_pairs():
+    cm = clock_model(window=20,rtt_quantile=0.5)
+    assert cm.perf_from_tick(0) is None and cm.utc_from_tick(0) is None
+    rate = 1E-6*(1 + 50E-6) #50ppm fast
+    t0 = TICK_WRAP - 2_000_000
+    for i in range(10):
+        tick = (t0 + i*500_000) % TICK_WRAP
+        rtt = 1E-4 if i % 2 else 5E-3
+        #slow round trips read late, those pairs must not skew the fit
+        late = 0. if i % 2 else 1E-3
+        cm.add_tick_pair(tick,50. + i*500_000*rate + late,rtt)
+    icpt,slope,_,rms = cm.tick_fit
+    assert slope == pytest.approx(rate,rel=1E-9)
+    assert rms == pytest.approx(0.,abs=1E-9)
+    tick = (t0 + 4_750_000) % TICK_WRAP #past the wrap
+    assert cm.perf_from_tick(tick) == pytest.approx(50. + 4_750_000*rate)
+    st = cm.status()
+    assert st['tick']['ppm'] == pytest.approx(50.,abs=1E-3)
+    assert st['tick_pairs'] == 10
+
+def test_one_tick_pair_is_an_offset_at_nominal_rate():
+    cm = clock_model()
+    cm.add_tick_pair(1_000_000,10.,1E-4)
+    assert cm.perf_from_tick(1_500_000) == pytest.approx(10.5)
+
+def test_wall_fit_and_anchor():
+    cm = clock_model(window=5)
+    for i in range(8):
+        cm.add_wall_pair(100. + i,1.7E9 + i*(1 + 20E-6))
+    assert len(cm.wall_pairs) == 5
+    assert cm.utc(110.) == pytest.approx(1.7E9 + 10*(1 + 20E-6))
+    assert cm.utc(np.array([103.,104.])).tolist() == pytest.approx([1.7E9 + 3*(1 + 20E-6),1.7E9 + 4*(1 + 20E-6)])
+    a = cm.anchor()
+    assert a['perf0'] == 103. and a['drift'] == pytest.approx(1 + 20E-6)
+    cm.add_tick_pair(0,103.,1E-4)
+    assert cm.utc_from_tick(1_000_000) == pytest.approx(cm.utc(104.))
@@ -0,0 +1,65 @@
+"""feedback reads of wave_control, with the ADS1115 alert reader and its bus stood in for"""
+import asyncio
+import time
+
+from waveware.control import wave_control, adc_timeout_periods, dr_inx
+
+
+class quiet_reader:
+    """an alert reader whose pin never fires unless a conversion is queued"""
+
+    def __init__(self,*items):
+        self.stats = {'edges':0,'reads':0,'missed':0,'dropped':0,'errors':0,'timeouts':0}
+        self.queue = asyncio.Queue()
+        for item in items:
+            self.queue.put_nowait(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+class adc_bus:
+    """the feedback i2c_device, every read returns `data`"""
+
+    def __init__(self,data):
+        self.data = data
+        self.reads = 0
+
+    async def call(self,method,*args):
+        assert (method,args) == ('read_i2c_block_data',(0x48,0x00,2))
+        self.reads += 1
+        return self.data
+
+
+def read_adc(loop,adc,bus,wait:float=0.01):
+    """(control,read_adc result), the control is built on the running loop"""
+    async def read():
+        cntl = wave_control(4,6,12,7,13,11,10,19)
+        cntl.adc = adc() if adc else None
+        cntl.adc_bus = bus
+        cntl.fail_feedback = False
+        return cntl,await cntl.read_adc(wait)
+    return loop.run_until_complete(read())
+
+def test_alert_conversion_is_used(loop):
+    bus = adc_bus([0,0])
+    cntl,(raw,t,polled) = read_adc(loop,lambda: quiet_reader((1000,0x1234,12.5)),bus)
+    assert (raw,t,polled) == (0x1234,12.5,False)
+    assert cntl.feedback_tick == 1000
+    assert bus.reads == 0
+    assert not cntl.fail_feedback
+
+def test_quiet_alert_falls_back_to_a_polled_read(loop):
+    bus = adc_bus([0x12,0x34])
+    t0 = time.perf_counter()
+    cntl,(raw,t,polled) = read_adc(loop,quiet_reader,bus)
+    assert polled and raw == 0x1234
+    assert t0 + adc_timeout_periods/dr_inx <= t <= time.perf_counter()
+    assert bus.reads == 1
+    assert cntl.fail_feedback
+    assert cntl.adc.stats['timeouts'] == 1
+
+def test_polled_reads_are_signed(loop):
+    bus = adc_bus([0xFF,0x00])
+    cntl,(raw,_,polled) = read_adc(loop,None,bus,0.001)
+    assert polled and raw == 0xFF00 - 65535
+    assert not cntl.fail_feedback
@@ -0,0 +1,63 @@
+"""the state_block seqlock between the control thread and its readers"""
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from waveware.control_exec import state_block, state_fields
+
+
+def test_write_then_read():
+    blk = state_block(['a','b','c'])
+    assert np.isnan(blk.read()).all()
+    blk.write([1.,2.,3.])
+    assert blk.read().tolist() == [1.,2.,3.]
+    assert blk.read_dict() == {'a':1.,'b':2.,'c':3.}
+    assert blk.arr[0] == 2 #even between writes
+
+def test_read_gives_up_on_a_stuck_writer():
+    blk = state_block(['a'])
+    blk.arr[0] = 1 #writer part way through
+    assert blk.read(tries=5) is None
+    assert blk.retries == 5
+    assert blk.read_dict() == {}
+
+def test_shared_memory_block():
+    shm = shared_memory.SharedMemory(create=True,size=(len(state_fields)+1)*8)
+    try:
+        writer = state_block(state_fields,shm.buf)
+        writer.write(np.arange(len(state_fields),dtype=np.float64))
+        reader = np.ndarray(len(state_fields)+1,dtype=np.float64,buffer=shm.buf)
+        assert reader[0] == 2 and reader[1:].tolist() == list(range(len(state_fields)))
+        del writer,reader
+    finally:
+        shm.close()
+        shm.unlink()
+
+def test_reads_are_never_torn():
+    #every write is n copies of one value, a torn copy would mix two
+    n = 64
+    blk = state_block([f'f{i}' for i in range(n)])
+    blk.write(np.zeros(n))
+    stop = threading.Event()
+
+    def write():
+        v = 0.
+        while not stop.is_set():
+            v += 1
+            blk.write(np.full(n,v))
+
+    th = threading.Thread(target=write)
+    th.start()
+    try:
+        seen = 0
+        for _ in range(20000):
+            vals = blk.read(tries=10000)
+            if vals is None:
+                continue
+            assert (vals == vals[0]).all()
+            seen += 1
+    finally:
+        stop.set()
+        th.join()
+    assert seen
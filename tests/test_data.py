@@ -0,0 +1,193 @@
+"""the columnar sample store, wire format, decimation & stage queues of waveware.data"""
+import asyncio
+
+import numpy as np
+import pytest
+
+from waveware.data import (sample_store, sample_schema, encode_columns, decode_columns, rows_to_columns,
+                           decimate, decimate_mean, decimate_minmax, decimate_lttb, stage_queue)
+
+
+def filled(capacity,n,**kw):
+    store = sample_store(capacity,**kw)
+    for i in range(n):
+        store.append({'timestamp':float(i),'x':i*2.,'label':f's{i}'})
+    return store
+
+
+#Store
+def test_append_returns_seq_and_overwrites_oldest():
+    store = sample_store(4)
+    assert [store.append({'timestamp':float(i),'x':i}) for i in range(6)] == list(range(6))
+    assert len(store) == 4
+    assert (store.first_seq,store.last_seq) == (2,5)
+    assert (store.first_time,store.last_time) == (2.,5.)
+    assert store.latest() == {'timestamp':5.,'seq':5,'x':5.}
+
+def test_append_rejects_time_going_backwards():
+    store = filled(4,2)
+    with pytest.raises(ValueError):
+        store.append({'timestamp':0.5,'x':1})
+
+def test_columns_are_typed_and_promoted():
+    store = sample_store(4)
+    store.append({'timestamp':0.,'x':1,'on':True})
+    store.append({'timestamp':1.,'x':'text','on':False})
+    store.append({'timestamp':2.})
+    assert store.kinds == {'x':'o','on':'b'}
+    rows = list(store.rows(store.since()).values())
+    assert [r['x'] for r in rows] == [1.,'text',None]
+    assert [r['on'] for r in rows] == [True,False,None]
+
+def test_search_spans_the_wrapped_ring():
+    store = filled(5,8) #holds 3..7, physically [5,6,7,3,4]
+    assert store._search(2.5) == 3
+    assert store._search(4.) == 5
+    assert store._search(4.,'left') == 4
+    assert store._search(6.5) == 7
+    assert store._search(99.) == 8
+    assert store.ts[store.range(after=3.5,before=6.)].tolist() == [4.,5.,6.]
+    assert store.find(6.) == 1 and store.find(2.) is None
+    assert store[7.]['label'] == 's7'
+
+def test_range_honours_max_age():
+    store = filled(10,10,max_age=3.)
+    assert store.ts[store.range()].tolist() == [7.,8.,9.]
+
+def test_since_and_lost_follow_the_cursor():
+    store = filled(5,8)
+    assert store._logical(store.since()).tolist() == [3,4,5,6,7]
+    assert store._logical(store.since(4)).tolist() == [5,6,7]
+    assert len(store.since(7)) == 0
+    assert store.lost(4) == 0
+    assert store.lost(0) == 2
+    assert store.lost(None) == 0
+    #a cursor that fell behind the ring resumes at the oldest sample
+    assert store._logical(store.since(0)).tolist() == [3,4,5,6,7]
+
+def test_extend_matches_append():
+    cols = rows_to_columns([{'timestamp':float(i),'x':i*2.,'label':f's{i}'} for i in range(8)])
+    store = sample_store(5)
+    store.extend(cols)
+    ref = filled(5,8)
+    assert store.rows(store.since()) == ref.rows(ref.since())
+
+def test_schema_records_store_like_rows():
+    schema = sample_schema(['x','y'])
+    store = sample_store(3,schema=schema)
+    rec = schema.record()
+    rec.update(timestamp=1.,x=2.,y=3.,note='a')
+    store.append(rec)
+    store.append({'timestamp':2.,'x':4.})
+    rows = list(store.rows(store.since()).values())
+    assert rows[0] == {'timestamp':1.,'seq':0,'x':2.,'y':3.,'note':'a'}
+    assert rows[1] == {'timestamp':2.,'seq':1,'x':4.,'y':None,'note':None}
+
+
+#Wire format
+def test_columns_round_trip():
+    store = filled(5,8)
+    cols = store.to_columns(store.since())
+    cols['tags'] = np.empty(5,dtype=object)
+    for i in range(5):
+        cols['tags'][i] = [i,'a']
+    out,meta = decode_columns(encode_columns(cols,{'first_seq':3}))
+    assert meta == {'first_seq':3}
+    assert list(out) == list(cols)
+    for key in ('timestamp','seq','x'):
+        assert out[key].dtype == np.float64
+        assert out[key].tolist() == cols[key].tolist()
+    assert out['label'].tolist() == ['s3','s4','s5','s6','s7']
+    assert out['tags'][2] == [2,'a']
+
+def test_decode_rejects_other_bodies():
+    with pytest.raises(ValueError):
+        decode_columns(b'{"not":"columns"}')
+
+
+#Decimation
+def wave_cols(n=1000):
+    t = np.arange(n)*0.01
+    x = np.sin(t)
+    x[n*7//16] = 5. #a spike decimation must not lose
+    return {'timestamp':t,'seq':np.arange(n),'x':x,'label':np.array([f's{i}' for i in range(n)],dtype=object)}
+
+def test_decimate_passes_short_windows_through():
+    cols = wave_cols(50)
+    assert decimate(cols,100) is cols
+    with pytest.raises(ValueError):
+        decimate(cols,10,'nearest')
+
+def test_minmax_keeps_the_envelope_in_order():
+    cols = wave_cols()
+    out = decimate_minmax(cols,100)
+    assert len(out['timestamp']) <= 100
+    assert out['x'].max() == 5.
+    assert out['x'].min() == cols['x'].min()
+    assert np.all(np.diff(out['timestamp']) >= 0)
+    assert out['label'][0] == 's0' and out['label'][-1] == 's999'
+
+def test_lttb_selects_real_samples():
+    cols = wave_cols()
+    out = decimate_lttb(cols,100)
+    assert len(out['timestamp']) == 100
+    assert out['seq'][0] == 0 and out['seq'][-1] == 999
+    assert 437 in out['seq']
+    sel = out['seq'].astype(int)
+    for key in cols:
+        assert out[key].tolist() == cols[key][sel].tolist()
+
+def test_mean_averages_buckets_ignoring_nan():
+    cols = {'timestamp':np.arange(8.),'x':np.array([1.,3.,np.nan,5.,np.nan,np.nan,2.,4.])}
+    out = decimate_mean(cols,4)
+    assert out['timestamp'].tolist() == [0.5,2.5,4.5,6.5]
+    assert out['x'][[0,1,3]].tolist() == [2.,5.,3.]
+    assert np.isnan(out['x'][2])
+
+
+#Stage queues
+def test_drop_oldest_sheds_the_head():
+    q = stage_queue('t',2,'drop_oldest')
+    assert all(q.put_nowait(i) for i in range(4))
+    assert q.pop_all() == [2,3]
+    assert q.stats['dropped'] == 2 and q.stats['enqueued'] == 4
+
+def test_drop_newest_refuses_the_item():
+    q = stage_queue('t',2,'drop_newest')
+    assert [q.put_nowait(i) for i in range(4)] == [True,True,False,False]
+    assert q.pop_all() == [0,1]
+    assert q.stats['dropped'] == 2 and q.stats['max_depth'] == 2
+
+def test_block_waits_for_space(loop):
+    q = stage_queue('t',1,'block')
+    assert q.put_nowait(0)
+    assert not q.put_nowait(1)
+
+    async def run():
+        put = loop.create_task(q.put(2))
+        await asyncio.sleep(0)
+        assert not put.done()
+        assert await q.get() == 0
+        assert await put
+        return await q.get()
+
+    assert loop.run_until_complete(run()) == 2
+    assert q.stats['blocked'] == 1 and q.stats['dropped'] == 1
+
+def test_spill_keeps_order_through_disk(tmp_path):
+    q = stage_queue('t',2,'spill',spill_dir=str(tmp_path/'spill'),spill_map=lambda i: i*10)
+    for i in range(5):
+        q.put_nowait(i)
+    assert q.status()['depth'] == 2 and q.status()['spill_depth'] == 3
+    assert q.get_nowait() == 0
+    #memory has room again but newer items still go behind the spilled ones
+    q.put_nowait(5)
+    assert q.pop_all() == [1,20,30,40,50]
+    assert q.stats['spilled'] == 4
+
+def test_spill_is_picked_up_again(tmp_path):
+    q = stage_queue('t',1,'spill',spill_dir=str(tmp_path/'spill'))
+    for i in range(3):
+        q.put_nowait(i)
+    again = stage_queue('t',1,'spill',spill_dir=str(tmp_path/'spill'))
+    assert again.pop_all() == [1,2]
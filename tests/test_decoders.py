@@ -0,0 +1,120 @@
+"""the edge decoders and echo filter of waveware.decoders, the batch paths must match the per edge ones"""
+import numpy as np
+import pytest
+
+from waveware.decoders import (quadrature_decoder, echo_decoder, echo_filter, quad_table, ILLEGAL,
+                               tick_diff, decode_reports, report_dtype, quad_states, TICK_MASK)
+
+
+def test_tick_diff_wraps():
+    assert tick_diff(100,250) == 150
+    assert tick_diff(TICK_MASK-9,10) == 20
+
+def test_quad_table_is_gray_code():
+    fwd = [0,1,3,2]
+    for i,s in enumerate(fwd):
+        nxt = fwd[(i+1)%4]
+        assert quad_table[s*4+nxt] == +1
+        assert quad_table[nxt*4+s] == -1
+        assert quad_table[s*4+(s^3)] == ILLEGAL
+        assert quad_table[s*4+s] == 0
+
+
+#Quadrature
+STATES = [1,3,2,0,1,3,1,0,3,1]
+TICKS = [100,200,300,400,500,600,700,800,900,1000]
+
+def test_steps_count_and_time_velocity():
+    q = quadrature_decoder(5,6,sens=4.)
+    for s,t in zip(STATES[:4],TICKS[:4]):
+        q.step(s,t)
+    assert q.count == 4 and q.position == 4.
+    assert q.period == pytest.approx(1E-4)
+    assert q.v == pytest.approx(1E4) #1 per count over 100us
+
+def test_edge_follows_the_pins():
+    q = quadrature_decoder(5,6,sens=4.)
+    q.edge(6,1,100) #B up
+    q.edge(5,1,200) #A up
+    q.edge(6,0,300)
+    q.edge(6,2,350) #watchdog
+    q.edge(5,0,400)
+    assert q.count == 4 and q.state == 0
+
+def test_batch_matches_steps():
+    one = quadrature_decoder(5,6,sens=4.,vel_edges=3)
+    for s,t in zip(STATES,TICKS):
+        one.step(s,t)
+    two = quadrature_decoder(5,6,sens=4.,vel_edges=3)
+    assert two.batch(np.array(STATES),np.array(TICKS)) == one.count
+    for attr in ('count','illegal','edges','state','tick','period','v'):
+        assert getattr(two,attr) == pytest.approx(getattr(one,attr)),attr
+    #0>3 is both channels
+    assert one.illegal == 1
+    assert two.batch(np.array([],dtype=np.int64),np.array([],dtype=np.int64)) == 0
+
+def test_velocity_decays_then_times_out():
+    q = quadrature_decoder(5,6,sens=4.,timeout=0.25)
+    assert q.velocity() == 0.
+    q.batch(np.array(STATES[:4]),np.array(TICKS[:4]))
+    t = q.edge_time
+    assert q.velocity(t) == pytest.approx(1E4)
+    #no count for 10ms: at most one count over the wait
+    assert q.velocity(t+0.01) == pytest.approx(100.)
+    assert q.velocity(t+0.3) == 0.
+
+
+#Echo
+def test_echo_batch_pairs_edges_like_single_edges():
+    levels = [1,0,1,0,1]
+    ticks = [10,25,100,140,TICK_MASK-4]
+    one = echo_decoder(4)
+    widths = [w for l,t in zip(levels,ticks) if (w := one.edge(l,t)) is not None]
+    #reports also come for other pins' edges, the level just repeats
+    two = echo_decoder(4)
+    falls,bw = two.batch(np.array(levels[:3]+[1]+levels[3:]),np.array(ticks[:3]+[120]+ticks[3:],dtype=np.int64))
+    assert bw.tolist() == widths == [15,40]
+    assert falls.tolist() == [25,140]
+    #the open rise carries over the batch and the tick wrap
+    falls,bw = two.batch(np.array([0]),np.array([10],dtype=np.int64))
+    assert bw.tolist() == [15] and one.edge(0,10) == 15
+
+def test_echo_filter_rejects_outliers():
+    f = echo_filter(size=8,window=5,k=3.,min_dev=20.)
+    for i,w in enumerate([1000,1010,990,1005,995]):
+        assert f.add(i,w,now=i*0.1)
+    assert not f.add(5,3000,now=0.5)
+    assert not f.add(6,0,now=0.6)
+    assert f.add(7,1030,now=0.7)
+    assert (f.count,f.rejected,f.width,f.tick) == (8,2,1030,7)
+    assert f.median() == pytest.approx(1002.5)
+    assert f.rate() == pytest.approx(5/0.7)
+
+def test_echo_filter_dropout_and_ring():
+    f = echo_filter(size=8,window=5,timeout=0.5)
+    assert f.dropout(0.) and f.rate() == 0.
+    for i in range(20):
+        f.add(i,1000+i,now=i*0.01)
+    assert f._n == 8
+    assert f.median() == pytest.approx(1015.5)
+    assert not f.dropout(0.5)
+    assert f.dropout(0.7)
+
+def test_echo_filter_extend_back_dates():
+    f = echo_filter()
+    assert f.extend(np.array([1000,2000,4000]),np.array([500.,510.,505.]),now=10.) == 3
+    assert f.times[:3].tolist() == pytest.approx([9.997,9.998,10.])
+
+
+#Reports
+def test_decode_reports_keeps_level_changes():
+    rep = np.zeros(4,dtype=report_dtype)
+    rep['seqno'] = [0,1,2,3]
+    rep['flags'] = [0,0x20,0,0] #a watchdog report
+    rep['tick'] = [10,20,30,TICK_MASK]
+    rep['level'] = [1<<5,0,(1<<5)|(1<<6),1<<6]
+    buf = rep.tobytes() + b'\x01\x02'
+    ticks,levels,rem = decode_reports(buf)
+    assert ticks.tolist() == [10,30,TICK_MASK]
+    assert rem == b'\x01\x02'
+    assert quad_states(levels,5,6).tolist() == [2,3,1]
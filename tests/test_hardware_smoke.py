@@ -0,0 +1,24 @@
+"""constructs the rig's hardware_control under the default config, ie what wavedaq does at startup"""
+from waveware.config import WAL_ENABLED, encoder_pins, echo_pins, control_conf, pins_kw
+from waveware.hardware import hardware_control
+
+
+def test_hardware_control_constructs(loop):
+    hw = hardware_control(encoder_pins,echo_pins,cntl_conf=control_conf,**pins_kw)
+    assert (hw.wal is not None) == WAL_ENABLED
+    assert hw.param_version == 1
+    assert hw.param_snapshot['title'] == hw.title
+    if hw.wal is not None:
+        hw.wal.close()
+    hw.events.close()
+
+
+def test_hardware_control_constructs_with_segment_log(tmp_path,monkeypatch,loop):
+    import waveware.hardware as hardware
+    monkeypatch.setattr(hardware,'WAL_ENABLED',True)
+    monkeypatch.setattr(hardware,'wal_dir',str(tmp_path))
+    hw = hardware_control(encoder_pins,echo_pins,cntl_conf=control_conf,**pins_kw)
+    assert hw.wal is not None
+    assert hw.wal.params_fn(hw.param_version) == hw.param_snapshot
+    hw.wal.close()
+    hw.events.close()
@@ -0,0 +1,136 @@
+"""the prioritized i2c scheduler and the Si7021 read through it, with the smbus handles stood in for"""
+
+import pytest
+
+from waveware import i2c_bus
+from waveware.i2c_bus import i2c_scheduler, crc8, FEEDBACK, IMU, TEMP, CAL
+
+
+class read_msg:
+    """smbus2 i2c_msg stand in, `i2c_rdwr` fills its bytes"""
+
+    def __init__(self,addr,n):
+        self.addr = addr
+        self.buf = [0]*n
+
+    @classmethod
+    def read(cls,addr,n):
+        return cls(addr,n)
+
+    def __iter__(self):
+        return iter(self.buf)
+
+class raw_bus:
+    """smbus2 handle of a sensor that NACKs the first `nacks` reads (still converting)"""
+
+    def __init__(self,data,nacks=0):
+        self.data = data
+        self.nacks = nacks
+        self.reads = 0
+
+    def i2c_rdwr(self,msg):
+        self.reads += 1
+        if self.nacks:
+            self.nacks -= 1
+            raise OSError(121,'Remote I/O error')
+        msg.buf[:] = self.data[:len(msg.buf)]
+
+class smbus:
+    def __init__(self):
+        self.calls = []
+
+    def write_byte(self,addr,val):
+        self.calls.append(('write_byte',addr,val))
+
+    def read_byte(self,addr):
+        self.calls.append(('read_byte',addr))
+        return 0
+
+
+def test_crc8_datasheet_example():
+    #Si7021 datasheet: measurement 0x683A has checksum 0x7C
+    assert crc8([0x68,0x3A]) == 0x7C
+    assert crc8([0x68,0x3A,0x7C]) == 0
+    assert crc8([]) == 0
+
+def test_priority_then_fifo_order():
+    bus = smbus()
+    sched = i2c_scheduler(bus)
+    order = [('temp',TEMP),('cal',CAL),('imu',IMU),('adc',FEEDBACK),('imu2',IMU),('adc2',FEEDBACK)]
+    futs = [sched.submit(name,prio,bus.write_byte,0x40,i) for i,(name,prio) in enumerate(order)]
+    sched.start()
+    for f in futs:
+        f.result(1)
+    sched.stop()
+    assert [c[2] for c in bus.calls] == [3,5,2,4,0,1]
+    assert sched.status()['devices']['adc']['count'] == 1
+
+def test_lowered_block_can_only_lower_priority():
+    bus = smbus()
+    sched = i2c_scheduler(bus)
+    with sched.lowered(CAL):
+        sched.submit('imu',IMU,bus.write_byte,0x68,0)
+        with sched.lowered(IMU):
+            sched.submit('imu',FEEDBACK,bus.write_byte,0x68,1)
+    sched.submit('temp',TEMP,bus.write_byte,0x40,2)
+    prios = sorted(sched.queue.queue)
+    assert [(p[0],p[4][1]) for p in prios] == [(TEMP,2),(CAL,0),(CAL,1)]
+
+def test_errors_are_counted_and_raised():
+    def nack(*args):
+        raise OSError(121,'Remote I/O error')
+    sched = i2c_scheduler(smbus())
+    sched.start()
+    with pytest.raises(OSError):
+        sched.call_sync('temp',TEMP,nack,timeout=1)
+    sched.stop()
+    assert sched.status()['devices']['temp']['errors'] == 1
+
+def test_device_read_is_one_message(monkeypatch,loop):
+    monkeypatch.setattr(i2c_bus,'i2c_msg',read_msg)
+    raw = raw_bus([0x68,0x3A,0x7C])
+    sched = i2c_scheduler(smbus(),raw)
+    sched.start()
+    dev = sched.device('temp',TEMP)
+    assert loop.run_until_complete(dev.read(0x40,3)) == [0x68,0x3A,0x7C]
+    sched.stop()
+    assert raw.reads == 1
+
+
+def read_temp(loop,raw,monkeypatch):
+    """hardware_control's Si7021 read over a scheduler of stand in buses, returns (hw,smbus)"""
+    from waveware.config import encoder_pins, echo_pins, control_conf, pins_kw
+    from waveware.hardware import hardware_control
+    monkeypatch.setattr(i2c_bus,'i2c_msg',read_msg)
+    bus = smbus()
+
+    async def read():
+        hw = hardware_control(encoder_pins,echo_pins,cntl_conf=control_conf,**pins_kw)
+        hw.i2c = i2c_scheduler(bus,raw)
+        hw.i2c.start()
+        hw.temp_bus = hw.i2c.device('temp',TEMP)
+        hw.record.pop('temp',None)
+        try:
+            await hw._read_temp()
+        finally:
+            hw.i2c.stop()
+            if hw.wal is not None:
+                hw.wal.close()
+            hw.events.close()
+        return hw
+
+    return loop.run_until_complete(read()),bus
+
+def test_si7021_read_retries_while_converting(monkeypatch,loop):
+    raw = raw_bus([0x68,0x3A,0x7C],nacks=2)
+    hw,bus = read_temp(loop,raw,monkeypatch)
+    assert bus.calls == [('write_byte',0x40,0xF3)]
+    assert raw.reads == 3
+    #status bits masked: 0x6838
+    assert hw.record['temp'] == pytest.approx(0x6838*175.72/65536 - 46.85)
+    assert hw.speed_of_sound == pytest.approx(20.05*(273.16 + hw.record['temp'])**0.5)
+
+def test_si7021_bad_checksum_is_dropped(monkeypatch,loop):
+    raw = raw_bus([0x68,0x3A,0x7D])
+    hw,_ = read_temp(loop,raw,monkeypatch)
+    assert 'temp' not in hw.record
@@ -0,0 +1,161 @@
+"""the MPU9250 fifo batch conversion & sample times and the orientation / heave fusion of waveware.imu, with the imusensor driver and bus stood in for"""
+import math
+
+import numpy as np
+import pytest
+
+from waveware.imu import (mpu_fifo, fifo_divider, orientation_filter, heave_integrator, imu_fusion, quat_from_accel,
+                          GRAVITY, FIFO_COUNTH, FIFO_R_W, FIFO_SIZE, CHUNK_BYTES)
+
+
+class cfg:
+    transformationMatrix = np.array([[0.,1.,0.],[1.,0.,0.],[0.,0.,-1.]])
+
+class mpu:
+    """the calibration attributes of an imusensor MPU9250"""
+    cfg = cfg
+    AccelScale = GRAVITY/16384
+    AccelBias = np.array([0.1,-0.2,0.3])
+    Accels = np.array([1.,1.01,0.99])
+    GyroScale = math.radians(250/32768)
+    GyroBias = np.array([0.01,0.02,-0.03])
+
+class fifo_bus:
+    """smbus of a chip with `data` in its fifo"""
+
+    def __init__(self,data=b''):
+        self.fifo = bytearray(data)
+        self.reads = []
+        self.writes = []
+
+    def read_i2c_block_data(self,addr,reg,n):
+        self.reads.append((reg,n))
+        if reg == FIFO_COUNTH:
+            return [len(self.fifo)>>8,len(self.fifo)&0xFF]
+        assert reg == FIFO_R_W and n <= 32
+        out,self.fifo = list(self.fifo[:n]),self.fifo[n:]
+        return out
+
+    def write_byte_data(self,addr,reg,val):
+        self.writes.append((reg,val))
+
+def samples(raw):
+    return np.asarray(raw,dtype='>i2').tobytes()
+
+RAW = [[100,-200,16384,10,-20,30],[-300,400,16000,-40,50,-60],[5,6,7,8,9,10]]
+
+
+def test_fifo_divider():
+    assert fifo_divider(200) == 4 and fifo_divider(1000) == 0 and fifo_divider(1) == 255
+    assert mpu_fifo(mpu,None,rate=200).rate == 200.
+
+def test_convert_matches_the_driver_per_sample():
+    accel,gyro = mpu_fifo(mpu,None).convert(samples(RAW))
+    tm = cfg.transformationMatrix
+    for i,r in enumerate(RAW):
+        #imusensor readSensor
+        a = (tm.dot(np.array(r[:3],dtype=float))*mpu.AccelScale - mpu.AccelBias)*mpu.Accels
+        g = tm.dot(np.array(r[3:],dtype=float))*mpu.GyroScale - mpu.GyroBias
+        assert accel[i] == pytest.approx(a)
+        assert gyro[i] == pytest.approx(g)
+
+def test_read_drains_whole_samples_in_chunks():
+    bus = fifo_bus(samples(RAW) + b'\x01\x02\x03')
+    fifo = mpu_fifo(mpu,bus)
+    times,accel,gyro = fifo.read()
+    assert accel.shape == gyro.shape == (3,3) and len(times) == 3
+    assert bus.reads == [(FIFO_COUNTH,2),(FIFO_R_W,CHUNK_BYTES),(FIFO_R_W,12)]
+    #a partly written sample stays for the next drain
+    assert bytes(bus.fifo) == b'\x01\x02\x03'
+    assert fifo.stats['samples'] == 3 and fifo.stats['transactions'] == 3
+
+def test_overflow_resets_and_loses_the_batch():
+    bus = fifo_bus(bytes(FIFO_SIZE))
+    fifo = mpu_fifo(mpu,bus)
+    fifo.last_t = 1.
+    times,accel,_ = fifo.read()
+    assert len(times) == 0 and accel.shape == (0,3)
+    assert fifo.stats['overflows'] == 1 and fifo.last_t is None
+    assert bus.writes
+
+def test_sample_times_continue_the_last_batch():
+    fifo = mpu_fifo(mpu,None,rate=200)
+    p = fifo.period
+    assert fifo.times(4,1.).tolist() == pytest.approx([1.-3*p,1.-2*p,1.-p,1.])
+    #read 0.1ms late, still on the sample grid
+    assert fifo.times(2,1.+2*p+1E-4).tolist() == pytest.approx([1.+p,1.+2*p])
+    #after a gap they hang back from the read time
+    assert fifo.times(2,2.).tolist() == pytest.approx([2.-p,2.])
+    #more samples than fit since the last batch are spread over the interval
+    assert fifo.times(4,2.+2*p).tolist() == pytest.approx([2.+p/2,2.+p,2.+1.5*p,2.+2*p])
+    assert fifo.last_t == pytest.approx(2.+2*p)
+
+
+#Fusion
+def tilted(roll):
+    r = math.radians(roll)
+    return 0.,GRAVITY*math.sin(r),GRAVITY*math.cos(r)
+
+def test_quat_from_accel_levels_roll_and_pitch():
+    f = orientation_filter()
+    f.q = quat_from_accel(*tilted(30))
+    roll,pitch,yaw = f.euler()
+    assert (roll,pitch,yaw) == pytest.approx((30.,0.,0.),abs=1E-9)
+    assert f.vertical(*tilted(30)) == pytest.approx(GRAVITY)
+    f.q = quat_from_accel(-GRAVITY*math.sin(math.radians(20)),0.,GRAVITY*math.cos(math.radians(20)))
+    assert f.euler()[1] == pytest.approx(20.)
+
+@pytest.mark.parametrize('method',['madgwick','mahony'])
+def test_filters_hold_still_and_follow_yaw(method):
+    f = orientation_filter(method)
+    for _ in range(400):
+        f.step(0.,0.,0.,0.,0.,GRAVITY,0.005)
+    assert f.euler() == pytest.approx((0.,0.,0.),abs=1E-6)
+    for _ in range(400): #2s at 0.5 rad/s
+        f.step(0.,0.,0.5,0.,0.,GRAVITY,0.005)
+    assert f.euler()[2] == pytest.approx(math.degrees(1.),abs=0.5)
+    assert abs(sum(v*v for v in f.q) - 1) < 1E-12
+
+@pytest.mark.parametrize('method,seconds',[('madgwick',30),('mahony',10)])
+def test_filters_converge_on_gravity(method,seconds):
+    f = orientation_filter(method)
+    f.step(0.,0.,0.,0.,0.,GRAVITY,0.005) #starts level
+    for _ in range(int(seconds/0.005)):
+        f.step(0.,0.,0.,*tilted(30),0.005)
+    assert f.euler()[0] == pytest.approx(30.,abs=0.5)
+
+def test_mahony_integral_cancels_gyro_bias():
+    f = orientation_filter('mahony',gain=1.,ki=0.5)
+    f.step(0.,0.,0.,0.,0.,GRAVITY,0.005)
+    for _ in range(8000):
+        f.step(0.02,0.,0.,0.,0.,GRAVITY,0.005)
+    assert f.euler()[0] == pytest.approx(0.,abs=0.1)
+    assert f._int[0] == pytest.approx(-0.02,abs=2E-3)
+
+def test_bad_method():
+    with pytest.raises(AssertionError):
+        orientation_filter('kalman')
+
+
+def test_heave_passes_waves_and_drops_bias():
+    dt = 0.005
+    w = 2*math.pi/2. #2s waves
+    h = heave_integrator(tau=5.)
+    z = []
+    for i in range(int(120/dt)):
+        t = i*dt
+        z.append(h.step(-0.5*w*w*math.sin(w*t) + 0.05,dt))
+    last = np.array(z[-int(4/dt):])
+    assert (last.max() - last.min())/2 == pytest.approx(0.5,rel=0.1)
+    assert abs(last.mean()) < 0.05
+
+def test_fusion_skips_gaps():
+    fus = imu_fusion('mahony',tau=5.)
+    times = np.array([0.,0.005,0.01,5.,5.005])
+    accel = np.tile([0.,0.,GRAVITY+1.],(5,1))
+    out = fus.update(times,accel,np.zeros((5,3)))
+    assert out.shape == (5,4)
+    assert out[0,3] == 0.
+    #the gap only re-levels, heave holds across it
+    assert out[3,3] == out[2,3] and out[4,3] != out[3,3]
+    assert fus.samples == 5 and fus.last_t == 5.005
@@ -0,0 +1,109 @@
+"""frames, segment rotation and crash recovery of waveware.segment_log"""
+import os
+
+from waveware.segment_log import (encode_frame, read_frames, frames_end, read_segment, materialize,
+                                  segment_log, event_log, frame_head)
+
+
+def test_frames_round_trip():
+    buf = encode_frame(b'S',{'timestamp':1.,'x':2}) + encode_frame(b'P',{1:{'title':'a'}})
+    assert list(read_frames(buf)) == [(b'S',{'timestamp':1.,'x':2}),(b'P',{'1':{'title':'a'}})]
+    assert frames_end(buf) == len(buf)
+
+def test_torn_and_corrupt_frames_end_the_read():
+    a = encode_frame(b'S',{'n':0})
+    b = encode_frame(b'S',{'n':1})
+    for cut in range(1,len(b)):
+        buf = a + b[:cut]
+        assert [o['n'] for _,o in read_frames(buf)] == [0]
+        assert frames_end(buf) == len(a)
+    bad = bytearray(b)
+    bad[-2] ^= 0xFF
+    buf = a + bytes(bad) + a
+    assert [o['n'] for _,o in read_frames(buf)] == [0]
+    assert frames_end(buf) == len(a)
+    #a zero length frame is never written
+    assert frames_end(frame_head.pack(0,0)) == 0
+
+
+def snapshots(ver):
+    return {1:{'title':'first','z':1.},2:{'title':'second','z':2.}}.get(ver)
+
+def test_segments_rotate_and_repeat_snapshots(tmp_path):
+    wal = segment_log(str(tmp_path),params_fn=snapshots)
+    wal.append({'timestamp':1.,'param_ver':1})
+    wal.append({'timestamp':2.,'param_ver':2})
+    wal.sync()
+    first = wal.active
+    assert wal.closed() == []
+    wal.append({'timestamp':3.,'param_ver':2})
+    wal.sync(rotate=True)
+    assert wal.closed() == [first]
+    wal.close()
+    assert len(wal.closed()) == 2
+
+    rows,params = read_segment(first)
+    assert [r['timestamp'] for r in rows] == [1.,2.]
+    assert params == {1:snapshots(1),2:snapshots(2)}
+    #the second segment stands on its own
+    rows,params = read_segment(wal.closed()[1])
+    assert rows == [{'timestamp':3.,'param_ver':2}]
+    assert materialize(rows[0],params) == {'title':'second','z':2.,'timestamp':3.,'param_ver':2}
+    assert wal.stats['appended'] == 3 and wal.stats['segments'] == 2
+
+def test_size_rotation(tmp_path):
+    wal = segment_log(str(tmp_path),max_bytes=1)
+    for i in range(3):
+        wal.append({'timestamp':float(i)})
+        wal.sync()
+    wal.close()
+    assert [len(read_segment(p)[0]) for p in wal.closed()] == [1,1,1]
+
+def test_torn_tail_is_pending_again(tmp_path):
+    wal = segment_log(str(tmp_path))
+    for i in range(3):
+        wal.append({'timestamp':float(i)})
+    wal.sync()
+    path = wal.active
+    #crash part way through the next write
+    with open(path,'ab') as fp:
+        fp.write(encode_frame(b'S',{'timestamp':3.})[:-3])
+    again = segment_log(str(tmp_path))
+    assert again.closed() == [path] and again.stats['replayed'] == 1
+    rows,_ = read_segment(path)
+    assert [r['timestamp'] for r in rows] == [0.,1.,2.]
+
+def test_uploaded_segments_are_purged(tmp_path):
+    wal = segment_log(str(tmp_path),keep=2)
+    for i in range(4):
+        wal.append({'timestamp':float(i)})
+        wal.sync(rotate=True)
+    wal.close()
+    for path in wal.closed():
+        wal.mark_uploaded(path)
+    assert wal.closed() == []
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.sent')]) == 2
+    assert wal.stats['uploaded'] == 4
+
+
+def test_event_log_recovers_a_torn_tail(tmp_path):
+    path = str(tmp_path/'events.log')
+    ev = event_log(path)
+    ev.append({'kind':'start','run_id':'r1','utc':1.,'seq':0,'run_num':0,'param_ver':1})
+    ev.append({'kind':'stop','run_id':'r1','utc':2.,'seq':9,'reason':'done'})
+    ev.close()
+    good = os.path.getsize(path)
+    with open(path,'ab') as fp:
+        fp.write(encode_frame(b'E',{'kind':'start','run_id':'r2'})[:5])
+
+    ev = event_log(path)
+    assert os.path.getsize(path) == good
+    assert [e['n'] for e in ev.since()] == [0,1]
+    ev.append({'kind':'start','run_id':'r2','utc':3.,'seq':10})
+    ev.close()
+
+    ev = event_log(path)
+    assert [e['kind'] for e in ev.since(1)] == ['stop','start']
+    runs = ev.run_index()
+    assert [(r['run_id'],r['first_seq'],r['last_seq'],r['reason']) for r in runs] == [('r1',0,9,'done'),('r2',10,None,None)]
+    ev.close()
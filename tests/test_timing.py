@@ -0,0 +1,98 @@
+"""the lateness histogram and deadline pacing of waveware.timing"""
+import asyncio
+
+import pytest
+
+from waveware import timing
+from waveware.timing import lateness_histogram, deadline_scheduler
+
+
+def test_small_values_are_exact():
+    h = lateness_histogram(sub_bits=5)
+    for v in range(32):
+        assert h._index(v) == v and h._upper(v) == v
+
+def test_buckets_bound_their_values():
+    h = lateness_histogram(sub_bits=5,max_us=1_000_000)
+    last = -1
+    for v in list(range(0,5000)) + [65_535,65_536,999_999,1_000_000]:
+        i = h._index(v)
+        assert i >= last
+        last = i
+        up = h._upper(i)
+        assert up >= v
+        assert up - v <= v/16 #1/2**(sub_bits-1)
+        assert i == 0 or h._upper(i-1) < v
+
+def test_percentiles_and_summary():
+    h = lateness_histogram()
+    for v in range(1,101):
+        h.record(v)
+    h.record(-5) #clamped to 0
+    h.record(1E9) #clamped to max_us
+    s = h.summary()
+    assert s['count'] == 102
+    assert s['max_us'] == h.max_us
+    assert s['p50_us'] == pytest.approx(50,rel=1/16)
+    assert s['p90_us'] == pytest.approx(90,rel=1/16)
+    assert h.percentile(100) == h.max_us
+    assert h.buckets()[0] == [0,1]
+    assert sum(c for _,c in h.buckets()) == 102
+    h.reset()
+    assert h.summary()['count'] == 0 and h.percentile(50) == 0
+
+
+class fake_clock:
+    """perf_counter that only asyncio.sleep advances"""
+
+    def __init__(self):
+        self.now = 100.
+
+    def perf_counter(self):
+        return self.now
+
+    async def sleep(self,dt):
+        self.now += dt
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clk = fake_clock()
+    monkeypatch.setattr(timing.time,'perf_counter',clk.perf_counter)
+    monkeypatch.setattr(timing.asyncio,'sleep',clk.sleep)
+    return clk
+
+def test_deadlines_stay_on_the_grid(clock,loop):
+    sch = deadline_scheduler(0.01)
+
+    async def run():
+        out = [await sch.wait()]
+        clock.now += 0.004 #work shorter than a period
+        out.append(await sch.wait())
+        clock.now += 0.0125 #overran by a quarter period
+        out.append(await sch.wait())
+        out.append(await sch.wait())
+        return out
+
+    out = loop.run_until_complete(run())
+    assert [s for s,_ in out] == [0,1,2,3]
+    assert [l for _,l in out] == pytest.approx([0.,0.,0.0025,0.])
+    assert clock.now == pytest.approx(100.03)
+    assert sch.missed == 0
+
+def test_whole_missed_periods_are_skipped(clock,loop):
+    sch = deadline_scheduler(0.01)
+
+    async def run():
+        await sch.wait()
+        clock.now += 0.035 #three and a half periods of work
+        return await sch.wait()
+
+    slot,late = loop.run_until_complete(run())
+    assert (slot,sch.missed) == (3,2)
+    assert late == pytest.approx(0.005)
+    assert sch.deadline == pytest.approx(100.03)
+    st = sch.status()
+    assert (st['slot'],st['missed'],st['count']) == (3,2,2)
+    sch.reset()
+    assert sch.t0 is None and sch.missed == 0
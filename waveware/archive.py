@@ -0,0 +1,298 @@
+"""
+Compacts the json upload archive (a local `test_data` mirror or the bucket itself) into columnar partitions that load in seconds
+
+    {out}/samples/test=<test>/date=<YYYY-MM-DD>/part-<ns>-<uid>.parquet   sample rows, one per timestamp, with the upload_time they arrived in
+    {out}/events/part-<ns>-<uid>.parquet                                     inputs, zeros & notes (kind, test, time, source, mode, json payload)
+    {out}/_state.json                                                 source files already compacted (path: size/etag)
+
+Needs pyarrow (`pip install waveware[archive]`). Sources are streamed in path order and flushed in batches, the state is saved after each flush so an interrupted run resumes where it stopped and a later run only reads new files. Rows whose timestamp is already in a partition (and events whose source is already in the table) are dropped, so re-reading a file after a crash doesn't duplicate anything.
+"""
+import datetime
+import fnmatch
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+
+from waveware.uploads import decode_body, rows_to_table, pa, pq
+
+log = logging.getLogger('archive')
+
+#basename pattern: event kind (None is sample data)
+source_kinds = {'data_*.json*':None,
+                'set_input_*.json*':'input',
+                'zero*.json*':'zero',
+                'test_note*.json*':'note',
+                'session_results*.json*':'note',
+                'run_event_*.json*':'run'}
+
+def source_kind(path:str):
+    """(is archive source, event kind)"""
+    name = os.path.basename(path)
+    for pat,kind in source_kinds.items():
+        if fnmatch.fnmatch(name,pat):
+            return True,kind
+    return False,None
+
+def source_test(path:str)->str:
+    """uploads are keyed {test}/{date}/{file} under the folder"""
+    parts = path.replace('\\','/').split('/')
+    return parts[-3] if len(parts) >= 3 else 'unknown'
+
+def event_time(kind:str,dat:dict)->str:
+    if kind == 'note' and 'at' in dat:
+        return str(dat['at'])
+    return str(dat.get('upload_time',''))
+
+
+#Sources
+class local_source:
+    """upload files under a directory"""
+
+    def __init__(self,root:str):
+        self.root = root
+
+    def list(self):
+        """sorted (relative path,token)"""
+        out = []
+        for fil in glob.glob(os.path.join(self.root,'**','*.json*'),recursive=True):
+            rel = os.path.relpath(fil,self.root)
+            if source_kind(rel)[0]:
+                st = os.stat(fil)
+                out.append((rel,f'{st.st_size}:{int(st.st_mtime)}'))
+        return sorted(out)
+
+    def read(self,path:str)->bytes:
+        with open(os.path.join(self.root,path),'rb') as fp:
+            return fp.read()
+
+class s3_source:
+    """upload objects under s3://bucket/folder (or an s3 compatible endpoint)"""
+
+    def __init__(self,bucket:str,folder:str,profile:str=None,endpoint_url:str=None):
+        import boto3
+        self.bucket = bucket
+        self.prefix = folder.strip('/')+'/'
+        session = boto3.Session(profile_name=profile)
+        self.client = session.client('s3',endpoint_url=endpoint_url)
+
+    def list(self):
+        out = []
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket,Prefix=self.prefix)
+        for page in pages:
+            for obj in page.get('Contents',[]):
+                rel = obj['Key'][len(self.prefix):]
+                if source_kind(rel)[0]:
+                    out.append((rel,obj['ETag'].strip('"')))
+        return sorted(out)
+
+    def read(self,path:str)->bytes:
+        return self.client.get_object(Bucket=self.bucket,Key=self.prefix+path)['Body'].read()
+
+
+#Compaction
+class archive_compactor:
+    """Streams sources into the partitioned archive at `out_dir`, `run` only reads sources missing from (or changed since) the saved state"""
+
+    def __init__(self,out_dir:str,batch_rows:int=200_000):
+        if pa is None:
+            raise ImportError('archive compaction needs pyarrow, pip install waveware[archive]')
+        self.out_dir = out_dir
+        self.batch_rows = batch_rows
+        self.state_path = os.path.join(out_dir,'_state.json')
+        self.state = {'sources':{}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path,'r') as fp:
+                self.state = json.load(fp)
+        self.stats = {'files':0,'rows':0,'duplicates':0,'events':0,'parts':0,'errors':0}
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._rows = {} #(test,date): {ts:row}
+        self._events = {} #source: event
+        self._done = {} #source: token
+        self._n = 0
+
+    def pending(self,listing:list)->list:
+        seen = self.state['sources']
+        return [(p,t) for p,t in listing if seen.get(p,None) != t]
+
+    def run(self,source)->dict:
+        todo = self.pending(source.list())
+        log.info(f'compacting {len(todo)} new files into {self.out_dir}')
+        for i,(path,token) in enumerate(todo):
+            try:
+                self.add(path,decode_body(source.read(path)))
+            except Exception as e:
+                #left out of the state so the next run retries it
+                self.stats['errors'] += 1
+                log.warning(f'could not read {path}: {e}')
+                continue
+            self._done[path] = token
+            if self._n >= self.batch_rows:
+                self.flush()
+                log.info(f'compacted {i+1}/{len(todo)} files')
+        self.flush()
+        return self.stats
+
+    def add(self,path:str,dat:dict):
+        _,kind = source_kind(path)
+        test = source_test(path)
+        self.stats['files'] += 1
+        if kind is not None:
+            self._events[path] = {'kind':kind,'test':test,'time':event_time(kind,dat),'source':path,
+                                  'mode':(dat.get('data',None) or {}).get('mode',None) if kind == 'input' else None,
+                                  'payload':json.dumps(dat,default=str)}
+            return
+
+        up_time = str(dat.get('upload_time',''))
+        for row in dat.get('data',{}).values():
+            ts = row.get('timestamp',None)
+            if ts is None:
+                continue
+            date = datetime.datetime.fromtimestamp(ts,tz=datetime.timezone.utc).date().isoformat()
+            part = self._rows.setdefault((test,date),{})
+            if ts in part:
+                self.stats['duplicates'] += 1
+                continue
+            row = dict(row)
+            row['upload_time'] = up_time
+            part[ts] = row
+            self._n += 1
+
+    def flush(self):
+        """writes the batch as new part files, then records its sources as done"""
+        for (test,date),rows in self._rows.items():
+            pdir = os.path.join(self.out_dir,'samples',f'test={test}',f'date={date}')
+            have = set(read_column(pdir,'timestamp'))
+            new = [r for ts,r in sorted(rows.items()) if ts not in have]
+            self.stats['duplicates'] += len(rows) - len(new)
+            if new:
+                self._write(pdir,new)
+                self.stats['rows'] += len(new)
+
+        if self._events:
+            edir = os.path.join(self.out_dir,'events')
+            have = set(read_column(edir,'source'))
+            new = [e for s,e in sorted(self._events.items()) if s not in have]
+            if new:
+                self._write(edir,new)
+                self.stats['events'] += len(new)
+
+        self.state['sources'].update(self._done)
+        self.state['updated'] = str(datetime.datetime.now(tz=datetime.timezone.utc))
+        os.makedirs(self.out_dir,exist_ok=True)
+        tmp = self.state_path+'.tmp'
+        with open(tmp,'w') as fp:
+            json.dump(self.state,fp)
+        os.replace(tmp,self.state_path)
+        self._reset_batch()
+
+    def _write(self,pdir:str,rows:list):
+        os.makedirs(pdir,exist_ok=True)
+        #unique, and sorted by write time, even with concurrent writers or deleted parts
+        name = f'part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+        table = rows_to_table(rows,{})
+        tmp = os.path.join(pdir,f'.{name}.tmp')
+        pq.write_table(table,tmp,compression='zstd')
+        os.replace(tmp,os.path.join(pdir,f'{name}.parquet'))
+        self.stats['parts'] += 1
+
+
+#Reading
+def part_files(pdir:str)->list:
+    if not os.path.isdir(pdir):
+        return []
+    return sorted(os.path.join(pdir,f) for f in os.listdir(pdir) if f.endswith('.parquet'))
+
+def read_column(pdir:str,col:str)->list:
+    out = []
+    for fil in part_files(pdir):
+        if col in pq.read_schema(fil).names:
+            out.extend(pq.read_table(fil,columns=[col]).column(col).to_pylist())
+    return out
+
+def read_parts(files:list):
+    """one table of part files with differing columns"""
+    tables = [pq.read_table(f) for f in files]
+    if not tables:
+        return None
+    return pa.concat_tables(tables,promote_options='default')
+
+def archive_sources(out_dir:str)->set:
+    path = os.path.join(out_dir,'_state.json')
+    if not os.path.exists(path):
+        return set()
+    with open(path,'r') as fp:
+        return set(json.load(fp)['sources'])
+
+def load_events(out_dir:str,kind:str=None)->list:
+    """[(source,upload dict)] of archived events, optionally of one kind"""
+    table = read_parts(part_files(os.path.join(out_dir,'events')))
+    if table is None:
+        return []
+    out = []
+    for ev in table.to_pylist():
+        if kind is None or ev['kind'] == kind:
+            out.append((ev['source'],json.loads(ev['payload'])))
+    return out
+
+def load_samples(out_dir:str,test:str=None):
+    """arrow table of archived sample rows (all tests or one) with `test` & `date` columns"""
+    tables = []
+    for tdir in sorted(glob.glob(os.path.join(out_dir,'samples','test=*'))):
+        tname = os.path.basename(tdir)[len('test='):]
+        if test is not None and tname != test:
+            continue
+        for ddir in sorted(glob.glob(os.path.join(tdir,'date=*'))):
+            table = read_parts(part_files(ddir))
+            if table is None:
+                continue
+            n = table.num_rows
+            table = table.append_column('test',pa.array([tname]*n,type=pa.string()))
+            table = table.append_column('date',pa.array([os.path.basename(ddir)[len('date='):]]*n,type=pa.string()))
+            tables.append(table)
+    if not tables:
+        return None
+    return pa.concat_tables(tables,promote_options='default')
+
+def load_uploads(out_dir:str):
+    """archived samples regrouped by the upload they came in, as {'upload_time':..,'data':{ts:row}} like a json data upload"""
+    table = load_samples(out_dir)
+    if table is None:
+        return
+    uploads = {}
+    for row in table.drop_columns(['test','date']).to_pylist():
+        row = {k:(None if isinstance(v,float) and v != v else v) for k,v in row.items()}
+        uploads.setdefault(row['upload_time'],{})[row['timestamp']] = row
+    for up_time,data in sorted(uploads.items()):
+        yield {'upload_time':up_time,'data':data}
+
+
+def main():
+    """compacts the upload archive into columnar partitions"""
+    import argparse
+    from waveware.config import bucket, folder, aws_profile, s3_endpoint
+
+    parser = argparse.ArgumentParser('WaveTank Archive Compaction')
+    parser.add_argument('out',help='archive directory')
+    parser.add_argument('--src',help='local test_data mirror (default: read the bucket)',default=None)
+    parser.add_argument('--bucket',default=bucket)
+    parser.add_argument('--folder',default=folder)
+    parser.add_argument('--endpoint',help='s3 compatible endpoint url',default=s3_endpoint)
+    parser.add_argument('--batch-rows',type=int,default=200_000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=20)
+    if args.src:
+        source = local_source(args.src)
+    else:
+        source = s3_source(args.bucket,args.folder,aws_profile,args.endpoint)
+    stats = archive_compactor(args.out,args.batch_rows).run(source)
+    log.info(f'compaction done: {stats}')
+
+
+if __name__ == '__main__':
+    main()
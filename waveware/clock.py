@@ -0,0 +1,152 @@
+"""
+Clock model relating the three timebases of the rig
+    pigpio tick: uint32 microseconds from the pigpio daemon, wraps every ~72 minutes
+    perf_counter: monotonic seconds, the timebase of sample & stream timestamps
+    utc: wall clock epoch seconds, what uploads and post processing line up on
+
+tick_unwrapper extends ticks to 64 bits, clock_model keeps linear fits perf = a + b*tick and utc = c + d*perf over a window of recent paired readings (tick pairs with the shortest request round trips only) so any tick or perf time converts to the common timebase or an anchored utc epoch.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+log = logging.getLogger('clock')
+
+TICK_WRAP = 1<<32
+TICK_HALF = 1<<31
+
+
+class tick_unwrapper:
+    """Maps uint32 ticks onto a 64 bit count, the reference advances with each newer tick and ticks within half a wrap either side of it resolve correctly"""
+
+    def __init__(self):
+        self.ref_tick = None
+        self.ref = 0 #unwrapped value of ref_tick
+
+    def __call__(self,tick):
+        """unwrapped tick(s) (int or numpy array), a newer scalar tick advances the reference"""
+        if np.ndim(tick):
+            tick = np.asarray(tick,dtype=np.int64)
+            if self.ref_tick is None:
+                if not len(tick):
+                    return tick
+                self.ref_tick = self.ref = int(tick[0])
+            return self.ref + ((tick - self.ref_tick + TICK_HALF) & (TICK_WRAP-1)) - TICK_HALF
+
+        tick = int(tick)
+        if self.ref_tick is None:
+            self.ref_tick = self.ref = tick
+            return tick
+        d = ((tick - self.ref_tick + TICK_HALF) & (TICK_WRAP-1)) - TICK_HALF
+        out = self.ref + d
+        if d > 0:
+            self.ref_tick = tick
+            self.ref = out
+        return out
+
+def linear_fit(x,y):
+    """(intercept at x[0],slope,x[0],rms residual) of y over x, centered for precision"""
+    x0 = x[0]
+    xc = x - x0
+    if len(x) < 2 or np.ptp(xc) <= 0:
+        return float(np.mean(y)),1.,float(x0),0.
+    slope,icpt = np.polyfit(xc,y,1)
+    res = y - (icpt + slope*xc)
+    return float(icpt),float(slope),float(x0),float(np.sqrt(np.mean(res**2)))
+
+
+class clock_model:
+    """Paired readings of tick/perf and perf/utc fitted over the last `window` of each.
+
+    Tick pairs are read as perf before & after a `get_current_tick` request, the midpoint is used and only pairs with a round trip at or under the `rtt_quantile` of the window take part in the fit.
+    """
+
+    def __init__(self,window:int=120,rtt_quantile:float=0.5):
+        self.window = window
+        self.rtt_quantile = rtt_quantile
+        self.unwrap = tick_unwrapper()
+        self.tick_pairs = deque(maxlen=window) #(tick us unwrapped,perf,rtt)
+        self.wall_pairs = deque(maxlen=window) #(perf,utc)
+        self.tick_fit = None #(perf at t0,s per tick us,t0,rms)
+        self.wall_fit = None #(utc at p0,utc s per perf s,p0,rms)
+        self.add_wall_pair()
+
+    #Readings
+    def add_tick_pair(self,tick:int,perf:float,rtt:float=0.):
+        self.tick_pairs.append((self.unwrap(tick),perf,rtt))
+        self._fit_ticks()
+
+    def add_wall_pair(self,perf:float=None,utc:float=None):
+        if perf is None:
+            perf = time.perf_counter()
+            utc = time.time()
+        self.wall_pairs.append((perf,utc))
+        self._fit_wall()
+
+    async def read_tick(self,pi):
+        """one tick pair from pigpio"""
+        p0 = time.perf_counter()
+        tick = await pi.get_current_tick()
+        p1 = time.perf_counter()
+        self.add_tick_pair(tick,(p0+p1)/2,p1-p0)
+
+    def _fit_ticks(self):
+        pairs = np.array(self.tick_pairs,dtype=np.float64)
+        rtt = pairs[:,2]
+        keep = rtt <= np.quantile(rtt,self.rtt_quantile)
+        sel = pairs[keep]
+        if len(sel) < 2:
+            #only an offset, at nominal rate
+            tk,pf,_ = pairs[-1]
+            self.tick_fit = (pf,1E-6,tk,0.)
+            return
+        icpt,slope,x0,rms = linear_fit(sel[:,0],sel[:,1])
+        self.tick_fit = (icpt,slope,x0,rms)
+
+    def _fit_wall(self):
+        pairs = np.array(self.wall_pairs,dtype=np.float64)
+        self.wall_fit = linear_fit(pairs[:,0],pairs[:,1])
+
+    #Conversions
+    def perf_from_tick(self,tick):
+        """perf_counter time of pigpio tick(s), None before the first tick pair"""
+        if self.tick_fit is None or tick is None:
+            return None
+        icpt,slope,x0,_ = self.tick_fit
+        return icpt + slope*(self.unwrap(tick) - x0)
+
+    def utc(self,perf):
+        """utc epoch seconds of perf_counter time(s)"""
+        icpt,slope,x0,_ = self.wall_fit
+        return icpt + slope*(np.asarray(perf,dtype=np.float64) - x0) if np.ndim(perf) else icpt + slope*(perf - x0)
+
+    def utc_from_tick(self,tick):
+        perf = self.perf_from_tick(tick)
+        return None if perf is None else self.utc(perf)
+
+    def anchor(self)->dict:
+        """the current perf > utc mapping, enough to convert a stream's perf times offline: utc = utc0 + drift*(perf - perf0)"""
+        icpt,slope,x0,rms = self.wall_fit
+        return {'perf0':x0,'utc0':icpt,'drift':slope,'rms':rms}
+
+    def status(self)->dict:
+        out = {'wall':self.anchor(),'wall_pairs':len(self.wall_pairs),'tick_pairs':len(self.tick_pairs)}
+        if self.tick_fit is not None:
+            icpt,slope,x0,rms = self.tick_fit
+            out['tick'] = {'tick0':x0,'perf0':icpt,'ppm':(slope*1E6-1)*1E6,'rms_us':rms*1E6}
+            out['rtt_us'] = float(np.median([p[2] for p in self.tick_pairs]))*1E6
+        return out
+
+    async def task(self,pi=None,period:float=1.):
+        """refresh the fits every `period`, tick pairs only with a connected pigpio"""
+        while True:
+            try:
+                self.add_wall_pair()
+                if pi is not None:
+                    await self.read_tick(pi)
+            except Exception as e:
+                log.info(f'clock sync error: {e}')
+            await asyncio.sleep(period)
@@ -74,6 +74,15 @@ except:
 LOG_TO_S3 = os.environ.get('WAVEWARE_LOG_S3','true').lower().strip()=='true'
 bucket = os.environ.get('WAVEWARE_S3_BUCKET',"nept-wavetank-data")
 folder = os.environ.get('WAVEWARE_FLDR_NAME',"V1")
+#uploads: data batch compression (none,gzip,zstd), parallel puts, tries per put & an optional endpoint (ie a local S3 stand in)
+s3_codec = os.environ.get('WAVEWARE_S3_CODEC','none').lower().strip()
+assert s3_codec in ('none','gzip','zstd'), f'bad upload codec, check WAVEWARE_S3_CODEC!'
+s3_concurrency = int(os.environ.get('WAVEWARE_S3_CONCURRENCY',4))
+s3_retries = int(os.environ.get('WAVEWARE_S3_RETRIES',5))
+s3_endpoint = os.environ.get('WAVEWARE_S3_ENDPOINT',None)
+#sample batches as json objects, or `parquet` / `arrow` columnar segments listed in a per test manifest (needs pyarrow: waveware[archive])
+upload_format = os.environ.get('WAVEWARE_UPLOAD_FORMAT','json').lower().strip()
+assert upload_format in ('json','parquet','arrow'), f'bad upload format, check WAVEWARE_UPLOAD_FORMAT!'
 PLOT_STREAM = (os.environ.get('PLOT_STREAM','false')=='true')
 
 FW_HOST = os.environ.get('FW_HOST','0.0.0.0' if ON_RASPI else '127.0.0.1')
@@ -96,6 +105,34 @@ num_update_interval = float(os.environ.get('WAVEWARE_DASH_READ_UPT','1.5'))
 poll_rate = float(os.environ.get('WAVEWARE_POLL_RATE',1.0 / 33))
 poll_temp = float(os.environ.get('WAVEWARE_POLL_TEMP',60))
 window = float(os.environ.get('WAVEWARE_WINDOW',6))
+#live stream: samples held per client before the oldest are shed
+stream_queue_len = int(os.environ.get('WAVEWARE_STREAM_QUEUE',int(window/poll_rate)))
+#pipeline overflow policies: buffer (poll > process) and upload (cache > s3) stages, block, drop_oldest, drop_newest or spill (to disk)
+buffer_policy = os.environ.get('WAVEWARE_BUFFER_POLICY','block').lower().strip()
+upload_policy = os.environ.get('WAVEWARE_UPLOAD_POLICY','drop_oldest').lower().strip()
+assert upload_policy != 'block', f'the upload stage cannot block processing, check WAVEWARE_UPLOAD_POLICY!'
+#poll & process samples in one stage writing straight into the store, instead of through a queue
+FUSED_PIPELINE = os.environ.get('WAVEWARE_FUSED','false').lower().strip()=='true'
+#every source also publishes into its own stream at its native rate (see streams.py), multirate uploads those raw streams and leaves the imu/temp values out of the polled samples
+MULTIRATE = os.environ.get('WAVEWARE_MULTIRATE','false').lower().strip()=='true'
+imu_rate = float(os.environ.get('WAVEWARE_IMU_RATE',poll_rate))
+stream_seconds = float(os.environ.get('WAVEWARE_STREAM_SECONDS',window*2)) #history held per stream
+#MPU9250: `poll` reads the registers every imu_rate s, `fifo` samples accel & gyro into the chip's fifo at imu_fifo_rate Hz and drains it every imu_rate s
+imu_mode = os.environ.get('WAVEWARE_IMU_MODE','poll').lower().strip()
+assert imu_mode in ('poll','fifo'), f'bad imu mode, check WAVEWARE_IMU_MODE!'
+imu_fifo_rate = float(os.environ.get('WAVEWARE_IMU_FIFO_RATE',200))
+#online imu fusion (none, madgwick or mahony), a per sample filter in the imu path: gain is madgwick's beta / mahony's kp (blank for the default), heave_tau s is the heave integrator's drift time constant
+imu_fusion = os.environ.get('WAVEWARE_IMU_FUSION','none').lower().strip()
+assert imu_fusion in ('none','madgwick','mahony'), f'bad imu fusion, check WAVEWARE_IMU_FUSION!'
+fusion_gain = float(os.environ['WAVEWARE_FUSION_GAIN']) if os.environ.get('WAVEWARE_FUSION_GAIN','') else None
+heave_tau = float(os.environ.get('WAVEWARE_HEAVE_TAU',5))
+#clock model: seconds between tick / wall clock readings and readings per fit
+clock_sync = float(os.environ.get('WAVEWARE_CLOCK_SYNC',1.0))
+clock_window = int(os.environ.get('WAVEWARE_CLOCK_WINDOW',120))
+DASH_STREAM = os.environ.get('WAVEWARE_DASH_STREAM','true').lower().strip()=='true'
+#graphs are decimated to this many points (0 disables)
+dash_max_points = int(os.environ.get('WAVEWARE_DASH_MAX_POINTS',1000))
+dash_decimate = os.environ.get('WAVEWARE_DASH_DECIMATE','minmax').lower().strip()
 
 
 log.info(f'Running AWS User: {aws_profile}| {REMOTE_HOST} S3: {bucket} fld: {folder}| DEBUG: {DEBUG}| RASPI: {ON_RASPI}')
@@ -104,6 +141,22 @@ path = pathlib.Path(__file__)
 fdir = path.parent
 cache = diskcache.Cache(os.path.join(fdir,'data_cache','dl_cache.db'))
 
+#samples are appended to a local segment log (fsync'd every wal_sync s) and uploaded from closed segments, rotating by size / age (off uploads from the cache as before)
+WAL_ENABLED = os.environ.get('WAVEWARE_WAL','false').lower().strip()=='true'
+wal_dir = os.environ.get('WAVEWARE_WAL_DIR',os.path.join(fdir,'data_cache','wal'))
+wal_segment_bytes = int(os.environ.get('WAVEWARE_WAL_SEGMENT_BYTES',4_000_000))
+wal_segment_age = float(os.environ.get('WAVEWARE_WAL_SEGMENT_S',10))
+wal_sync = float(os.environ.get('WAVEWARE_WAL_SYNC',1.0))
+wal_keep = int(os.environ.get('WAVEWARE_WAL_KEEP',100)) #uploaded segments kept on disk
+#ADS1115 feedback: `poll` sleeps then reads, `alert` reads each conversion on its ALERT/RDY edge in a worker thread, at adc_rate samples/s
+adc_feedback = os.environ.get('WAVEWARE_ADC_FEEDBACK','poll').lower().strip()
+assert adc_feedback in ('poll','alert'), f'bad adc feedback mode, check WAVEWARE_ADC_FEEDBACK!'
+adc_rate = int(os.environ.get('WAVEWARE_ADC_RATE',128))
+#run feedback, control modes & the drive on a dedicated thread with its own event loop, the data path reads its state from a shared block
+CONTROL_THREAD = os.environ.get('WAVEWARE_CONTROL_THREAD','false').lower().strip()=='true'
+#run start / stop events, indexed by run id
+event_log_path = os.environ.get('WAVEWARE_EVENT_LOG',os.path.join(fdir,'data_cache','run_events.log'))
+
 def check_failure(typ):
     def f(res):
         try:
@@ -117,15 +170,33 @@ def check_failure(typ):
 encoder_pins = [(17,18),(27,22),(23,24),(25,5)]
 encoder_sens = [{'sens':0.005*4}]*4
 echo_pins = [16,26,20,21]
+#echo outlier rejection: ring size, hampel window & threshold (MADs), seconds without a valid echo before dropout
+echo_ring = int(os.environ.get('WAVEWARE_ECHO_RING',16))
+echo_window = int(os.environ.get('WAVEWARE_ECHO_WINDOW',7))
+echo_hampel_k = float(os.environ.get('WAVEWARE_ECHO_HAMPEL_K',3.0))
+echo_timeout = float(os.environ.get('WAVEWARE_ECHO_TIMEOUT',0.5))
+#gpio edges: `callback` per edge, or `notify` to read the pigpio notification pipe in batches
+gpio_ingest = os.environ.get('WAVEWARE_GPIO_INGEST','callback').lower().strip()
+assert gpio_ingest in ('callback','notify'), f'bad gpio ingest, check WAVEWARE_GPIO_INGEST!'
 
 pins_kw = dict(dir_pin=4,step_pin=6,speedpwm_pin=12,adc_alert_pin=7,hlfb_pin=13,motor_en_pin=19,torque_pwm_pin=10,echo_trig_pin=8)
 
+#sonar triggering: one trigger pin per echo pin (comma list, defaults to the shared echo_trig_pin)
+#pattern `all` pings every sonar at once, `pairs` alternates two halves, `round_robin` one at a time
+#each ping slot listens at least echo_listen seconds
+echo_trig_pins = [int(p) for p in os.environ.get('WAVEWARE_ECHO_TRIG_PINS','').split(',') if p.strip()]
+echo_trig_pins = echo_trig_pins or [pins_kw['echo_trig_pin']]*len(echo_pins)
+assert len(echo_trig_pins) == len(echo_pins), f'need one trigger pin per echo pin, check WAVEWARE_ECHO_TRIG_PINS!'
+echo_pattern = os.environ.get('WAVEWARE_ECHO_PATTERN','all').lower().strip()
+assert echo_pattern in ('all','pairs','round_robin'), f'bad echo pattern, check WAVEWARE_ECHO_PATTERN!'
+echo_listen = float(os.environ.get('WAVEWARE_ECHO_LISTEN',0.25))
+
 log.info(f'PIN SETTINGS:')
 for i,(a,b) in enumerate(encoder_pins):
     log.info(f'ENCDR CH: {i} A: {a} B:{b}')
 
 for i,ep in enumerate(echo_pins):
-    log.info(f'ECHO CH: {i} A: {ep} TRIG: {pins_kw["echo_trig_pin"]}')
+    log.info(f'ECHO CH: {i} A: {ep} TRIG: {echo_trig_pins[i]}')
 
 for k,p in pins_kw.items():
     log.info(f'{k.upper()}: {p}')
@@ -137,7 +208,18 @@ z_wave_parms = ['z_cur','z_err','z_wave','v_cur','v_cmd','v_wave','wave_fb_pct',
 z_sensors = [f'z{i+1}' for i in range(4)]
 e_sensors = [f'e{i+1}' for i in range(4)]
 
+imu_fields = ['ax','ay','az','gx','gy','gz','mx','my','mz','imutime','temp']
+fusion_fields = ['roll','pitch','yaw','heave_imu']
+
+#fixed numeric channels of every sample, held in `sample_record` slots & one block in the store (anything else rides along as extras)
+sample_channels = z_sensors+e_sensors+z_wave_parms+imu_fields+fusion_fields
+sample_channels += [f'v_enc{i+1}' for i in range(4)]+[f'enc_miss{i+1}' for i in range(4)]
+sample_channels += [f'{e}_{s}' for e in e_sensors for s in ('n','age')]+['e_ts']
+sample_channels += ['coef_2','coef_10','coef_100','slot','late','param_ver','utc','e_time','run_id']
+
 zgraph = ['z_cur','z_err','z_wave']
+if imu_fusion != 'none':
+    zgraph.append('heave_imu')
 vgraph = ['v_cur','v_cmd','v_wave']
 acclgryo = ['az','ax','ay','gx','gy','gz','mz']
 
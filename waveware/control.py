@@ -14,8 +14,15 @@ import threading
 import time
 import sys,os,pathlib
 import math
+from collections import deque
+import numpy as np
 from waveware.config import *
 from waveware.data import *
+from waveware.decoders import decode_reports,level_bit
+from waveware.clock import tick_unwrapper
+from waveware.control_exec import state_fields
+from waveware import i2c_bus
+from waveware.i2c_bus import i2c_scheduler
 import random
 
 # Get I2C bus
@@ -43,8 +50,11 @@ def config_bit(pinx,fvinx=4):
     return int(f'1{dv}{vr}0',2)
 
 wait_factor = 2
+#conversion periods without an alert read before the feedback loop polls the adc itself
+adc_timeout_periods = 4
 fv_inx = 4
-dr_inx = 128#860
+dr_inx = adc_rate
+assert dr_inx in dr_ref, f'bad ADS1115 rate {dr_inx}, choose: {list(dr_ref)}'
 dr = dr_ref[dr_inx]
 min_res = volt_ref[fv_inx]/(2**16/2)
 # see https://thecavepearlproject.org/2020/05/21/using-the-ads1115-in-continuous-mode-for-burst-sampling/
@@ -54,6 +64,95 @@ high_thres = 0x8000
 
 vmove=vmove_default=[0.0001,0.001]
 
+
+class adc_alert_reader:
+    """Reads every ADS1115 conversion off the bus as soon as its ALERT/RDY pin pulses low (conversion ready).
+
+    A worker thread blocks on a pigpio notification pipe of just the alert pin, on each falling edge it reads the conversion register through `bus` (an i2c_device at feedback priority) and hands (tick,raw,perf) to the loop's queue, so nothing blocks the event loop. perf is the edge's tick mapped onto perf_counter by the smallest recent read-minus-tick offset (the read latency floor).
+    """
+
+    def __init__(self,bus,pin:int,addr:int=0x48,maxlen:int=1024):
+        self.bus = bus
+        self.pin = pin
+        self.addr = addr
+        self.maxlen = maxlen
+        self.unwrap = tick_unwrapper()
+        self._offsets = deque(maxlen=256)
+        self.handle = None
+        self.thread = None
+        self.stats = {'edges':0,'reads':0,'missed':0,'dropped':0,'errors':0,'timeouts':0}
+
+    async def start(self,pi):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.maxlen)
+        self.level = ((await pi.read_bank_1())>>self.pin)&1
+        self.handle = h = await pi.notify_open()
+        self._fd = os.open(f'/dev/pigpio{h}',os.O_RDONLY) #blocking, read in the worker
+        await pi.notify_begin(h,1<<self.pin)
+        self.thread = threading.Thread(target=self._run,name='adc-alert',daemon=True)
+        self.thread.start()
+        log.info(f'adc alert reader on pin {self.pin} handle {h}')
+
+    async def stop(self,pi):
+        if self.handle is None:
+            return
+        #closing the notification ends the pipe, the worker sees eof and exits
+        await pi.notify_close(self.handle)
+        self.handle = None
+        await asyncio.to_thread(self.thread.join,1.)
+        os.close(self._fd)
+
+    def _run(self):
+        rem = b''
+        while True:
+            try:
+                data = os.read(self._fd,4096)
+            except OSError as e:
+                log.info(f'adc alert pipe closed: {e}')
+                return
+            if not data:
+                return
+            ticks,levels,rem = decode_reports(rem+data)
+            if not len(ticks):
+                continue
+            bits = level_bit(levels,self.pin)
+            prev = np.concatenate(([self.level],bits[:-1]))
+            self.level = int(bits[-1])
+            falls = ticks[(prev == 1) & (bits == 0)]
+            if not len(falls):
+                continue
+            self.stats['edges'] += len(falls)
+            #only the newest conversion is still in the register
+            self.stats['missed'] += len(falls) - 1
+            self._read(int(falls[-1]))
+
+    def _read(self,tick:int):
+        try:
+            data = self.bus.read_i2c_block_data(self.addr,0x00,2)
+            now = time.perf_counter()
+        except Exception as e:
+            self.stats['errors'] += 1
+            log.info(f'adc alert read error: {e}')
+            return
+        raw = data[0] * 256 + data[1]
+        if raw > 32767:
+            raw -= 65535
+        t = self.unwrap(tick)*1E-6
+        self._offsets.append(now - t)
+        perf = t + min(self._offsets)
+        self.stats['reads'] += 1
+        self.loop.call_soon_threadsafe(self._put,(tick,raw,perf))
+
+    def _put(self,item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.stats['dropped'] += 1
+        self.queue.put_nowait(item)
+
+    async def get(self):
+        """the next conversion (tick,raw counts,perf_counter of the ready edge)"""
+        return await self.queue.get()
+
 PR_INT = 1000
     
 steps_per_rot = 360/1.8
@@ -75,6 +174,8 @@ class wave_control:
 
     adc_addr = 0x48
     t_command = 0 #torque fraction of upper limit 0-1
+    streams = None #stream_hub of the rig, set by hardware_control
+    executor = None #control_executor when control runs on its own thread
 
     def __init__(self, dir:int,step:int,speed_pwm:int,fb_an_pin:int,hlfb:int,torque_pwm,motor_en_pin,pi=None,**conf):
         """This class represents an A4988 stepper motor driver.  It uses two output pins
@@ -142,6 +243,7 @@ class wave_control:
 
         self._last_dir = 1
         self.feedback_volts = 0
+        self.feedback_tick = None #pigpio tick of the last conversion ready edge (alert feedback)
         self.last_feedback = 0
         self.fail_feedback = None
 
@@ -269,7 +371,8 @@ class wave_control:
         loop.run_until_complete(self.start_control())
         self.first_feedback = d = asyncio.Future()
 
-        self.set_speed_tasks()
+        if not self._elsewhere():
+            self.set_speed_tasks()
 
         def go(*args,docal=True,**kw):
             nonlocal self, loop
@@ -303,7 +406,13 @@ class wave_control:
         else:
             log.info(f'already enabled!')
 
+    def _elsewhere(self)->bool:
+        """control runs on its executor's thread and this isn't it"""
+        return self.executor is not None and self.executor.running and not self.executor.in_thread()
+
     async def start_control(self):
+        if self._elsewhere():
+            return await self.executor.run(self.start_control())
         self.mark_start()
         await self.enable_control()
         if self.enabled and self.stopped:
@@ -322,6 +431,8 @@ class wave_control:
         self.enabled = False
 
     async def stop_control(self):
+        if self._elsewhere():
+            return await self.executor.run(self.stop_control())
         await self.disable_control()
         await self._stop()
 
@@ -352,6 +463,8 @@ class wave_control:
 
         await self.sleep(0.1)
         if ON_RASPI:
+            if getattr(self,'adc',None) is not None:
+                await self.adc.stop(self.pi)
 
             #Set PWM Drive off
             log.info(f'setting pwm off')
@@ -398,28 +511,26 @@ class wave_control:
 
 
     
-    def setup_i2c(self,cv_inx = 0,smb=None,lock=None):
-        if smb is None:
-            self.smbus = smbus.SMBus(1)
-        else:
-            self.smbus = smb
-
-        if lock is None:
-            self.i2c_lock = threading.Lock()
-        else:
-            self.i2c_lock = lock
+    def setup_i2c(self,cv_inx = 0,bus=None):
+        if bus is None:
+            bus = i2c_scheduler(smbus.SMBus(1))
+            bus.start()
+        self.i2c = bus
+        #the adc is the only device at feedback priority
+        self.adc_bus = bus.device('adc',i2c_bus.FEEDBACK)
 
         try:
             cb = config_bit(cv_inx,fvinx = 4)
-            db = int(f'{dr}00011',2)
+            #comparator queue 11 disables ALERT/RDY, 00 with the thresholds below pulses it low at every conversion
+            db = int(f'{dr}00000',2) if adc_feedback == 'alert' else int(f'{dr}00011',2)
             data = [cb,db]
             #do this before reading different pin, 
             log.info(f'setting adc to: {[bin(d) for d in data]}')
-            with self.i2c_lock:
-                self.smbus.write_i2c_block_data(0x48, 0x01, data)
-            #setup alert pin!
-            #self.smbus.write_i2c_block_data(0x48, 0x02, [0x00,0x00])
-            #self.smbus.write_i2c_block_data(0x48, 0x03, [0x80,0x00])
+            if adc_feedback == 'alert':
+                #hi threshold msb 1, lo msb 0: conversion ready mode
+                self.adc_bus.write_i2c_block_data(0x48, 0x02, [low_thres>>8,low_thres&0xFF])
+                self.adc_bus.write_i2c_block_data(0x48, 0x03, [high_thres>>8,high_thres&0xFF])
+            self.adc_bus.write_i2c_block_data(0x48, 0x01, data)
             self.adc_ready = True
 
         #TODO: handle i2c failure and restart or reattempt
@@ -440,6 +551,9 @@ class wave_control:
                     not self.fail_st])
     
     def set_mode(self,new_mode):
+        if self._elsewhere():
+            #mode futures live on the control loop, the caller gets a future of the change
+            return self.executor.submit(self.set_mode,new_mode)
         log.info(f'setting mode: {new_mode}')
         new_mode = new_mode.strip().lower()
         assert new_mode in drive_modes,f'bad drive mode {new_mode}! choose: {drive_modes}'
@@ -462,6 +576,8 @@ class wave_control:
         self.mode_changed = asyncio.Future()
     
     def set_speed_mode(self,new_mode):
+        if self._elsewhere():
+            return self.executor.submit(self.set_speed_mode,new_mode)
         new_mode = new_mode.strip().lower()
         assert new_mode in speed_modes,f'bad speed mode {new_mode}! choose: {speed_modes}'
         new_mode = new_mode.lower().strip()
@@ -507,6 +623,9 @@ class wave_control:
 
 
     def setup_control(self):
+        if self._elsewhere():
+            #already set up on the control loop by the executor
+            return
         log.info('starting...')
         assert self.adc_ready, f'cannot run without feedback!'
 
@@ -704,21 +823,43 @@ class wave_control:
 
 
     #FEEDBACK & CONTROL TASKS
+    async def read_adc(self,wait:float):
+        """(raw counts,perf_counter time,polled) of the next ADS1115 conversion, from the alert reader or read off the bus after `wait` s without one.
+
+        An alert that doesn't come within `adc_timeout_periods` conversions flags fail_feedback, is counted in the reader's `timeouts` and the conversion register is polled instead.
+        """
+        if self.adc is not None:
+            try:
+                self.feedback_tick,raw_adc,t_adc = await asyncio.wait_for(self.adc.get(),adc_timeout_periods/float(dr_inx))
+                return raw_adc,t_adc,False
+            except asyncio.TimeoutError:
+                #alert pin went quiet, poll so the safety checks still see the position
+                self.fail_feedback = True
+                self.adc.stats['timeouts'] += 1
+        else:
+            await self.sleep(wait)
+
+        data = await self.adc_bus.call('read_i2c_block_data',0x48, 0x00, 2)
+        raw_adc = data[0] * 256 + data[1]
+        if raw_adc > 32767:
+            raw_adc -= 65535
+        return raw_adc,time.perf_counter(),True
+
     async def feedback(self,feedback_futr=None,alpha=0.25):
         log.info(f'starting feedback!')
         self.dvds = None
         VR = volt_ref[fv_inx]
         
 
-        #TODO: get interrupt working, IO error on read, try latching?
-        # self._adc_feedback_pin_cb = asyncio.Future()
-        # def trigger_read(gpio,level,tick):
-        #     adc = self._adc_feedback_pin_cb
-        #     adc.set_result(tick)
-        #     self._adc_feedback_pin_cb = asyncio.Future()
-        #     
-        # 
-        # await self.pi.callback(self._adc_feedback_pin,asyncpio.FALLING_EDGE,trigger_read)
+        #conversion ready interrupts, reads happen on the alert reader's thread
+        self.adc = None
+        if ON_RASPI and adc_feedback == 'alert':
+            try:
+                self.adc = adc_alert_reader(self.adc_bus,self._adc_feedback_pin)
+                await self.adc.start(self.pi)
+            except Exception as e:
+                log.error(f'adc alert setup failed, polling instead: {e}')
+                self.adc = None
 
         tlast = t_plast=  tnow = time.perf_counter()
         
@@ -736,17 +877,8 @@ class wave_control:
                     st_inx = self.inx
                     wait = wait_factor/float(dr_inx)
                     
-                    #TODO: add feedback interrupt on GPIO7
-                    #-await deferred, in pigpio callback set_result
-                    #tick = await self._adc_feedback_pin_cb
-                    await self.sleep(wait)
-                    
                     try:
-                        with self.i2c_lock:
-                            data = self.smbus.read_i2c_block_data(0x48, 0x00, 2)
-                        raw_adc = data[0] * 256 + data[1]
-                        if raw_adc > 32767:
-                            raw_adc -= 65535
+                        raw_adc,t_adc,polled = await self.read_adc(wait)
 
                         vlast = self.last_feedback
                         self.last_feedback = lv = self.feedback_volts
@@ -765,8 +897,9 @@ class wave_control:
                         if feedback_futr is not None:
                             feedback_futr.set_result(True)
                             feedback_futr = None #twas, no more                
-                        #ok!
-                        self.fail_feedback = False
+                        #ok! (a timed out alert stays a failure until the next alert read)
+                        if self.adc is None or not polled:
+                            self.fail_feedback = False
 
                     except Exception as e:
                         log.info('read i2c issue',e)
@@ -774,12 +907,13 @@ class wave_control:
                     
                     # Convert the data
                     vdtnow = self.v_command
-                    tnow = time.perf_counter()
+                    tnow = t_adc
 
                     kw = dict(tlast=tlast,vdtlast=vdtlast,vlast=vlast,st_inx=st_inx,vnow=vnow)
                     self.calc_rates(vdtnow,tnow,**kw)
                     #measured
                     self.v_cur = self.dvdt_10*self.dzdvref
+                    self.publish_state(tnow)
 
             except Exception as e:
                 self.fail_feedback = True
@@ -873,6 +1007,7 @@ class wave_control:
                     kw = dict(tlast=tlast,vdtlast=vdtlast,vlast=vlast,st_inx=st_inx,vnow=vnow)
                     self.calc_rates(vdtnow,tnow,**kw)
                     self.v_cur = v_cur
+                    self.publish_state(tnow)
 
             except Exception as e:
                 self.fail_feedback = True
@@ -881,6 +1016,26 @@ class wave_control:
 
         log.warning(f'NO FEEDBACK!!!!')           
 
+    def state_values(self,t)->list:
+        """the control state in `state_fields` order"""
+        flag = lambda v: float('nan') if v is None else float(bool(v))
+        return [t,self.v_cmd,self.v_command,self.v_cur,self.v_wave,self.z_cur,self.z_err,self.z_wave,self.z_center,
+                self.feedback_volts,self.feedback_pct,self.coef_2,self.coef_10,self.coef_100,
+                flag(self.fail_sc),flag(self.fail_st),flag(self.fail_feedback),flag(self.stopped),flag(self.enabled),flag(self.is_safe())]
+
+    def snapshot(self)->dict:
+        """consistent control state, from the executor's shared block when control runs on its own thread"""
+        if self.executor is not None and self.executor.running:
+            out = self.executor.block.read_dict()
+            if out:
+                return out
+        return dict(zip(state_fields,self.state_values(time.perf_counter())))
+
+    def publish_state(self,tnow):
+        """feedback & control state into the `control` stream at the feedback rate"""
+        if self.streams is not None:
+            self.streams.publish('control',tnow,(self.feedback_volts,self.z_cur,self.z_err,self.z_wave,self.v_command,self.v_cur))
+
     def calc_rates(self,vdtnow,tnow,**kw):
         vnow = kw.get('vnow')
         vlast = kw.get('vlast')
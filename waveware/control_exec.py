@@ -0,0 +1,178 @@
+"""
+Runs wave_control's feedback, control modes & drive loops on a dedicated thread with its own event loop (and pigpio connection), so a heavy web / data path on the main loop can't stall the control interval
+1. state_block: float64 block of the control state behind a sequence counter, the control thread is the only writer and any thread reads a consistent copy without a lock
+2. control_executor: the thread & its loop, a clock that snapshots the state every control interval (period & overrun stats), and marshalling of mode changes / start / stop onto the control loop
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+import asyncpio
+import numpy as np
+
+from waveware.config import ON_RASPI, check_failure
+from waveware.timing import deadline_scheduler
+
+log = logging.getLogger('cntl-exec')
+
+#published each control interval, flags as 0/1 (nan for unknown)
+state_fields = ['t','v_cmd','v_command','v_cur','v_wave','z_cur','z_err','z_wave','z_center',
+                'feedback_volts','feedback_pct','coef_2','coef_10','coef_100',
+                'fail_sc','fail_st','fail_feedback','stopped','enabled','is_safe']
+
+
+class state_block:
+    """Seqlock over [seq,*fields]: the writer makes seq odd, writes, then makes it even again, readers retry while it's odd or moved during their copy.
+
+    `buf` can be any writable buffer (ie a multiprocessing.shared_memory block) of (fields+1)*8 bytes.
+    """
+
+    def __init__(self,fields:list,buf=None):
+        self.fields = list(fields)
+        self.arr = np.ndarray(len(self.fields)+1,dtype=np.float64,buffer=buf)
+        self.arr[:] = np.nan
+        self.arr[0] = 0
+        self.retries = 0
+
+    def write(self,values):
+        arr = self.arr
+        arr[0] += 1
+        arr[1:] = values
+        arr[0] += 1
+
+    def read(self,tries:int=100):
+        """consistent copy of the values, None if the writer never let go"""
+        arr = self.arr
+        for _ in range(tries):
+            seq = arr[0]
+            if seq % 2 == 0:
+                vals = arr[1:].copy()
+                if arr[0] == seq:
+                    return vals
+            self.retries += 1
+        return None
+
+    def read_dict(self)->dict:
+        vals = self.read()
+        if vals is None:
+            return {}
+        return dict(zip(self.fields,vals.tolist()))
+
+
+class control_executor:
+    """The control thread of `control` (a wave_control), `period` is its clock & snapshot interval"""
+
+    def __init__(self,control,period:float=None):
+        self.control = control
+        self.period = period if period is not None else control.control_interval
+        self.block = state_block(state_fields)
+        self.clock = deadline_scheduler(self.period)
+        self.overruns = 0
+        self.loop = None
+        self.thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    @property
+    def running(self)->bool:
+        return self.thread is not None and self.thread.is_alive() and self.loop is not None
+
+    def in_thread(self)->bool:
+        return threading.current_thread() is self.thread
+
+    async def start(self,timeout:float=30.):
+        """starts the thread and waits (off the calling loop) until the control's tasks are set up on it"""
+        self.thread = threading.Thread(target=self._run,name='control',daemon=True)
+        self.thread.start()
+        if not await asyncio.to_thread(self._ready.wait,timeout):
+            raise TimeoutError(f'control thread not ready after {timeout}s')
+        if self._error is not None:
+            raise self._error
+        log.info(f'control running on its own thread at {self.period*1000:3.1f}ms')
+
+    def _run(self):
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._start())
+        except Exception as e:
+            log.error('control thread setup failed',exc_info=e)
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            #let the control's tasks unwind before the loop goes
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks,return_exceptions=True))
+            loop.close()
+            self.loop = None
+
+    async def _start(self):
+        """control.setup & setup_control, on this loop"""
+        cntl = self.control
+        cntl.mark_start()
+        cntl.mode_changed = asyncio.Future()
+        cntl.speed_control_mode_changed = asyncio.Future()
+        if ON_RASPI:
+            #pigpio connections belong to the loop they're opened on
+            cntl.pi = asyncpio.pi()
+        await cntl._setup()
+        cntl.feedback_task = asyncio.create_task(cntl.feedback())
+        cntl.feedback_task.add_done_callback(check_failure('feedbck task'))
+        cntl.setup_control()
+        self.clock_task = asyncio.create_task(self._clock())
+        self.clock_task.add_done_callback(check_failure('control clock'))
+
+    async def _clock(self):
+        cntl = self.control
+        while True:
+            _,late = await self.clock.wait()
+            if late > self.period:
+                self.overruns += 1
+            try:
+                self.block.write(cntl.state_values(time.perf_counter()))
+            except Exception as e:
+                log.info(f'control state error: {e}')
+
+    #Marshalling
+    def call_soon(self,fn,*args):
+        """fn(*args) on the control loop, fire and forget"""
+        self.loop.call_soon_threadsafe(fn,*args)
+
+    def submit(self,fn,*args)->concurrent.futures.Future:
+        """fn(*args) on the control loop, the future holds its result or exception (which is also logged, so nothing is lost if no one waits)"""
+        async def call():
+            return fn(*args)
+        futr = asyncio.run_coroutine_threadsafe(call(),self.loop)
+        futr.add_done_callback(check_failure(getattr(fn,'__name__','control call')))
+        return futr
+
+    async def run(self,coro):
+        """awaits coro on the control loop from another loop"""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro,self.loop))
+
+    async def stop(self):
+        """stops the control (drive off) then the thread's loop"""
+        if not self.running:
+            return
+        try:
+            await self.run(self.control._stop())
+            if ON_RASPI:
+                await self.run(self.control._close())
+        except Exception as e:
+            log.info(f'control stop error: {e}')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.to_thread(self.thread.join,2.)
+
+    def status(self)->dict:
+        out = self.clock.status()
+        out.update(overruns=self.overruns,retries=self.block.retries,alive=self.running)
+        return out
+
@@ -8,7 +8,11 @@ import pytz
 import datetime
 import pigpio
 import sys
-from expiringdict import ExpiringDict
+import json
+import struct
+import asyncio
+import numpy as np
+from collections import deque
 from math import cos,sin
 
 from waveware.config import *
@@ -21,4 +25,754 @@ path = pathlib.Path(__file__)
 fdir = path.parent
 disk_cache = diskcache.Cache(os.path.join(fdir,'data_cache','dl_cache.db'))
 
-memcache = ExpiringDict(max_len=window * 2 / poll_rate, max_age_seconds=window* 2)
\ No newline at end of file
+class sample_schema:
+    """The fixed numeric channels of a sample, `timestamp` first, shared by records and the store"""
+
+    def __init__(self,channels:list,time_key:str='timestamp'):
+        self.time_key = time_key
+        self.names = (time_key,)+tuple(dict.fromkeys(c for c in channels if c != time_key))
+        self.index = {k:i for i,k in enumerate(self.names)}
+        self.blank = [np.nan]*len(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def record(self):
+        return sample_record(self)
+
+
+class sample_record:
+    """One sample with its schema channels in a flat list of floats and anything else in `extra`.
+
+    Supports the dict access `output_data` & `process_data` use, an unset (nan) channel reads as missing.
+    """
+    __slots__ = ('schema','values','extra')
+
+    def __init__(self,schema:sample_schema):
+        self.schema = schema
+        self.values = schema.blank.copy()
+        self.extra = {}
+
+    def __setitem__(self,key,value):
+        i = self.schema.index.get(key,None)
+        if i is None:
+            self.extra[key] = value
+        else:
+            self.values[i] = np.nan if value is None else value
+
+    def __getitem__(self,key):
+        i = self.schema.index.get(key,None)
+        if i is None:
+            return self.extra[key]
+        return self.values[i]
+
+    def __contains__(self,key):
+        i = self.schema.index.get(key,None)
+        if i is None:
+            return key in self.extra
+        v = self.values[i]
+        return v == v
+
+    def get(self,key,default=None):
+        return self[key] if key in self else default
+
+    def update(self,other=(),**kw):
+        if hasattr(other,'items'):
+            other = other.items()
+        for k,v in other:
+            self[k] = v
+        for k,v in kw.items():
+            self[k] = v
+
+    def keys(self):
+        return [k for k,v in zip(self.schema.names,self.values) if v == v]+list(self.extra)
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return True
+
+    def to_dict(self)->dict:
+        out = {k:v for k,v in zip(self.schema.names,self.values) if v == v}
+        out.update(self.extra)
+        return out
+
+
+class sample_store:
+    """A preallocated columnar ring buffer of samples.
+
+    Numeric values (float/int/bool/None) are written into typed float64 columns, anything else (strings, lists, datetimes) is held in an object column. Samples must arrive with a monotonic `timestamp` which is kept in its own column so time ranges can be found with a binary search instead of a scan.
+
+    Columns are created on first sight of a key, after which appending a sample only writes into existing arrays.
+
+    Every sample also gets a sequence number, its count since the store was created. Reads by `since(seq)` return exactly the samples after a cursor, and `first_seq` tells a client whether it fell behind the ring.
+
+    With a `schema` its channels live in one 2D block (the columns are views into it), so a `sample_record` is stored with a single row write.
+    """
+
+    def __init__(self,capacity:int,max_age:float=None,time_key:str='timestamp',seq_key:str='seq',schema:sample_schema=None):
+        self.capacity = max(int(capacity),1)
+        self.max_age = max_age
+        self.time_key = time_key
+        self.seq_key = seq_key
+        self.schema = schema
+        self.ts = np.full(self.capacity,np.nan,dtype=np.float64)
+        self._count = 0 #total samples ever appended
+        self._init_columns()
+
+    def _init_columns(self):
+        self.columns = {}
+        self.kinds = {} #f: float, b: bool, o: object
+        self.free_keys = [] #columns outside the schema
+        if self.schema is not None:
+            self.block = np.full((self.capacity,len(self.schema)),np.nan,dtype=np.float64)
+            for j,key in enumerate(self.schema.names):
+                if key == self.time_key:
+                    continue
+                self.columns[key] = self.block[:,j]
+                self.kinds[key] = 'f'
+
+    #Write
+    def _new_column(self,key,value):
+        if isinstance(value,(bool,np.bool_)):
+            kind = 'b'
+        elif value is None or isinstance(value,(int,float,np.number)):
+            kind = 'f'
+        else:
+            kind = 'o'
+
+        if kind == 'o':
+            col = np.full(self.capacity,None,dtype=object)
+        else:
+            col = np.full(self.capacity,np.nan,dtype=np.float64)
+        self.columns[key] = col
+        self.kinds[key] = kind
+        self.free_keys.append(key)
+        return col
+
+    def _to_object(self,key):
+        """promote a numeric column to an object column when a non-numeric value shows up"""
+        if self.schema is not None and key in self.schema.index:
+            raise TypeError(f'schema channel {key} must be numeric')
+        col = self.columns[key]
+        ocol = np.full(self.capacity,None,dtype=object)
+        ok = ~np.isnan(col)
+        if self.kinds[key] == 'b':
+            ocol[ok] = col[ok].astype(bool)
+        else:
+            ocol[ok] = col[ok]
+        self.columns[key] = ocol
+        self.kinds[key] = 'o'
+        return ocol
+
+    def _write(self,key,col,inx,value):
+        if self.kinds[key] == 'o':
+            col[inx] = value
+            return
+        if value is None:
+            col[inx] = np.nan
+            return
+        try:
+            col[inx] = value
+        except (TypeError,ValueError):
+            col = self._to_object(key)
+            col[inx] = value
+
+    def append(self,row:dict)->int:
+        """writes a sample into the next slot, overwriting the oldest sample once full, returning its sequence number"""
+        if isinstance(row,sample_record):
+            return self.append_record(row)
+        ts = row[self.time_key]
+        if self._count and ts < self.last_time:
+            raise ValueError(f'non monotonic timestamp {ts} < {self.last_time}')
+
+        inx = self._count % self.capacity
+        self.ts[inx] = ts
+
+        #existing columns, clearing any that this row doesn't have
+        found = 0
+        for key,col in self.columns.items():
+            if key in row:
+                found += 1
+                self._write(key,col,inx,row[key])
+            elif self.kinds[key] == 'o':
+                col[inx] = None
+            else:
+                col[inx] = np.nan
+
+        #new columns
+        if found < len(row) - 1 - (self.seq_key in row):
+            for key,value in row.items():
+                if key in (self.time_key,self.seq_key) or key in self.columns:
+                    continue
+                col = self._new_column(key,value)
+                self._write(key,col,inx,value)
+
+        self._count += 1
+        return self._count - 1
+
+    def append_record(self,rec:sample_record)->int:
+        """`append` for a record of this store's schema, channels are one row write & only the extras go key by key"""
+        if rec.schema is not self.schema:
+            return self.append(rec.to_dict())
+        values = rec.values
+        ts = values[0]
+        if self._count and ts < self.last_time:
+            raise ValueError(f'non monotonic timestamp {ts} < {self.last_time}')
+
+        inx = self._count % self.capacity
+        self.ts[inx] = ts
+        self.block[inx] = values
+
+        extra = rec.extra
+        found = 0
+        for key in self.free_keys:
+            col = self.columns[key]
+            if key in extra:
+                found += 1
+                self._write(key,col,inx,extra[key])
+            elif self.kinds[key] == 'o':
+                col[inx] = None
+            else:
+                col[inx] = np.nan
+
+        if found < len(extra) - (self.seq_key in extra):
+            for key,value in extra.items():
+                if key == self.seq_key or key in self.columns:
+                    continue
+                col = self._new_column(key,value)
+                self._write(key,col,inx,value)
+
+        self._count += 1
+        return self._count - 1
+
+    def extend(self,cols:dict):
+        """writes a block of samples given as columns (ie from `decode_columns`), vectorized per column"""
+        ts = np.asarray(cols[self.time_key],dtype=np.float64)
+        n = len(ts)
+        if n == 0:
+            return
+        if (self._count and ts[0] < self.last_time) or np.any(np.diff(ts) < 0):
+            raise ValueError(f'non monotonic timestamps in block')
+
+        skip = max(n - self.capacity,0) #only the newest fit
+        inx = np.arange(self._count + skip,self._count + n) % self.capacity
+        self.ts[inx] = ts[skip:]
+
+        for key,values in cols.items():
+            if key in (self.time_key,self.seq_key):
+                continue
+            values = np.asarray(values)
+            if key not in self.columns:
+                self._new_column(key,values.flat[0] if values.dtype == object else values.dtype.type(0))
+            col = self.columns[key]
+            if self.kinds[key] != 'o' and values.dtype == object:
+                col = self._to_object(key)
+            col[inx] = values[skip:]
+
+        for key,col in self.columns.items():
+            if key not in cols:
+                col[inx] = None if self.kinds[key] == 'o' else np.nan
+
+        self._count += n
+
+    def clear(self):
+        self.ts[:] = np.nan
+        self._init_columns()
+        self._count = 0
+
+    #Read
+    def __len__(self):
+        return min(self._count,self.capacity)
+
+    def __bool__(self):
+        return self._count > 0
+
+    @property
+    def last_index(self):
+        if self._count:
+            return (self._count-1) % self.capacity
+        return None
+
+    @property
+    def last_time(self):
+        if self._count:
+            return float(self.ts[self.last_index])
+        return None
+
+    @property
+    def first_time(self):
+        if self._count:
+            return float(self.ts[self._first % self.capacity])
+        return None
+
+    @property
+    def _first(self):
+        """logical index of the oldest retained sample"""
+        return max(self._count - self.capacity,0)
+
+    @property
+    def first_seq(self):
+        """sequence number of the oldest retained sample"""
+        if self._count:
+            return self._first
+        return None
+
+    @property
+    def last_seq(self):
+        if self._count:
+            return self._count - 1
+        return None
+
+    def _logical(self,inx):
+        """sequence numbers of physical slots"""
+        inx = np.asarray(inx)
+        first = self._first
+        return first + (inx - first) % self.capacity
+
+    def _search(self,t,side='right'):
+        """logical index of `t` in the timestamp column, the ring is two sorted segments [head:] and [:head] so this is two binary searches"""
+        first = self._first
+        if self._count <= self.capacity:
+            return int(np.searchsorted(self.ts[:self._count],t,side=side))
+
+        head = self._count % self.capacity
+        older = self.ts[head:]
+        if t < older[-1] or (side=='left' and t == older[-1]):
+            return first + int(np.searchsorted(older,t,side=side))
+        newer = self.ts[:head]
+        return first + len(older) + int(np.searchsorted(newer,t,side=side))
+
+    def _physical(self,lo,hi):
+        """physical slot indices for the logical range [lo,hi)"""
+        return np.arange(lo,hi) % self.capacity
+
+    def range(self,after:float=None,before:float=None):
+        """physical slot indices of samples with after < timestamp <= before in time order"""
+        if not self._count:
+            return np.arange(0)
+
+        lo = self._first
+        hi = self._count
+        if self.max_age is not None:
+            after = max(after,self.last_time - self.max_age) if after is not None else self.last_time - self.max_age
+        if after is not None:
+            lo = max(self._search(after,'right'),lo)
+        if before is not None:
+            hi = min(self._search(before,'right'),hi)
+        if hi <= lo:
+            return np.arange(0)
+        return self._physical(lo,hi)
+
+    def since(self,seq:int=None):
+        """physical slot indices of samples with a sequence number after `seq`, O(new samples)"""
+        lo = self._first if seq is None else max(int(seq) + 1,self._first)
+        if lo >= self._count:
+            return np.arange(0)
+        return self._physical(lo,self._count)
+
+    def lost(self,seq:int=None)->int:
+        """how many samples after `seq` have already left the ring"""
+        if seq is None or not self._count:
+            return 0
+        return max(self._first - (int(seq) + 1),0)
+
+    def find(self,ts:float):
+        """physical slot of the sample with exactly this timestamp or None"""
+        if not self._count:
+            return None
+        li = self._search(ts,'left')
+        if li >= self._count or li < self._first:
+            return None
+        inx = li % self.capacity
+        if self.ts[inx] == ts:
+            return inx
+        return None
+
+    def column(self,key,inx):
+        if key == self.time_key:
+            return self.ts[inx]
+        return self.columns[key][inx]
+
+    def to_columns(self,inx,keys:list=None):
+        """the selected samples as a dict of column arrays"""
+        if keys is None:
+            keys = self.columns.keys()
+        out = {self.time_key:self.ts[inx],self.seq_key:self._logical(inx)}
+        for key in keys:
+            if key in self.columns:
+                out[key] = self.columns[key][inx]
+        return out
+
+    def row(self,inx:int)->dict:
+        out = {self.time_key:float(self.ts[inx]),self.seq_key:int(self._logical(inx))}
+        for key,col in self.columns.items():
+            kind = self.kinds[key]
+            v = col[inx]
+            if kind == 'o':
+                out[key] = v
+            elif v != v: #nan
+                out[key] = None
+            elif kind == 'b':
+                out[key] = bool(v)
+            else:
+                out[key] = float(v)
+        return out
+
+    def rows(self,inx)->dict:
+        """the selected samples in the ts:row format used by the api"""
+        return {float(self.ts[i]):self.row(i) for i in inx}
+
+    def latest(self):
+        if not self._count:
+            return None
+        return self.row(self.last_index)
+
+    def __contains__(self,ts):
+        return self.find(ts) is not None
+
+    def __getitem__(self,ts):
+        inx = self.find(ts)
+        if inx is None:
+            raise KeyError(ts)
+        return self.row(inx)
+
+    def get(self,ts,default=None):
+        inx = self.find(ts)
+        if inx is None:
+            return default
+        return self.row(inx)
+
+
+def rows_to_columns(rows:list,keys:list=None,time_key:str='timestamp')->dict:
+    """turns a list of sample dicts into columns, numeric where possible"""
+    if keys is None:
+        keys = list(rows[0].keys()) if rows else []
+    elif time_key not in keys:
+        keys = [time_key]+list(keys)
+    cols = {}
+    for key in keys:
+        values = [r.get(key,None) for r in rows]
+        try:
+            cols[key] = np.array([np.nan if v is None else v for v in values],dtype=np.float64)
+        except (TypeError,ValueError):
+            arr = np.empty(len(values),dtype=object)
+            for i,v in enumerate(values):
+                arr[i] = v
+            cols[key] = arr
+    return cols
+
+
+def columns_to_rows(cols:dict,time_key:str='timestamp')->dict:
+    """inverse of `rows_to_columns` in the ts:row format used by the api"""
+    out = {}
+    keys = list(cols.keys())
+    for i,ts in enumerate(cols[time_key]):
+        row = {}
+        for key in keys:
+            v = cols[key][i]
+            if isinstance(v,np.generic):
+                v = v.item()
+            if isinstance(v,float) and v != v:
+                v = None
+            row[key] = v
+        out[float(ts)] = row
+    return out
+
+
+#Decimation
+#reduce a window of columns to about `max_points` samples that plot the same
+decimate_methods = ('minmax','lttb','mean')
+
+def _numeric(values):
+    return values.dtype != object and values.dtype.kind in 'fiub'
+
+def decimate_mean(cols:dict,max_points:int,time_key:str='timestamp')->dict:
+    """bucket averages, non-numeric columns keep the last value of each bucket"""
+    n = len(cols[time_key])
+    edges = np.linspace(0,n,max_points+1).astype(np.int64)
+    starts = edges[:-1]
+    last = edges[1:]-1
+    out = {}
+    for key,values in cols.items():
+        if key == time_key or (_numeric(values) and key != 'seq'):
+            v = values.astype(np.float64)
+            good = ~np.isnan(v)
+            cnt = np.add.reduceat(good.astype(np.int64),starts)
+            tot = np.add.reduceat(np.where(good,v,0),starts)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                out[key] = np.where(cnt > 0,tot/np.maximum(cnt,1),np.nan)
+        else:
+            out[key] = values[last]
+    return out
+
+def decimate_minmax(cols:dict,max_points:int,time_key:str='timestamp')->dict:
+    """per bucket min and max of every numeric column in the order they occurred, placed at the bucket's first and last time so the envelope is kept"""
+    ts = cols[time_key]
+    n = len(ts)
+    nb = max(max_points//2,1)
+    k = -(-n//nb) #ceil
+    nb = -(-n//k)
+    pad = nb*k - n
+
+    def shaped(values,fill):
+        return np.concatenate((values,np.full(pad,fill,dtype=values.dtype))).reshape(nb,k)
+
+    rows = np.arange(nb)
+    t = shaped(ts.astype(np.float64),np.nan)
+    out = {time_key:np.column_stack((t[:,0],np.nanmax(t,axis=1))).ravel()}
+
+    inx = shaped(np.arange(n),n-1)
+    for key,values in cols.items():
+        if key == time_key:
+            continue
+        if _numeric(values) and key != 'seq':
+            v = shaped(values.astype(np.float64),np.nan)
+            nan = np.isnan(v)
+            imin = np.argmin(np.where(nan,np.inf,v),axis=1)
+            imax = np.argmax(np.where(nan,-np.inf,v),axis=1)
+            vmin = v[rows,imin]
+            vmax = v[rows,imax]
+            first = np.where(imin <= imax,vmin,vmax)
+            second = np.where(imin <= imax,vmax,vmin)
+            out[key] = np.column_stack((first,second)).ravel()
+        else:
+            #bucket first and last sample
+            out[key] = values[np.column_stack((inx[:,0],inx.max(axis=1))).ravel()]
+    return out
+
+def decimate_lttb(cols:dict,max_points:int,time_key:str='timestamp')->dict:
+    """largest triangle three buckets, selecting one shared sample per bucket using the triangle area summed over every numeric column (each scaled to its range) so all series keep their shape on one time axis"""
+    ts = cols[time_key].astype(np.float64)
+    n = len(ts)
+    keys = [k for k,v in cols.items() if k not in (time_key,'seq') and _numeric(v)]
+    if keys:
+        y = np.column_stack([cols[k].astype(np.float64) for k in keys])
+        with np.errstate(invalid='ignore'):
+            lo = np.nanmin(y,axis=0)
+            rng = np.nanmax(y,axis=0) - lo
+        rng[~(rng > 0)] = 1
+        lo[np.isnan(lo)] = 0
+        y = np.nan_to_num((y - lo)/rng)
+    else:
+        y = np.zeros((n,1))
+    tn = (ts - ts[0])/max(ts[-1]-ts[0],1E-9)
+
+    #first and last are always kept, the middle is split into max_points-2 buckets
+    edges = np.linspace(1,n-1,max_points-1).astype(np.int64)
+    sel = np.empty(max_points,dtype=np.int64)
+    sel[0] = a = 0
+    for b in range(max_points-2):
+        s,e = edges[b],edges[b+1]
+        if b+2 < len(edges):
+            ns,ne = edges[b+1],edges[b+2]
+        else:
+            ns,ne = n-1,n
+        tc = tn[ns:ne].mean()
+        yc = y[ns:ne].mean(axis=0)
+        ta,ya = tn[a],y[a]
+        area = np.abs((ta - tc)*(y[s:e] - ya) - (ta - tn[s:e,None])*(yc - ya)).sum(axis=1)
+        a = s + int(np.argmax(area)) if e > s else s
+        sel[b+1] = a
+    sel[-1] = n-1
+    return {k:v[sel] for k,v in cols.items()}
+
+def decimate(cols:dict,max_points:int,method:str='minmax',time_key:str='timestamp')->dict:
+    """downsamples a window of columns to at most about `max_points` samples"""
+    n = len(cols[time_key])
+    max_points = int(max_points)
+    if max_points < 3 or n <= max_points:
+        return cols
+    if method == 'minmax':
+        return decimate_minmax(cols,max_points,time_key)
+    elif method == 'lttb':
+        return decimate_lttb(cols,max_points,time_key)
+    elif method == 'mean':
+        return decimate_mean(cols,max_points,time_key)
+    raise ValueError(f'bad decimate method {method}! choose: {decimate_methods}')
+
+
+overflow_policies = ('block','drop_oldest','drop_newest','spill')
+
+class sample_feed:
+    """A bounded queue of new samples for one live stream client.
+
+    The processing stage calls `put` for every sample, the client task awaits `get` which drains everything queued since its last send. If a client can't keep up the oldest samples are shed and counted in `dropped` so the sampler is never held up by a slow socket.
+    """
+
+    def __init__(self,fields:list=None,maxlen:int=stream_queue_len):
+        self.fields = list(fields) if fields else None
+        self.queue = deque([],maxlen=max(int(maxlen),1))
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def put(self,row:dict):
+        if isinstance(row,sample_record):
+            row = row.to_dict()
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(row)
+        self.ready.set()
+
+    async def get(self)->list:
+        await self.ready.wait()
+        self.ready.clear()
+        rows = list(self.queue)
+        self.queue.clear()
+        self.sent += len(rows)
+        return rows
+
+    def select(self,rows:list,time_key:str='timestamp',seq_key:str='seq')->list:
+        """applies the client field selection, time and sequence are always kept"""
+        if self.fields is None:
+            return rows
+        keys = [time_key,seq_key]+[k for k in self.fields if k not in (time_key,seq_key)]
+        return [{k:r[k] for k in keys if k in r} for r in rows]
+
+
+class stage_queue:
+    """A bounded FIFO between two pipeline stages with an explicit overflow policy and loss counters.
+
+    When full `block` makes `put` wait for space (only the async put can), `drop_oldest` sheds the head, `drop_newest` refuses the new item and `spill` writes it to a `diskcache.Deque` under `spill_dir` (through `spill_map` if given) which is read back in order once memory drains. Spilled items left from an earlier run are picked up again.
+    """
+
+    def __init__(self,name:str,maxlen:int,policy:str='block',spill_dir:str=None,spill_map=None):
+        assert policy in overflow_policies, f'bad overflow policy {policy}! choose: {overflow_policies}'
+        self.name = name
+        self.maxlen = max(int(maxlen),1)
+        self.policy = policy
+        self.queue = deque()
+        self.spill = None
+        self.spill_map = spill_map
+        if policy == 'spill':
+            self.spill = diskcache.Deque(directory=spill_dir or os.path.join(fdir,'data_cache',f'spill_{name}'))
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.stats = {'enqueued':0,'dequeued':0,'dropped':0,'spilled':0,'blocked':0,'max_depth':0}
+
+    def __len__(self):
+        return len(self.queue) + (len(self.spill) if self.spill is not None else 0)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @property
+    def full(self):
+        return len(self.queue) >= self.maxlen
+
+    def put_nowait(self,item)->bool:
+        """enqueue applying the policy, a full `block` stage refuses (and counts) the item since it can't wait here"""
+        st = self.stats
+        if self.spill is not None and (self.full or len(self.spill)):
+            #once spilling everything new goes to disk to stay in order
+            self.spill.append(self.spill_map(item) if self.spill_map else item)
+            st['spilled'] += 1
+        elif self.full:
+            if self.policy == 'drop_oldest':
+                self.queue.popleft()
+                self.queue.append(item)
+                st['dropped'] += 1
+            else:
+                st['dropped'] += 1
+                return False
+        else:
+            self.queue.append(item)
+        st['enqueued'] += 1
+        st['max_depth'] = max(st['max_depth'],len(self.queue))
+        self._ready.set()
+        return True
+
+    async def put(self,item)->bool:
+        if self.policy == 'block' and self.full:
+            self.stats['blocked'] += 1
+            while self.full:
+                self._space.clear()
+                await self._space.wait()
+        return self.put_nowait(item)
+
+    def _refill(self):
+        while self.spill is not None and len(self.spill) and not self.full:
+            self.queue.append(self.spill.popleft())
+
+    def get_nowait(self):
+        if not self.queue:
+            self._refill()
+        item = self.queue.popleft()
+        self.stats['dequeued'] += 1
+        self._space.set()
+        return item
+
+    async def get(self):
+        while not self:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
+
+    def pop_all(self)->list:
+        """everything queued (memory then spill) in order"""
+        out = []
+        while self:
+            out.append(self.get_nowait())
+        return out
+
+    def status(self)->dict:
+        out = {'policy':self.policy,'depth':len(self.queue),'spill_depth':len(self.spill) if self.spill is not None else 0}
+        out.update(self.stats)
+        return out
+
+
+#firmware side sample store
+sample_cache = sample_store(window * 2 / poll_rate, max_age=window * 2, schema=sample_schema(sample_channels))
+
+
+#Wire Format
+#columns are sent as raw little-endian numpy blocks behind a small json header:
+#   magic(4) | header length (uint32 le) | json header | column blocks
+#numeric columns are packed as <f8, non-numeric columns ride along in the header as json lists
+wire_magic = b'WVC1'
+wire_mime = 'application/x-waveware-columns'
+
+def encode_columns(cols:dict,meta:dict=None)->bytes:
+    """packs a dict of equal length columns into the binary wire format"""
+    header = {'n':0,'meta':meta or {},'columns':[],'objects':{}}
+    blocks = []
+    offset = 0
+    for key,values in cols.items():
+        values = np.asarray(values)
+        header['n'] = len(values)
+        if values.dtype == object or values.dtype.kind in 'USM':
+            header['objects'][key] = values.tolist()
+            continue
+        block = values.astype('<f8').tobytes()
+        header['columns'].append({'name':key,'dtype':'<f8','offset':offset,'nbytes':len(block)})
+        blocks.append(block)
+        offset += len(block)
+
+    hdr = json.dumps(header,default=str).encode()
+    return wire_magic + struct.pack('<I',len(hdr)) + hdr + b''.join(blocks)
+
+def decode_columns(body:bytes):
+    """inverse of `encode_columns`, returns (columns,meta) with numeric columns as zero-copy arrays"""
+    if body[:4] != wire_magic:
+        raise ValueError(f'not a column block: {body[:4]}')
+    (hlen,) = struct.unpack('<I',body[4:8])
+    header = json.loads(body[8:8+hlen])
+    start = 8 + hlen
+    cols = {}
+    for c in header['columns']:
+        a = start + c['offset']
+        cols[c['name']] = np.frombuffer(body,dtype=c['dtype'],count=c['nbytes']//8,offset=a)
+    for key,values in header['objects'].items():
+        arr = np.empty(len(values),dtype=object)
+        for i,v in enumerate(values): #lists must stay elements
+            arr[i] = v
+        cols[key] = arr
+    return cols,header['meta']
@@ -2,9 +2,7 @@
 
 import datetime
 import asyncio
-
-import aiobotocore
-from aiobotocore.session import get_session
+import time
 
 from aiohttp import web
 from dash.dependencies import Input, Output,State
@@ -18,11 +16,12 @@ import logging
 import requests
 import traceback
 import signal
-from concurrent.futures import ProcessPoolExecutor
 
 from waveware.config import *
 from waveware.data import *
 from waveware.hardware import LABEL_DEFAULT
+from waveware.segment_log import read_segment,materialize
+from waveware.streams import resample_methods
 
 #### Dashboard data server
 logging.basicConfig(level=logging.INFO)
@@ -40,7 +39,10 @@ def make_app(hw):
             #the data broker to front end
             web.get("/getdata", hwfi(get_data,hw)), #works
             web.get("/getcurrent", hwfi(get_current,hw)), #works
+            web.get("/stream", hwfi(stream_data,hw)),
             web.get("/run_summary", hwfi(run_summary,hw)), #works
+            web.get("/runs", hwfi(get_runs,hw)),
+            web.get("/runs/events", hwfi(get_run_events,hw)),
             web.post("/save_table_config", hwfi(save_config,hw)), #works
 
             web.post("/log_note", hwfi(add_note,hw)),
@@ -63,10 +65,16 @@ def make_app(hw):
             web.get('/control/get',hwfi(get_control_info,hw)),
             web.get('/control/test_pins',hwfi(test_pins,hw)),
             web.get('/control/status',hwfi(ctrl_status,hw)),
+            web.get('/control/timing',hwfi(ctrl_timing,hw)),
+            web.get('/metrics',hwfi(get_metrics,hw)),
+            web.get('/streams',hwfi(get_streams,hw)),
         ]
     )
     log.info(f'creating web server')
 
+    #run start / stop events go up as they happen, keyed by run & kind since a parameter change stops and starts runs in the same instant
+    hw.event_sink = lambda ev: write_s3(hw,hw.title.replace(' ','-'),ev,'run_event',name=f"{ev['run_id']}_{ev['kind']}")
+
     dash_log = logging.getLogger('aiohttp.access')
     dash_log.setLevel(40)
 
@@ -101,7 +109,7 @@ async def zero_positions(request,hw):
         raise Exception(f'DAQ not on')
 
     output = await hw._zero_task
-    await write_s3_in_pool(hw,hw.title.replace(' ','-'),output,'zero_result')
+    await write_s3(hw,hw.title.replace(' ','-'),output,'zero_result')
     output = json.dumps(output)
     resp = web.Response(text=f'Positions zeroed: {output}')
     return resp
@@ -124,6 +132,52 @@ async def ctrl_status(request,hw):
     out = hw.control_status
     return web.Response(body=json.dumps(out))
 
+async def ctrl_timing(request,hw):
+    """poll_data deadline lateness histogram, `?reset=true` starts a new one"""
+    sched = hw.scheduler
+    out = sched.status()
+    out['buckets'] = sched.hist.buckets()
+    if request.query.get('reset','').lower() == 'true':
+        sched.hist.reset()
+    return web.Response(body=json.dumps(out),content_type='application/json')
+
+async def get_metrics(request,hw):
+    """pipeline counters per stage (enqueued, dropped, spilled, expired before upload...) plus echo dropouts, to tell sensor gaps from overload"""
+    out = hw.pipeline_status
+    out['echo'] = {f'e{i+1}':{'count':f.count,'rejected':f.rejected,'dropout':f.dropout()} for i,(pin,f) in enumerate(hw.echo_filters.items())}
+    out['timing'] = hw.scheduler.status()
+    out['streams'] = hw.streams.status()
+    out['clock'] = hw.clock.status()
+    return web.Response(body=json.dumps(out),content_type='application/json')
+
+async def get_streams(request,hw):
+    """
+    the native rate sensor streams merged into aligned frames
+    :param names: comma separated streams, all by default
+    :param after: start time (perf_counter like sample timestamps), default one window back
+    :param before: end time, default now
+    :param period: frame period, default the poll rate
+    :param method: `hold` (last sample) or `linear`
+    """
+    fmt = wire_format(request)
+    names = request.query.get('names',None)
+    if names:
+        names = [n.strip() for n in names.split(',') if n.strip()]
+    now = time.perf_counter()
+    before = query_number(request,'before',now)
+    after = query_number(request,'after',before-hw.window)
+    period = query_number(request,'period',hw.poll_rate)
+    method = request.query.get('method','hold').strip().lower()
+    if method not in resample_methods:
+        raise web.HTTPBadRequest(text=f'bad resample method {method}! choose: {resample_methods}')
+    if period <= 0 or (before-after)/period > 1E6:
+        raise web.HTTPBadRequest(text=f'bad period {period} for {before-after:.1f}s')
+
+    cols = hw.streams.resample(after,before,period,names,method)
+    if fmt == 'columns':
+        return web.Response(body=encode_columns(cols,{'method':method}),content_type=wire_mime)
+    return web.Response(body=json.dumps(columns_to_rows(cols),default=str),content_type='application/json')
+
 #TODO: check trigger / restart dynamics for these items
 async def turn_daq_on(request,hw):
     '''switch puts data in buffer'''
@@ -139,32 +193,154 @@ async def turn_daq_off(request,hw):
     return web.Response(text="success")
 
 #DATA ACCESS
+def wire_format(request):
+    """`?format=columns` or an Accept of the column mime selects the binary column format, json is the default"""
+    fmt = request.query.get('format',None)
+    if fmt is not None:
+        fmt = fmt.strip().lower()
+        if fmt not in ('json','columns'):
+            raise web.HTTPBadRequest(text=f'unknown format: {fmt}')
+        return fmt
+    if wire_mime in request.headers.get('Accept',''):
+        return 'columns'
+    return 'json'
+
+def query_number(request,key:str,default=None,typ=float,minimum=None):
+    """a numeric query parameter, a bad value is a 400 instead of a server error"""
+    val = request.query.get(key,None)
+    if val is None:
+        return default
+    try:
+        val = typ(val)
+    except (TypeError,ValueError):
+        raise web.HTTPBadRequest(text=f'bad {key}: {val!r} is not {typ.__name__}')
+    if val != val or (minimum is not None and val < minimum):
+        raise web.HTTPBadRequest(text=f'bad {key}: {val}')
+    return val
+
+def columns_response(hw,inx,cols=None,fields=None,**meta):
+    if cols is None:
+        cols = hw.cache.to_columns(inx,fields)
+    if 'param_ver' in cols:
+        meta['params'] = hw.param_meta(cols['param_ver'])
+    body = encode_columns(cols,meta)
+    return web.Response(body=body,content_type=wire_mime,headers=seq_headers(meta))
+
+def seq_headers(meta):
+    return {f'X-{k.replace("_","-").title()}':str(v) for k,v in meta.items() if v is not None and k != 'params'}
+
 async def get_current(request,hw):
-    if hw.last_time and hw.last_time in hw.cache:
-        data = hw.cache[hw.last_time]
+    fmt = wire_format(request)
+    if hw.cache:
+        if fmt == 'columns':
+            return columns_response(hw,[hw.cache.last_index])
+
+        data = hw.cache.latest()
         #if DEBUG: 
         #    log.info(f'current {data}')
         if data:
-            return web.Response(body=json.dumps(data))
+            data = hw.materialize(data)
+            return web.Response(body=json.dumps(data,default=str))
     return web.Response(body='no data!',status=420)
 
 async def get_data(request,hw):
     """
-    returns the cache data in format ts:data
+    returns the cache data in format ts:data, or as column blocks when `format=columns`
+    :param since_seq: a sequence number cursor, returns exactly the samples after it
     :param after: a timestamp, which is used to filter older values
+    :param max_points: decimate the selection to about this many samples
+    :param method: decimation method, one of `decimate_methods` (default minmax)
+    :param fields: comma separated keys to send, all by default
+    the oldest and newest sequence numbers held, and samples lost past the cursor, are reported in `X-First-Seq`,`X-Last-Seq` and `X-Lost` headers (and the column meta)
     """
+    fmt = wire_format(request)
     if hw.cache:
-        after = request.query.get("after",None)
-        if after is not None:
-            after = float(after)
-            subset = {k:v for k,v in hw.cache.items() if k > after}
-            if subset:
-                return web.Response(body=json.dumps(subset))
+        since_seq = query_number(request,'since_seq',typ=int)
+        after = query_number(request,'after')
+        max_points = query_number(request,'max_points',typ=int,minimum=1)
+        method = request.query.get("method",'minmax').strip().lower()
+        fields = request.query.get('fields',None)
+        if fields:
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+        if method not in decimate_methods:
+            raise web.HTTPBadRequest(text=f'bad decimate method {method}! choose: {decimate_methods}')
+
+        meta = {'first_seq':hw.cache.first_seq,'last_seq':hw.cache.last_seq}
+        if since_seq is not None:
+            inx = hw.cache.since(since_seq)
+            meta['lost'] = hw.cache.lost(since_seq)
         else:
-            return web.Response(body=json.dumps(hw.cache)) 
+            inx = hw.cache.range(after)
+
+        if len(inx):
+            if max_points is not None:
+                cols = decimate(hw.cache.to_columns(inx,fields),max_points,method)
+                meta['decimated'] = method
+                if fmt == 'columns':
+                    return columns_response(hw,inx,cols=cols,**meta)
+                return web.Response(body=json.dumps(columns_to_rows(cols),default=str),headers=seq_headers(meta))
+
+            if fmt == 'columns':
+                return columns_response(hw,inx,fields=fields,**meta)
+            if fields:
+                rows = columns_to_rows(hw.cache.to_columns(inx,fields))
+            else:
+                rows = {ts:hw.materialize(row) for ts,row in hw.cache.rows(inx).items()}
+            return web.Response(body=json.dumps(rows,default=str),headers=seq_headers(meta))
 
     return web.Response(body='no data!',status=420)
 
+async def stream_data(request,hw):
+    """
+    websocket pushing new samples as soon as they are processed, each message is the batch queued since the last send
+    :param fields: comma separated keys to send, all by default
+    :param format: json rows `{ts:row}` (default) or binary column blocks
+    :param queue: max samples held for this client before the oldest are shed
+    """
+    fmt = wire_format(request)
+    fields = request.query.get('fields',None)
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    maxlen = query_number(request,'queue',stream_queue_len,typ=int,minimum=1)
+
+    ws = web.WebSocketResponse(heartbeat=10)
+    await ws.prepare(request)
+
+    feed = sample_feed(fields,maxlen=maxlen)
+    hw.feeds.add(feed)
+    log.info(f'stream client connected: {request.remote}| fields: {fields}| N={len(hw.feeds)}')
+
+    async def pump():
+        try:
+            while not ws.closed:
+                rows = feed.select(await feed.get())
+                if not rows:
+                    continue
+                if fmt == 'columns':
+                    cols = rows_to_columns(rows)
+                    meta = {'dropped':feed.dropped,'sent':feed.sent}
+                    if 'param_ver' in cols:
+                        meta['params'] = hw.param_meta(cols['param_ver'])
+                    await ws.send_bytes(encode_columns(cols,meta))
+                else:
+                    if not fields:
+                        rows = [hw.materialize(r) for r in rows]
+                    await ws.send_str(json.dumps({r['timestamp']:r for r in rows},default=str))
+        except Exception as e:
+            log.info(f'stream send error: {e}')
+            await ws.close()
+
+    sender = asyncio.create_task(pump())
+    try:
+        async for msg in ws: #nothing expected from the client, this returns on close
+            pass
+    finally:
+        sender.cancel()
+        hw.feeds.discard(feed)
+        log.info(f'stream client left: {request.remote}| sent: {feed.sent} dropped: {feed.dropped}')
+
+    return ws
+
 #DATA LABELS & LOGGING
 async def save_config(request,hw):
     try:
@@ -181,6 +357,15 @@ async def save_config(request,hw):
 async def run_summary(request,hw):
     return web.Response(body=json.dumps(hw.run_summary))
 
+async def get_runs(request,hw):
+    """index of the runs in the device event log, one row per run id"""
+    return web.Response(body=json.dumps(hw.events.run_index(),default=str),content_type='application/json')
+
+async def get_run_events(request,hw):
+    """run events after the `since` event number"""
+    since = query_number(request,'since',0,typ=int)
+    return web.Response(body=json.dumps(hw.events.since(since),default=str),content_type='application/json')
+
 async def set_control_info(request,hw):
     try:
         #params = {k:float(v.strip()) if k.replace('.','').isalpha() else v for k,v in request.query.copy().items() }
@@ -189,7 +374,7 @@ async def set_control_info(request,hw):
         s_data = {'data':params,'asOf':str(datetime.datetime.now())}
 
         loop = asyncio.get_running_loop()
-        await write_s3_in_pool(hw,hw.title.replace(' ','-'),s_data,'set_input')
+        await write_s3(hw,hw.title.replace(' ','-'),s_data,'set_input')
 
         out = hw.set_parameters(**params)
         if out is True:
@@ -209,7 +394,7 @@ async def set_control_info(request,hw):
 async def write_results(hw):
         results = hw.run_summary
         s_data = {'data':results,'asOf':str(datetime.datetime.now())}
-        await write_s3_in_pool(hw,hw.title.replace(' ','-'),s_data,'session_results')
+        await write_s3(hw,hw.title.replace(' ','-'),s_data,'session_results')
         
 
 async def get_control_info(request,hw):
@@ -221,7 +406,7 @@ async def add_note(request,hw):
     dt = datetime.datetime.now()
     bdy = await request.json()
 
-    await write_s3_in_pool(hw,hw.title.replace(' ','-'),bdy,'test_note')
+    await write_s3(hw,hw.title.replace(' ','-'),bdy,'test_note')
 
     return web.Response(body=f'Added Note: {bdy}')
 
@@ -277,136 +462,124 @@ some_flag = False
 #Data Recording
 async def push_data(hw):
     """Periodically looks for new data to upload 1/3 of window time"""
-    loop = asyncio.get_running_loop()
-    with ProcessPoolExecutor(1) as pool:
-        hw._pool = pool
-        while True:
-            global some_flag
-            if some_flag:
-                pool.shutdown(wait=True)
-                sys.exit()
-            try:
-
-                if hw.active and hw.unprocessed:
-
-                    data_rows = {}
-                    data_set = {
-                        "data": data_rows,
-                        "num": len(hw.unprocessed),
-                        "test": hw.title,
-                    }
-                    #add items from deque
-                    while hw.unprocessed:
-                        row_ts = hw.unprocessed.pop()
-                        if row_ts in hw.cache:
-                            row = hw.cache[row_ts]
-                            if row:
-                                data_rows[row_ts] = row
-
-                    # Finally try writing the data (data rows already set above in data_set)
-                    if data_rows and LOG_TO_S3:
-                        if DEBUG: log.info(f"writing to S3")
-                        
-                        out = await asyncio.gather(
-                            loop.run_in_executor(pool,sync_write_s3,hw.title.replace(' ','-'),data_set )
-                            )
-
-                        if DEBUG: log.info(f"wrote to S3, got: {out}")
-
+    while True:
+        global some_flag
+        if some_flag:
+            await hw.uploader.close()
+            sys.exit()
+        try:
+            if MULTIRATE and hw.active and LOG_TO_S3:
+                await push_streams(hw)
+
+            if hw.wal is not None:
+                await push_segments(hw)
+                await asyncio.sleep(hw.window / 10.0)
+                continue
+
+            if hw.active and hw.unprocessed:
+
+                data_rows = {}
+                data_set = {
+                    "data": data_rows,
+                    "num": len(hw.unprocessed),
+                    "test": hw.title,
+                }
+                #add items from the upload stage, timestamps in the cache or spilled rows
+                stats = hw.unprocessed.stats
+                for item in hw.unprocessed.pop_all():
+                    if isinstance(item,dict):
+                        data_rows[item['timestamp']] = item
+                        continue
+                    row = hw.cache.get(item)
+                    if row:
+                        data_rows[item] = row
                     else:
-                        log.info(f"no data, skpping s3 write")
-                    # Finally Wait Some Time
-                    await asyncio.sleep(hw.window / 10.0)
+                        #left the cache before upload
+                        stats['expired'] += 1
+
+                # Finally try writing the data (data rows already set above in data_set)
+                if data_rows and LOG_TO_S3:
+                    if DEBUG: log.info(f"writing to S3")
+                    test = hw.title.replace(' ','-')
+                    if hw.uploader.columnar:
+                        rows = list(data_rows.values())
+                        params = hw.param_meta([r.get('param_ver',None) for r in rows])
+                        out = await hw.uploader.put_segment(test,rows,params)
+                    else:
+                        for ts,row in data_rows.items():
+                            data_rows[ts] = hw.materialize(row)
+                        out = await hw.uploader.put(test,data_set)
+                    if out:
+                        stats['uploaded'] += len(data_rows)
+                    if DEBUG: log.info(f"wrote to S3, got: {out}")
 
-                elif hw.active:
-                    log.info(f"no data")
-                    await asyncio.sleep(hw.window / 10.0)
                 else:
-                    log.info(f"not active")
-                    await asyncio.sleep(hw.window / 10.0)
-
-            except Exception as e:
-                log.error(str(e), exc_info=1)
+                    log.info(f"no data, skpping s3 write")
+                # Finally Wait Some Time
+                await asyncio.sleep(hw.window / 10.0)
 
-async def write_s3(test,data: dict,title=None):
-    """writes the dictionary to the bucket
-    :param data: a dictionary to write as json
-    :param : default='data', use to log actions ect
-    """
-    from waveware.config import aws_profile,bucket,folder
-
-    if ON_RASPI or folder.upper()=='TEST':
-        up_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        data["upload_time"] = str(up_time)
-        date = up_time.date()
-        time = f"{up_time.hour}-{up_time.minute}-{up_time.second}"
-        
-        #SET THE PATH
-        if title is not None and title:
-            key = f"{folder}/{test}/{date}/{title}_{time}.json"
-        else:
-            #data
-            key = f"{folder}/{test}/{date}/data_{time}.json"
-
-        session = aiobotocore.session.AioSession(profile=aws_profile)
-        async with session.create_client('s3',region_name='us-east-1') as client:
-
-            resp = await client.put_object(
-                Bucket=bucket, Key=key, Body=json.dumps(data)
-            )
-            log.info(f"success writing {key}")
-            log.debug(f"got s3 resp: {resp}")
-            return True
-        
-    else:
-        log.info(f"mock writing s3...: {aws_profile}|{title}|{len(data)}")
+            elif hw.active:
+                log.info(f"no data")
+                await asyncio.sleep(hw.window / 10.0)
+            else:
+                log.info(f"not active")
+                await asyncio.sleep(hw.window / 10.0)
 
-        return True
-    
-async def write_s3_in_pool(hw,test,data,title=None):
-    loop = asyncio.get_running_loop()
-    with ProcessPoolExecutor(1) as pool:
-        out = await asyncio.gather(
-            loop.run_in_executor(pool,sync_write_s3,test,data,title ))
-        if DEBUG: log.info(f"wrote to S3, got: {out}")
-
-
-def sync_write_s3(test,data: dict,title=None):
-    """writes the dictionary to the bucket
-    :param data: a dictionary to write as json
-    :param : default='data', use to log actions ect
-    """
-    import botocore
-    from waveware.config import aws_profile,bucket,folder
-
-    if ON_RASPI or folder.upper()=='TEST':
-        up_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        data["upload_time"] = str(up_time)
-        date = up_time.date()
-        time = f"{up_time.hour}-{up_time.minute}-{up_time.second}"
-        
-        #SET THE PATH
-        if title is not None and title:
-            key = f"{folder}/{test}/{date}/{title}_{time}.json"
+        except Exception as e:
+            log.error(str(e), exc_info=1)
+
+async def push_segments(hw):
+    """uploads closed segment log files oldest first (up to the uploader concurrency at once) as json or columnar segments, each is marked uploaded only once its write succeeds"""
+
+    async def push(seg):
+        rows,params = await asyncio.to_thread(read_segment,seg)
+        name = os.path.basename(seg)[:-len('.wal')]
+        if rows and LOG_TO_S3 and hw.uploader.columnar:
+            if DEBUG: log.info(f"writing {name} to S3")
+            if not await hw.uploader.put_segment(hw.title.replace(' ','-'),rows,params,name):
+                return
+        elif rows and LOG_TO_S3:
+            data_set = {
+                "data": {r['timestamp']:materialize(r,params) for r in rows},
+                "num": len(rows),
+                "test": hw.title,
+                "segment": name,
+            }
+            if DEBUG: log.info(f"writing {name} to S3")
+            if not await hw.uploader.put(hw.title.replace(' ','-'),data_set,'data',name=name):
+                return
+        if rows and LOG_TO_S3:
+            #same upload counters as the cache path
+            hw.unprocessed.stats['uploaded'] += len(rows)
+        hw.wal.mark_uploaded(seg)
+
+    segs = hw.wal.closed()[:hw.uploader.concurrency]
+    if segs:
+        await asyncio.gather(*[push(seg) for seg in segs])
+
+async def push_streams(hw):
+    """uploads what each sensor stream published since the last push, as columns (json) or a stream segment, a stream's cursor only moves once its upload succeeds so a failed one is retried next push"""
+    test = hw.title.replace(' ','-')
+    for name,strm in hw.streams.streams.items():
+        cursor,times,values = hw.streams.peek(name)
+        if not len(times):
+            continue
+        utc = hw.clock.utc(times)
+        if hw.uploader.columnar:
+            rows = [dict(zip(strm.fields,v),timestamp=t,utc=u) for t,u,v in zip(times.tolist(),utc.tolist(),values.tolist())]
+            ok = await hw.uploader.put_segment(test,rows,{},stream=name)
         else:
-            #data
-            key = f"{folder}/{test}/{date}/data_{time}.json"
-
-        session = botocore.session.Session(profile=aws_profile)
-        client = session.create_client('s3',region_name='us-east-1')
-        resp = client.put_object(
-            Bucket=bucket, Key=key, Body=json.dumps(data)
-        )
-        log.info(f"success writing {key}")
-        #log.debug(f"got s3 resp: {resp}")
-        return True
-        
-    else:
-        log.info(f"mock writing s3...: {aws_profile}|{title}|{len(data)}")
-
-        return True
-
-
+            data_set = {'stream':name,'num':len(times),'test':hw.title,'clock':hw.clock.anchor(),
+                        'timestamp':times.tolist(),'utc':utc.tolist(),'data':{f:values[:,j].tolist() for j,f in enumerate(strm.fields)}}
+            ok = await hw.uploader.put(test,data_set,f'stream_{name}')
+        if ok:
+            hw.streams.advance(name,cursor)
+
+async def write_s3(hw,test,data,title=None,name=None):
+    """writes an event record (inputs, notes, zeros...) uncompressed through the shared uploader"""
+    out = await hw.uploader.put(test,data,title,packed=False,name=name)
+    if DEBUG: log.info(f"wrote to S3, got: {out}")
+    return out
 
 
 def print_some_num():
@@ -0,0 +1,343 @@
+"""
+Decoders that turn raw GPIO edges (gpio, level, tick) into measurements
+1. quadrature_decoder: table driven 4x decoding of an A/B encoder with tick timed velocity
+2. echo_decoder: rise/fall pairing of a sonar echo pin into pulse widths
+   echo_filter: ring of recent echoes with a hampel outlier test and dropout timeout
+3. decode_reports: numpy parsing of pigpio notification reports so both decoders can run on whole batches of edges
+"""
+import logging
+import math
+import time
+
+import numpy as np
+
+log = logging.getLogger('decode')
+
+TICK_MASK = 0xFFFFFFFF #pigpio ticks are uint32 microseconds
+
+def tick_diff(t_old:int,t_new:int)->int:
+    """microseconds from t_old to t_new handling the 32 bit wraparound (~72 minutes)"""
+    return (t_new - t_old) & TICK_MASK
+
+
+#QUADRATURE
+#state is (A<<1)|B, the gray sequence 00>01>11>10>00 is forward
+#index by old_state*4 + new_state, ILLEGAL marks both channels changing (a missed edge)
+ILLEGAL = 2
+quad_table = (
+     0,+1,-1, ILLEGAL,
+    -1, 0, ILLEGAL,+1,
+    +1, ILLEGAL, 0,-1,
+     ILLEGAL,-1,+1, 0,
+)
+quad_array = np.array(quad_table,dtype=np.int8)
+
+class quadrature_decoder:
+    """Counts every edge of an A/B quadrature encoder (4 counts per cycle).
+
+    Each count keeps the pigpio tick it happened at, velocity comes from the time between edges over the last `vel_edges` counts. Transitions where both channels changed are counted in `illegal` since a count was missed.
+    """
+
+    def __init__(self,apin:int,bpin:int,sens:float,vel_edges:int=8,timeout:float=0.25):
+        self.apin = apin
+        self.bpin = bpin
+        self.sens = sens #distance per full cycle
+        self.dist = sens / 4. #distance per count
+        self.vel_edges = max(int(vel_edges),1)
+        self.timeout = timeout
+        self.stream = None #sensor_stream of positions at each count
+        self.reset()
+
+    def reset(self,a:int=0,b:int=0):
+        self.state = (a<<1)|b
+        self.count = 0
+        self.illegal = 0
+        self.edges = 0
+        self.tick = None
+        self.v = 0.
+        self.period = None #seconds between the last two counts
+        self.edge_time = None #perf_counter of the last count
+        self._hist = [] #(tick,count) since the last direction change
+        self._dir = 0
+
+    @property
+    def position(self):
+        return self.count * self.dist
+
+    def edge(self,gpio:int,level:int,tick:int):
+        """pigpio callback signature, level 2 (watchdog) is ignored"""
+        if level > 1:
+            return
+        old = self.state
+        if gpio == self.apin:
+            new = (level<<1)|(old&1)
+        else:
+            new = (old&2)|level
+        self.step(new,tick)
+
+    def step(self,new:int,tick:int):
+        """advance to a new AB state seen at tick"""
+        old = self.state
+        self.state = new
+        d = quad_table[(old<<2)|new]
+        if d == 0:
+            return 0
+        if d == ILLEGAL:
+            self.illegal += 1
+            return 0
+
+        self.count += d
+        self.edges += 1
+        self.edge_time = time.perf_counter()
+        self._track(d,tick)
+        if self.stream is not None:
+            self.stream.publish(self.edge_time,(self.position,))
+        return d
+
+    def batch(self,states,ticks)->int:
+        """advance through arrays of AB states and their ticks (from `decode_reports`), counting is vectorized and only the trailing counts feed the velocity history"""
+        if not len(states):
+            return 0
+        states = states.astype(np.int64)
+        prev = np.empty_like(states)
+        prev[0] = self.state
+        prev[1:] = states[:-1]
+        d = quad_array[(prev<<2)|states]
+        self.state = int(states[-1])
+
+        ill = d == ILLEGAL
+        self.illegal += int(ill.sum())
+        moved = (d != 0) & ~ill
+        if not moved.any():
+            return 0
+
+        dm = d[moved].astype(np.int64)
+        tm = ticks[moved]
+        counts = self.count + np.cumsum(dm)
+        n = len(dm)
+        self.edges += n
+        self.edge_time = time.perf_counter()
+        if self.stream is not None:
+            #back dated from now by tick offset to the last count
+            back = ((int(tm[-1]) - tm.astype(np.int64)) & TICK_MASK)*1E-6
+            self.stream.extend(self.edge_time - back,counts*self.dist)
+        for i in range(max(n - self.vel_edges - 1,0),n):
+            self.count = int(counts[i])
+            self._track(int(dm[i]),int(tm[i]))
+        return int(dm.sum())
+
+    def _track(self,d:int,tick:int):
+        """velocity history of one count in direction d at tick, self.count already includes it"""
+        if d != self._dir:
+            self._dir = d
+            self._hist = []
+        elif self.tick is not None:
+            self.period = tick_diff(self.tick,tick)*1E-6
+
+        self.tick = tick
+        hist = self._hist
+        hist.append((tick,self.count))
+        if len(hist) > self.vel_edges + 1:
+            del hist[0]
+        if len(hist) > 1:
+            t0,c0 = hist[0]
+            dt = tick_diff(t0,tick)*1E-6
+            if dt > 0:
+                self.v = (self.count - c0)*self.dist/dt
+        else:
+            self.v = 0.
+
+    def velocity(self,now:float=None)->float:
+        """edge period velocity, once no count arrives within the last period the estimate is bounded by one count over the elapsed time and drops to zero after `timeout`"""
+        if self.edge_time is None:
+            return 0.
+        v = self.v
+        if now is None:
+            now = time.perf_counter()
+        elapsed = now - self.edge_time
+        if elapsed > self.timeout:
+            return 0.
+        if self.period is not None and elapsed > self.period:
+            v = math.copysign(min(abs(v),self.dist/elapsed),v)
+        return v
+
+
+#ECHO
+class echo_decoder:
+    """Pairs rising and falling edges of a sonar echo pin into (tick,width) pulses, a rise that spans a batch boundary is carried over."""
+
+    def __init__(self,pin:int):
+        self.pin = pin
+        self.level = 0
+        self.rise = None
+
+    def edge(self,level:int,tick:int):
+        """one edge, returns the pulse width in us when a pulse completes"""
+        if level > 1:
+            return None
+        self.level = level
+        if level == 1:
+            self.rise = tick
+        elif self.rise is not None:
+            dt = tick_diff(self.rise,tick)
+            self.rise = None
+            return dt
+        return None
+
+    def batch(self,levels,ticks):
+        """pulses completed in arrays of pin levels and ticks, returns (fall ticks,widths us)"""
+        if not len(levels):
+            return ticks[:0],ticks[:0]
+        levels = levels.astype(np.int8)
+        prev = np.empty_like(levels)
+        prev[0] = self.level
+        prev[1:] = levels[:-1]
+        rises = (prev == 0) & (levels == 1)
+        falls = (prev == 1) & (levels == 0)
+        self.level = int(levels[-1])
+
+        inx = np.arange(len(levels))
+        last_rise = np.maximum.accumulate(np.where(rises,inx,-1))
+        fall_inx = inx[falls]
+        rise_inx = last_rise[fall_inx]
+
+        #the first fall may close a rise from the last batch
+        rise_ticks = np.where(rise_inx >= 0,ticks[np.maximum(rise_inx,0)],-1).astype(np.int64)
+        if self.rise is not None:
+            rise_ticks[rise_inx < 0] = self.rise
+        fall_ticks = ticks[fall_inx].astype(np.int64)
+
+        #only the latest rise before each fall pairs with it
+        ok = rise_ticks >= 0
+        if len(fall_inx) > 1:
+            ok[1:] &= rise_inx[1:] > fall_inx[:-1]
+        widths = (fall_ticks[ok] - rise_ticks[ok]) & TICK_MASK
+
+        #carry an open rise
+        if rises.any() and (not falls.any() or inx[rises][-1] > fall_inx[-1]):
+            self.rise = int(ticks[inx[rises][-1]])
+        elif falls.any():
+            self.rise = None
+        return fall_ticks[ok],widths
+
+
+class echo_filter:
+    """Ring of the last `size` echoes (tick,width us,perf time,valid) for one pin.
+
+    Each new width is compared with the median of the `window` echoes before it, it's rejected when it is further than `k` scaled MADs (at least `min_dev` us) away. The filtered width is the latest accepted echo, once none is accepted for `timeout` seconds the channel is flagged as a dropout.
+    """
+
+    def __init__(self,size:int=16,window:int=7,k:float=3.,min_dev:float=20.,timeout:float=0.5):
+        self.size = max(int(size),window+1)
+        self.window = max(int(window),1)
+        self.k = k
+        self.min_dev = min_dev
+        self.timeout = timeout
+        self.ticks = np.zeros(self.size,dtype=np.int64)
+        self.widths = np.zeros(self.size)
+        self.times = np.zeros(self.size)
+        self.valid = np.zeros(self.size,dtype=bool)
+        self.stream = None #sensor_stream of every echo (width us,accepted)
+        self.reset()
+
+    def reset(self):
+        self._i = 0 #next slot
+        self._n = 0
+        self.count = 0 #echoes seen
+        self.rejected = 0
+        self.width = None #latest accepted
+        self.tick = None
+        self.time = None
+
+    def _recent(self,n):
+        n = min(n,self._n)
+        inx = (self._i - n + np.arange(n)) % self.size
+        return self.widths[inx]
+
+    def add(self,tick:int,width:float,now:float=None)->bool:
+        """add one echo, returns if it was accepted"""
+        if now is None:
+            now = time.perf_counter()
+        ok = width > 0
+        hist = self._recent(self.window)
+        if ok and len(hist) >= 3:
+            med = np.median(hist)
+            dev = max(1.4826*np.median(np.abs(hist-med)),self.min_dev)
+            ok = abs(width-med) <= self.k*dev
+
+        i = self._i
+        self.ticks[i] = tick
+        self.widths[i] = width
+        self.times[i] = now
+        self.valid[i] = ok
+        self._i = (i+1) % self.size
+        self._n = min(self._n+1,self.size)
+        self.count += 1
+        if self.stream is not None:
+            self.stream.publish(now,(width,ok))
+        if ok:
+            self.width = width
+            self.tick = tick
+            self.time = now
+        else:
+            self.rejected += 1
+        return ok
+
+    def extend(self,ticks,widths,now:float=None)->int:
+        """add a batch of echoes, perf times are back dated from `now` by their tick offset to the last one"""
+        if not len(widths):
+            return 0
+        if now is None:
+            now = time.perf_counter()
+        last = int(ticks[-1])
+        acc = 0
+        for t,w in zip(ticks,widths):
+            t = int(t)
+            acc += self.add(t,float(w),now - tick_diff(t,last)*1E-6)
+        return acc
+
+    def age(self,now:float=None)->float:
+        """seconds since the last accepted echo"""
+        if self.time is None:
+            return math.inf
+        if now is None:
+            now = time.perf_counter()
+        return now - self.time
+
+    def dropout(self,now:float=None)->bool:
+        return self.age(now) > self.timeout
+
+    def rate(self)->float:
+        """measured rate of accepted echoes in the ring (Hz)"""
+        inx = (self._i - self._n + np.arange(self._n)) % self.size
+        t = self.times[inx][self.valid[inx]]
+        if len(t) < 2 or t[-1] <= t[0]:
+            return 0.
+        return (len(t)-1)/(t[-1]-t[0])
+
+    def median(self)->float:
+        """median of the accepted widths in the ring"""
+        inx = (self._i - self._n + np.arange(self._n)) % self.size
+        ok = self.valid[inx]
+        if not ok.any():
+            return 0.
+        return float(np.median(self.widths[inx][ok]))
+
+
+#NOTIFICATIONS
+#pigpio notification reports: seqno uint16, flags uint16, tick uint32, level uint32
+report_dtype = np.dtype([('seqno','<u2'),('flags','<u2'),('tick','<u4'),('level','<u4')])
+
+def decode_reports(buf:bytes):
+    """parses whole reports from a notification pipe read, returns (ticks,levels,remainder) keeping only level changes (flags 0, no watchdog/keepalive/event)"""
+    n = len(buf)//report_dtype.itemsize
+    rem = buf[n*report_dtype.itemsize:]
+    rep = np.frombuffer(buf,dtype=report_dtype,count=n)
+    rep = rep[rep['flags'] == 0]
+    return rep['tick'].astype(np.int64),rep['level'].astype(np.int64),rem
+
+def level_bit(levels,pin:int):
+    return (levels >> pin) & 1
+
+def quad_states(levels,apin:int,bpin:int):
+    return (level_bit(levels,apin) << 1) | level_bit(levels,bpin)
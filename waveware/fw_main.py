@@ -90,9 +90,17 @@ class program:
             # 1. data poll
             self.poll_task = asyncio.create_task(self.hw.poll_data())
             self.poll_task.add_done_callback(check_failure('poll task'))
-            # 2. process data
-            self.process_task = asyncio.create_task(self.hw.process_data())
-            self.process_task.add_done_callback(check_failure('proc task'))
+            # 2. process data (done inside the poll with a fused pipeline)
+            if not FUSED_PIPELINE:
+                self.process_task = asyncio.create_task(self.hw.process_data())
+                self.process_task.add_done_callback(check_failure('proc task'))
+            # 2b. sync the segment log
+            if self.hw.wal is not None:
+                self.wal_task = asyncio.create_task(self.hw.wal_task())
+                self.wal_task.add_done_callback(check_failure('wal task'))
+            # 2c. tick / perf / utc clock model
+            self.clock_task = asyncio.create_task(self.hw.clock.task(self.hw.pi if ON_RASPI else None,clock_sync))
+            self.clock_task.add_done_callback(check_failure('clock task'))
             # 3. push data
             self.push_task = asyncio.create_task(push_data(self.hw))
             self.push_task.add_done_callback(check_failure('push task'))
@@ -30,7 +30,9 @@ Data Aquired:
 #hlfb - PPR / PWM speed (GPIO)
 
 # DATA STORAGE:
-Store Data in key:value pandas format in queue format
+Store Data in a columnar ring buffer (`sample_store`) after a queue (or directly from the poll with WAVEWARE_FUSED)
+samples are `sample_record`s, the fixed `sample_channels` are list slots written to the store's block in one go
+processed samples are appended to a local segment log (`segment_log`) that the uploader reads, so a crash or slow S3 only delays upload
 all items will have a `timestamp` that is use to orchestrate using `after` search, items are moved from the buffer to the cache after they have been processed, with additional calculations.
 """
 
@@ -39,6 +41,7 @@ import threading
 import struct
 
 from collections import deque
+from types import MappingProxyType
 import signal
 import sys
 
@@ -56,7 +59,18 @@ import random
 import math
 
 from waveware.control import wave_control
+from waveware.control_exec import control_executor
+from waveware.decoders import quadrature_decoder,echo_decoder,echo_filter,decode_reports,quad_states,level_bit
 from waveware.data import *
+from waveware.timing import deadline_scheduler
+from waveware import i2c_bus
+from waveware.i2c_bus import i2c_scheduler
+from waveware.imu import mpu_fifo
+from waveware.imu import imu_fusion as imu_fusion_filter
+from waveware.streams import stream_hub
+from waveware.clock import clock_model
+from waveware.segment_log import segment_log,event_log
+from waveware.uploads import s3_uploader
 from waveware.config import *
 
 
@@ -121,6 +135,17 @@ def fake_wave_damping(z):
     bh = bsub(z)
     return bh * ah * 1000 * 9.81    
 
+def echo_trigger_slots(n:int,pattern:str)->list:
+    """groups of sonar indexes pinged together, each group gets its own listen slot"""
+    if pattern == 'round_robin':
+        return [[i] for i in range(n)]
+    if pattern == 'pairs':
+        #pair sonars from opposite halves so neighbours never ping together
+        half = (n+1)//2
+        return [[i]+([i+half] if i+half < n else []) for i in range(half)]
+    return [list(range(n))]
+
+
 class hardware_control:
     
     #hw access
@@ -149,9 +174,9 @@ class hardware_control:
 
     
     #Data Storage
-    buffer: asyncio.Queue
-    unprocessed: deque
-    cache: ExpiringDict
+    buffer: stage_queue
+    unprocessed: stage_queue
+    cache: sample_store
     active_mpu_cal = False
 
     #TODO: pins_def
@@ -165,16 +190,44 @@ class hardware_control:
         self.labels = self.default_labels.copy()
         
         #data storage
-        self.buffer = asyncio.Queue(winlen)
-        self.unprocessed = deque([], maxlen=winlen)
+        self.buffer = stage_queue('buffer',winlen,buffer_policy)
+        self.scheduler = deadline_scheduler(self.poll_rate)
+        #upload spills keep the row itself, it'll be gone from the cache by the time it's read back
+        self.unprocessed = stage_queue('upload',winlen,upload_policy,spill_map=lambda ts: self.cache.get(ts))
+        self.unprocessed.stats.update(expired=0,uploaded=0)
+        self.uploader = s3_uploader()
+        #parameter & label snapshots by version, samples only carry `param_ver` (the first is frozen once control exists)
+        self.param_version = 0
+        self.param_snapshots = {}
+        #with the segment log processed samples go to disk and the uploader reads from there
+        self.wal = None
+        if WAL_ENABLED:
+            self.wal = segment_log(wal_dir,wal_segment_bytes,wal_segment_age,wal_keep,params_fn=self.param_snapshots.get)
         
         #TODO: move to global
-        self.cache = memcache
+        self.cache = sample_cache
+        self.schema = self.cache.schema
+        self.feeds = set() #live stream clients
 
-        self.i2c_lock = threading.Lock()
+        self.i2c = None #i2c_scheduler, owns the bus on the pi
 
         self.last = {} #last set of signals for GPIO
+        self.echo_filters = {} #pin: echo_filter, history of valid echos
         self.record = {} #for i2c values
+        #tick, perf_counter & utc timebases
+        self.clock = clock_model(clock_window)
+        #native rate streams of each source
+        self.streams = stream_hub()
+        self.imu_fifo = None #mpu_fifo in fifo imu mode
+        imu_hz = imu_fifo_rate if imu_mode == 'fifo' else 1./imu_rate
+        self.streams.add('imu',imu_fields[:9],int(stream_seconds*imu_hz)+1)
+        #orientation & heave at the imu's rate, updated in the imu thread
+        self.fusion = None
+        if imu_fusion != 'none':
+            self.fusion = imu_fusion_filter(imu_fusion,fusion_gain,heave_tau)
+            self.streams.add('fusion',fusion_fields,int(stream_seconds*imu_hz)+1)
+        self.streams.add('temp',['temp'],64,on_change=True)
+        self.streams.add('control',['wave_fb_volt','z_cur','z_err','z_wave','v_cmd','v_cur'],int(stream_seconds*1000))
         self.echo_pins = echo_ch
         self.encoder_pins = encoder_ch
         if enc_conf is None:
@@ -201,16 +254,30 @@ class hardware_control:
         #adc_alert
         self._adc_alert_pin = adc_alert_pin
         self._echo_trig_pin = echo_trig_pin
+        self.echo_trig_pins = list(echo_trig_pins)
 
         if cntl_conf is None: 
             cntl_conf = {} #empty
         
         self.pi = asyncpio.pi()
         self.control = wave_control(self._dir_pin,self._step_pin,self._speedpwm_pin,self._adc_alert_pin,self._hlfb_pin,self._torque_pwm_pin,motor_en_pin,pi=self.pi,**cntl_conf)
+        self.control.streams = self.streams
 
         #Count Up Runs
         self.run_num_id = 0
         self.run_summary = {}
+        #the run samples belong to (utc ms at its start), None outside wave mode
+        self.run_id = None
+        self._run_num = None
+        self._last_run_id = 0
+        self.events = event_log(event_log_path)
+        self.event_sink = None #async fn(event) to upload run events
+        self._proc_ts = None #process_sample running state
+        self._proc_run = None
+        self._proc_avgs = {}
+        self._proc_last = {}
+
+        self.bump_parameters()
 
     #Run / Setup
     async def sig_cb(self,*a,**kw):
@@ -234,7 +301,11 @@ class hardware_control:
             self.imu_ready = False
             self.control.adc_ready = True
 
-        self.control.setup()
+        if CONTROL_THREAD:
+            self.control.executor = control_executor(self.control)
+            loop.run_until_complete(self.control.executor.start())
+        else:
+            self.control.setup()
 
         #Add Exception & Signal Handling
         # g =  lambda loop, context: asyncio.create_task(self.exec_cb(context, loop))
@@ -257,6 +328,8 @@ class hardware_control:
             await self.setup_encoder()
             self.setup_trigger()
             await self.setup_echo_sensors()  
+            if gpio_ingest == 'notify':
+                await self.setup_notify()
 
     def setup_trigger(self):
         log.info(f'eval trigger')
@@ -270,12 +343,19 @@ class hardware_control:
     def setup_i2c(self):
         log.info(f'setup i2c')
         self.smbus = smbus.SMBus(1)
+        #every transaction goes through the scheduler's thread, feedback ahead of imu ahead of temp
+        self.i2c = i2c_scheduler(self.smbus,i2c_bus.SMBus2(1) if i2c_bus.SMBus2 is not None else None)
+        self.i2c.start()
+        self.imu_bus = self.i2c.device('imu',i2c_bus.IMU)
+        self.temp_bus = self.i2c.device('temp',i2c_bus.TEMP)
 
         #MPU
         self.mpu_cal_file = f"{fdir}/mpu_calib.json"
         try:
             log.info(f'setup mpu9250')
             self.imu = MPU9250.MPU9250(self.smbus, self.mpu_addr)
+            #the driver's Bus setter only takes a real SMBus, swap in the scheduled handle after
+            self.imu._Bus = self.imu_bus
             log.info(f'mpu9250 begin')
             self.imu.begin()
             log.info(f'mpu9250 config')
@@ -285,20 +365,23 @@ class hardware_control:
             if os.path.exists(self.mpu_cal_file):
                 log.info(f'loading calibration file!: {self.mpu_cal_file}')
                 self.imu.loadCalibDataFromFile(self.mpu_cal_file)  
+            if imu_mode == 'fifo':
+                self.imu_fifo = mpu_fifo(self.imu,self.imu_bus,imu_fifo_rate,self.mpu_addr)
+                self.imu_fifo.setup()
             self.imu_ready = True
         except Exception as e:
             log.error('issue setting up imu',exc_info=e)
             self.imu_ready = False
             
         try:
-            self.control.setup_i2c(smb=self.smbus,lock=self.i2c_lock)
+            self.control.setup_i2c(bus=self.i2c)
             self.adc_ready = True
         except Exception as e:
             log.error('issue setting up control i2c',exc_info=e)
             self.adc_ready = False
 
         try:
-            self.smbus.read_i2c_block_data(0x40, 0xE3,2)
+            self.temp_bus.read_byte_data(0x40, 0xE7) #user register, answers without a conversion
             self.temp_ready = True
         except Exception as e:
             log.error('issue setting up temp',exc_info=e)
@@ -352,6 +435,8 @@ class hardware_control:
                 for cbf in self._cb_fall:
                     await cbf.cancel()
 
+                await self.stop_notify()
+
                 log.info(f'stopping echos')
                 if hasattr(self,'imu_read_task'):
                     self.imu_read_task.cancel() 
@@ -362,18 +447,28 @@ class hardware_control:
         except Exception as e:
             log.error(e)
             
-        await self.control._stop()
+        if self.control.executor is not None:
+            await self.control.executor.stop()
+        else:
+            await self.control._stop()
+        if self.i2c is not None:
+            await asyncio.to_thread(self.i2c.stop)
+
+        if self.wal is not None:
+            self.wal.close()
+        if self.run_id is not None:
+            self.run_event('stop',time.perf_counter(),'shutdown')
+        self.events.close()
 
-        if hasattr(self,'_pool'):
-            print(f'killing process pool!')
-            self._pool.shutdown(wait=True)
+        await self.uploader.close()
 
     #MPU:
     #Interactive MPU Cal 
     def imu_calibrate(self):
-        self.imu.caliberateAccelerometer()
-        self.imu.caliberateGyro()
-        self.imu.caliberateMagPrecise()
+        with self.i2c.lowered(i2c_bus.CAL):
+            self.imu.caliberateAccelerometer()
+            self.imu.caliberateGyro()
+            self.imu.caliberateMagPrecise()
         self.imu.saveCalibDataToFile(self.mpu_cal_file)
 
     async def mpu_calibration_process(self):
@@ -419,18 +514,17 @@ class hardware_control:
         log.info(f'starting imu task')
         while ON_RASPI:
             try:
-                await asyncio.to_thread(self._read_imu)
-                await asyncio.sleep(self.poll_rate)
+                await asyncio.to_thread(self._read_imu if self.imu_fifo is None else self._read_imu_fifo)
+                await asyncio.sleep(imu_rate)
             except Exception as e:
                 log.info(f'imu error: {e}')
 
     def _read_imu(self):
-        """blocking call use in thread"""
+        """blocking call use in thread, each register read of the imu is queued on the i2c scheduler"""
         
-        with self.i2c_lock:
-            ts = time.perf_counter()
-            self.imu.readSensor()
-            #self.imu.computeOrientation()
+        ts = time.perf_counter()
+        self.imu.readSensor()
+        #self.imu.computeOrientation()
         
         imu = self.imu
         ax,ay,az = imu.AccelVals[0], imu.AccelVals[1], imu.AccelVals[2]
@@ -438,29 +532,66 @@ class hardware_control:
         mx,my,mz = imu.MagVals[0], imu.MagVals[1], imu.MagVals[2]
         dct = dict(ax=ax,ay=ay,az=az,gx=gx,gy=gy,gz=gz,mx=mx,my=my,mz=mz,imutime=ts)
         self.record.update(dct)
+        self.streams.publish('imu',ts,(ax,ay,az,gx,gy,gz,mx,my,mz))
+        self._fuse(np.array([ts]),np.array([imu.AccelVals]),np.array([imu.GyroVals]))
+
+    def _read_imu_fifo(self):
+        """blocking call use in thread, drains the fifo into the imu stream as one batch, the magnetometer is read once per drain and held across it"""
+        times,accel,gyro = self.imu_fifo.read()
+        if not len(times):
+            return
+        mag = self.imu_fifo.read_mag()
+        vals = np.hstack((accel,gyro,np.tile(mag,(len(times),1))))
+        self.streams['imu'].extend(times,vals)
+        self.record.update(dict(zip(imu_fields[:9],vals[-1].tolist())),imutime=float(times[-1]))
+        self._fuse(times,accel,gyro)
+
+    def _fuse(self,times,accel,gyro):
+        """orientation & heave of an imu batch into the fusion stream, the newest into the record"""
+        if self.fusion is None:
+            return
+        out = self.fusion.update(times,accel,gyro)
+        self.streams['fusion'].extend(times,out)
+        self.record.update(zip(fusion_fields,out[-1].tolist()))
 
     #TEMP Sensors
     async def temp_task(self):
         log.info(f'starting temp task')
         while ON_RASPI:
             try:
-                await asyncio.to_thread(self._read_temp)
+                await self._read_temp()
                 await asyncio.sleep(self.poll_temp)
             except Exception as e:
                 log.info(f'temp error: {e}')
 
-    def _read_temp(self) -> None:
+    async def _read_temp(self) -> None:
         log.info(f'read temp')
         #signal to read
         try:
-            with self.i2c_lock:
-                temp = self.smbus.read_i2c_block_data(0x40, 0xE3,2)
-            #what really happens here is that master sends a 0xE3 command (measure temperature, hold master mode) and read 2 bytes back
-            time.sleep(0.1)
+            if self.i2c.raw is not None:
+                #0xF3 measures temperature in no hold master mode, the bus is free during the conversion (<11ms) instead of clock stretched by the sensor like 0xE3
+                await self.temp_bus.call('write_byte',0x40, 0xF3)
+                await asyncio.sleep(0.012)
+                for attempt in range(5):
+                    try:
+                        #msb, lsb & checksum in one read
+                        temp = await self.temp_bus.read(0x40,3)
+                        break
+                    except OSError:
+                        #NACKed while still converting
+                        await asyncio.sleep(0.005)
+                else:
+                    raise TimeoutError('si7021 conversion not ready')
+            else:
+                #python-smbus has no plain multi byte read, hold master mode keeps it to one transaction
+                temp = await self.temp_bus.call('read_i2c_block_data',0x40, 0xE3,3)
+            if i2c_bus.crc8(temp[:2]) != temp[2]:
+                raise ValueError(f'si7021 checksum mismatch: {temp}')
 
             # Convert the data
-            cTemp = ((temp[0] * 256 + temp[1]) * 175.72 / 65536.0) - 46.85
+            cTemp = (((temp[0] << 8 | temp[1]) & 0xFFFC) * 175.72 / 65536.0) - 46.85
             self.record['temp'] = cTemp
+            self.streams.publish('temp',time.perf_counter(),(cTemp,))
             if cTemp > -50 and cTemp < 60:
                 #no phoney baloney
                 self.speed_of_sound = 20.05 * (273.16 + cTemp)**0.5
@@ -472,9 +603,9 @@ class hardware_control:
 
     #Encoders
     async def setup_encoder(self):
-        enccb = {}
         self.cbA = []
         self.cbB = []
+        self.encoders = []
         for i,(apin,bpin) in enumerate(self.encoder_pins):
             log.info(f'setting up encoder {i} on A:{apin} B:{bpin}')
             await self.pi.set_mode(apin, pigpio.INPUT)
@@ -485,37 +616,17 @@ class hardware_control:
 
             ee = pigpio.EITHER_EDGE
 
-            self.last[apin] = 0
-            self.last[bpin] = 0
-            enccb[i] = self._make_pulse_func(apin,bpin,i)
-            self.cbA.append(await self.pi.callback(apin, ee , enccb[i]))
-            self.cbB.append(await self.pi.callback(bpin, ee , enccb[i]))
-
-    def _make_pulse_func(self,apin,bpin,inx):
-        """function to scope lambda"""
-        enc_inx = f'enc_{inx}_last_pin'
-        cbinx = f'pos_enc_{inx}'
-        self.last[cbinx] = 0 #initalizes
-        self.last[enc_inx] = 0 #
-        sens = self.encoder_conf[inx]['sens']
-        def cb(step):
-            nxt = self.last[cbinx] + step*sens
-            self.last[cbinx] = nxt
-        f = lambda *args: self._pulse(*args,apin=apin,bpin=bpin,enc_inx=enc_inx,cb=cb)
-        return f
-        
-    def _pulse(self, gpio, level, tick,apin,bpin,enc_inx,cb):
-        self.last[gpio] = level
-
-        if gpio != self.last[enc_inx]: # debounce
-            self.last[enc_inx] = gpio
-            if gpio == apin and level == 1:
-                if self.last[bpin] == 1:
-                    cb(1) #forward step
-                    
-            elif gpio == bpin and level == 1:
-                if self.last[apin] == 1:
-                    cb(-1) #reverse step
+            #start from the current AB state so the first edge decodes
+            a = await self.pi.read(apin)
+            b = await self.pi.read(bpin)
+            dec = quadrature_decoder(apin,bpin,self.encoder_conf[i]['sens'])
+            dec.reset(a,b)
+            dec.stream = self.streams.add(f'enc{i+1}',[f'z{i+1}'],32768)
+            self.encoders.append(dec)
+
+            if gpio_ingest == 'callback':
+                self.cbA.append(await self.pi.callback(apin, ee , dec.edge))
+                self.cbB.append(await self.pi.callback(bpin, ee , dec.edge))
 
     #SONAR:
     async def setup_echo_sensors(self):
@@ -526,30 +637,118 @@ class hardware_control:
 
         self._cb_rise = []
         self._cb_fall = []
+        self.echo_decoders = {}
+        self.echo_filters = {}
         for i,echo_pin in enumerate(self.echo_pins):
             log.info(f'starting ecno sensors {i+1} on pin {echo_pin}')
 
-            self.last[echo_pin] = {'dt':0,'rise':None}
+            self.last[echo_pin] = {'dt':0,'n_out':0}
+            self.echo_decoders[echo_pin] = echo_decoder(echo_pin)
+            self.echo_filters[echo_pin] = filt = echo_filter(echo_ring,echo_window,echo_hampel_k,timeout=echo_timeout)
+            filt.stream = self.streams.add(f'echo{i+1}',[f'e{i+1}_us',f'e{i+1}_ok'],int(stream_seconds*100))
 
             await  self.pi.set_mode(echo_pin, asyncpio.INPUT)
 
-            self._cb_rise.append(await self.pi.callback(echo_pin, asyncpio.RISING_EDGE, self._rise))
-            self._cb_fall.append(await self.pi.callback(echo_pin, asyncpio.FALLING_EDGE, self._fall))
-
-    async def trigger_task(self,rate=0.25):
-        #TODO: set a repeating waveform on trigger pin 20us on
-        delay = int(rate*1E6)
-        pulse_us = 50
-        doff = delay-pulse_us
-        trigger_100ms = [asyncpio.pulse(1<<self._echo_trig_pin,0,pulse_us),
-                     asyncpio.pulse(0,1<<self._echo_trig_pin,doff)]
-        log.info(f'running trigger on pin: {self._echo_trig_pin} | {pulse_us}us@1 > {doff}us@0')
-        await self.pi.set_mode(self._echo_trig_pin, pigpio.OUTPUT)
+            if gpio_ingest == 'callback':
+                self._cb_rise.append(await self.pi.callback(echo_pin, asyncpio.RISING_EDGE, self._rise))
+                self._cb_fall.append(await self.pi.callback(echo_pin, asyncpio.FALLING_EDGE, self._fall))
+
+    #BATCHED GPIO
+    async def setup_notify(self):
+        """opens one pigpio notification pipe for every encoder & echo pin, level change reports are read in bulk and decoded with numpy"""
+        if getattr(self,'notify_handle',None) is not None:
+            return
+
+        bits = 0
+        for apin,bpin in self.encoder_pins:
+            bits |= (1<<apin)|(1<<bpin)
+        for echo_pin in self.echo_pins:
+            bits |= 1<<echo_pin
+
+        #seed decoders with current levels
+        levels = await self.pi.read_bank_1()
+        for dec in self.encoders:
+            dec.reset((levels>>dec.apin)&1,(levels>>dec.bpin)&1)
+        for dec in self.echo_decoders.values():
+            dec.level = (levels>>dec.pin)&1
+
+        self.notify_handle = h = await self.pi.notify_open()
+        self._notify_fd = os.open(f'/dev/pigpio{h}',os.O_RDONLY|os.O_NONBLOCK)
+        self._notify_rem = b''
+        self.notify_stats = {'reads':0,'reports':0}
+        await self.pi.notify_begin(h,bits)
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self._notify_fd,self._read_notify)
+        log.info(f'notify ingest on handle {h} bits: {bits:#010x}')
+
+    def _read_notify(self):
+        """reader callback, drains the pipe and decodes the reports as one batch"""
+        chunks = [self._notify_rem]
+        while True:
+            try:
+                data = os.read(self._notify_fd,65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+
+        ticks,levels,self._notify_rem = decode_reports(b''.join(chunks))
+        self.notify_stats['reads'] += 1
+        self.notify_stats['reports'] += len(ticks)
+        if not len(ticks):
+            return
+
+        for dec in self.encoders:
+            dec.batch(quad_states(levels,dec.apin,dec.bpin),ticks)
+
+        for echo_pin,dec in self.echo_decoders.items():
+            fall_ticks,widths = dec.batch(level_bit(levels,echo_pin),ticks)
+            if len(widths):
+                self.echo_filters[echo_pin].extend(fall_ticks,widths)
+                self._echo_pulse(echo_pin,int(fall_ticks[-1]),int(widths[-1]))
+
+    async def stop_notify(self):
+        h = getattr(self,'notify_handle',None)
+        if h is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._notify_fd)
+        await self.pi.notify_close(h)
+        os.close(self._notify_fd)
+        self.notify_handle = None
+
+    def echo_trigger_wave(self,pulse_us:int=50)->list:
+        """one frame of staggered trigger pulses, each slot pulses its sonars' trigger pins then listens for `echo_listen`"""
+        pattern = echo_pattern
+        if pattern != 'all' and len(set(self.echo_trig_pins)) == 1:
+            log.warning(f'echo pattern {pattern} needs separate trigger pins, using all')
+            pattern = 'all'
+
+        slots = echo_trigger_slots(len(self.echo_pins),pattern)
+        listen_us = max(int(echo_listen*1E6),pulse_us*2)
+        pulses = []
+        for grp in slots:
+            mask = 0
+            for i in grp:
+                mask |= 1<<self.echo_trig_pins[i]
+            pulses.append(asyncpio.pulse(mask,0,pulse_us))
+            pulses.append(asyncpio.pulse(0,mask,listen_us-pulse_us))
+
+        self.echo_slots = slots
+        self.echo_frame = len(slots)*listen_us*1E-6
+        return pulses
+
+    async def trigger_task(self):
+        trigger_frame = self.echo_trigger_wave()
+        log.info(f'running trigger on pins: {self.echo_trig_pins} | slots: {self.echo_slots} @ {self.echo_frame:.3f}s')
+        for pin in set(self.echo_trig_pins):
+            await self.pi.set_mode(pin, pigpio.OUTPUT)
 
         while True:
             log.info(f'starting trigger task')
             try:        
-                await self.pi.wave_add_generic(trigger_100ms)
+                await self.pi.wave_add_generic(trigger_frame)
                 self.trigger_wave = await self.pi.wave_create()
                 await self.pi.wave_send_repeat(self.trigger_wave)
 
@@ -561,30 +760,62 @@ class hardware_control:
             
             await asyncio.sleep(1)
 
+    @property
+    def echo_status(self)->dict:
+        """trigger pattern, nominal ping rate and measured rate of valid echoes per gauge"""
+        frame = getattr(self,'echo_frame',None)
+        out = {'echo_pattern':echo_pattern,'echo_rate_cmd':round(1/frame,2) if frame else None}
+        out['echo_rate'] = {f'e{i+1}':round(self.echo_filters[pin].rate(),2) for i,pin in enumerate(self.echo_pins) if pin in self.echo_filters}
+        return out
+
 
 
     def _rise(self, gpio, level, tick):
-        self.last[gpio]['rise'] = tick
+        self.echo_decoders[gpio].edge(level,tick)
 
     def _fall(self, gpio, level, tick):
-        if self.last[gpio]['rise'] is not None:
-            dt = tick -  self.last[gpio]['rise']
-            if dt < 0:
-                dt = 4294967295 + dt #wrap around
-            self.last[gpio]['dt'] = dt
-            self.last[gpio]['dt_tick'] = tick
+        dt = self.echo_decoders[gpio].edge(level,tick)
+        if dt is not None:
+            self.echo_filters[gpio].add(tick,dt)
+            self._echo_pulse(gpio,tick,dt)
+
+    def _echo_pulse(self,gpio,tick,dt):
+        """a completed (raw) echo of dt us ending at tick"""
+        self.last[gpio]['dt'] = dt
+        self.last[gpio]['dt_tick'] = tick
 
     def read(self,gpio:int):
         """
-        get the current reading
+        get the current filtered reading
         round trip cms = round trip time / 1000000.0 * 34030
         """
         
-        dobj = self.last.get(gpio,None)
-        if dobj is not None:
-            return dobj['dt'] * self.sound_conv
+        filt = self.echo_filters.get(gpio,None)
+        if filt is not None and filt.width is not None:
+            return filt.width * self.sound_conv
         return 0
 
+    def read_echo(self,gpio:int,now:float=None)->dict:
+        """filtered distance, echoes since the last call, age of the last valid echo and dropout flag"""
+        filt = self.echo_filters[gpio]
+        last = self.last[gpio]
+        n = filt.count - last['n_out']
+        last['n_out'] = filt.count
+        return {'v':self.read(gpio),'n':n,'age':filt.age(now),'drop':filt.dropout(now),'tick':filt.tick}
+
+    @property
+    def pipeline_status(self)->dict:
+        """counters of each stage, poll (missed deadline slots) > buffer > cache > upload, and the live stream feeds"""
+        out = {'poll':{'missed':self.scheduler.missed,'slot':self.scheduler.slot}}
+        out['buffer'] = self.buffer.status()
+        out['upload'] = self.unprocessed.status()
+        if self.wal is not None:
+            out['wal'] = self.wal.status()
+        out['s3'] = self.uploader.status()
+        out['cache'] = {'capacity':self.cache.capacity,'depth':len(self.cache),'last_seq':self.cache.last_seq}
+        out['stream'] = {'clients':len(self.feeds),'sent':sum(f.sent for f in self.feeds),'dropped':sum(f.dropped for f in self.feeds)}
+        return out
+
     @property
     def control_status(self)->dict:
         basic = {
@@ -600,7 +831,18 @@ class hardware_control:
            #'maybe_stuck':self.control.maybe_stuck,
            'fail_speed':self.control.fail_sc,
            'fail_step':self.control.fail_st,
+           'pipeline': self.pipeline_status,
            }
+        if ON_RASPI:
+            basic.update(self.echo_status)
+            if getattr(self.control,'adc',None) is not None:
+                basic['adc_alert'] = dict(self.control.adc.stats,queued=self.control.adc.queue.qsize())
+            if self.i2c is not None:
+                basic['i2c'] = self.i2c.status()
+            if self.imu_fifo is not None:
+                basic['imu_fifo'] = self.imu_fifo.status()
+        if self.control.executor is not None:
+            basic['control_exec'] = self.control.executor.status()
            
         
         if DEBUG and hasattr(self.control,'speed_pwm_task'):
@@ -729,9 +971,72 @@ class hardware_control:
 
         #match raw update
         self.labels.update(kw)
+        self.bump_parameters()
 
         return True
 
+    #Runs
+    def track_run(self,ts:float)->int:
+        """starts a run on entering wave mode or a control change in it (`run_num_id` moved) and stops it on leaving, returns the current run id"""
+        wave = self.control.drive_mode == 'wave'
+        if self.run_id is not None and (not wave or self._run_num != self.run_num_id):
+            self.run_event('stop',ts,'mode' if not wave else 'params')
+            self.run_id = None
+        if wave and self.run_id is None:
+            utc = self.clock.utc(ts)
+            self.run_id = self._last_run_id = max(int(utc*1000),self._last_run_id+1)
+            self._run_num = self.run_num_id
+            self.run_event('start',ts)
+        return self.run_id
+
+    def run_event(self,kind:str,ts:float,reason:str=None)->dict:
+        """writes a run start / stop to the event log and hands it to `event_sink`"""
+        event = {'kind':kind,'run_id':self.run_id,'run_num':self.run_num_id,'title':self.title,
+                 'utc':self.clock.utc(ts),'perf':ts,'seq':self.cache.last_seq,'param_ver':self.param_version}
+        if kind == 'start':
+            event['params'] = dict(self.param_snapshot)
+        if reason:
+            event['reason'] = reason
+        self.events.append(event)
+        log.info(f'run {kind}: {self.run_id} #{self.run_num_id} {reason or ""}')
+        if self.event_sink is not None:
+            task = asyncio.get_event_loop().create_task(self.event_sink(dict(event)))
+            task.add_done_callback(check_failure('run event'))
+        return event
+
+    def bump_parameters(self):
+        """freeze the current labels & parameters as a new version"""
+        snap = dict(self.labels)
+        snap.update(self.parameters())
+        self.param_version += 1
+        self.param_snapshots[self.param_version] = MappingProxyType(snap)
+        log.info(f'parameters v{self.param_version}')
+        return self.param_version
+
+    @property
+    def param_snapshot(self):
+        return self.param_snapshots[self.param_version]
+
+    def materialize(self,row:dict)->dict:
+        """a sample row with its parameter snapshot filled in, sample values take precedence"""
+        snap = self.param_snapshots.get(row.get('param_ver',None),None)
+        if not snap:
+            return row
+        out = dict(snap)
+        out.update(row)
+        return out
+
+    def param_meta(self,versions)->dict:
+        """{version:snapshot} for the versions referenced by a block of samples"""
+        out = {}
+        for v in set(versions):
+            if v is None or v != v:
+                continue
+            v = int(v)
+            if v in self.param_snapshots:
+                out[v] = dict(self.param_snapshots[v])
+        return out
+
     def parameters(self):
         out = {'mode':self.control.drive_mode,'title':self.title}
         
@@ -764,23 +1069,34 @@ class hardware_control:
         return out
 
     def output_data(self,add_bias=True):
-        out = {'timestamp':time.perf_counter()}
+        out = self.schema.record() if self.schema is not None else {}
+        out['timestamp'] = time.perf_counter()
         if ON_RASPI:
-            out.update(self.record) #these are latest from I2C
+            if not MULTIRATE:
+                out.update(self.record) #these are latest from I2C, multirate uploads them as streams
 
             #Add in GPIO Signals
+            tnow = time.perf_counter()
             for i,echo_pin in enumerate(self.echo_pins):
-                if echo_pin in self.last:
-                    out[f'e{i+1}'] = self.read(echo_pin)
+                if echo_pin in self.echo_filters:
+                    echo = self.read_echo(echo_pin,tnow)
+                    out[f'e{i+1}'] = echo['v']
+                    out[f'e{i+1}_n'] = echo['n']
+                    out[f'e{i+1}_age'] = min(echo['age'],999.)
+                    out[f'e{i+1}_drop'] = echo['drop']
                     if i == 0:
-                        out[f'e_ts'] = self.last[echo_pin].get('dt_tick',None)    
+                        out[f'e_ts'] = echo['tick']
+                        out['e_time'] = self.clock.perf_from_tick(echo['tick'])
                 else:
                     out[f'e{i+1}'] = 0
                     if i == 0:
                         out[f'e_ts'] = 0
 
-            for i,(enc_a,enc_b) in enumerate(self.encoder_pins):
-                out[f'z{i+1}'] = self.last.get(f'pos_enc_{i}',0)
+
+            for i,dec in enumerate(getattr(self,'encoders',[])):
+                out[f'z{i+1}'] = dec.position
+                out[f'v_enc{i+1}'] = dec.velocity(tnow)
+                out[f'enc_miss{i+1}'] = dec.illegal
 
         else:
             #FAKENESS
@@ -824,22 +1140,25 @@ class hardware_control:
                 mock_sensors[var] = random.random()
             
             out[f'e_ts'] = tnow - 0.05*random.random()
+            for i in range(len(self.echo_pins)):
+                out.update({f'e{i+1}_n':1,f'e{i+1}_age':0.05*random.random(),f'e{i+1}_drop':False})
             out.update(mock_sensors)
 
 
-        #Add control info
-        out['z_wave'] = self.control.z_wave + self.control.z_center
-        out['z_err'] = self.control.z_err
-        out['z_cur'] = self.control.z_cur + self.control.z_center
-        out['v_cmd'] = self.control.v_command
-        out['v_cur'] = self.control.v_cur
-        out['v_wave'] = self.control.v_wave
-
-        out['wave_fb_volt'] = self.control.feedback_volts
-        out['wave_fb_pct'] = self.control.feedback_pct
-        out['coef_2'] = self.control.coef_2
-        out['coef_10'] = self.control.coef_10
-        out['coef_100'] = self.control.coef_100
+        #Add control info, one consistent snapshot
+        cs = self.control.snapshot()
+        out['z_wave'] = cs['z_wave'] + cs['z_center']
+        out['z_err'] = cs['z_err']
+        out['z_cur'] = cs['z_cur'] + cs['z_center']
+        out['v_cmd'] = cs['v_command']
+        out['v_cur'] = cs['v_cur']
+        out['v_wave'] = cs['v_wave']
+
+        out['wave_fb_volt'] = cs['feedback_volts']
+        out['wave_fb_pct'] = cs['feedback_pct']
+        out['coef_2'] = cs['coef_2']
+        out['coef_10'] = cs['coef_10']
+        out['coef_100'] = cs['coef_100']
         
         # out['stuck'] = self.control.stuck
         # out['maybe_stuck'] = self.control.maybe_stuck
@@ -865,8 +1184,13 @@ class hardware_control:
                 if k in out:
                     out[k] = out[k] - bs                    
 
-        #Add labels
-        out.update(self.parameters())
+        #anchored wall time of the sample, exact across sensors & uploads
+        out['utc'] = self.clock.utc(out['timestamp'])
+
+        #labels & parameters by reference, mode changes outside set_parameters
+        out['mode'] = self.control.drive_mode
+        out['param_ver'] = self.param_version
+        out['run_id'] = self.run_id
 
         return out 
 
@@ -890,100 +1214,110 @@ class hardware_control:
 
     async def process_data(self):
         """a simple function to provide efficient calculation of variables out of a queue before writing to S3"""
-        run_id = None
-        ts = None
         while True:
             try:
-                # #swap refs with namespace fancyness
-                # last = locals().get('new',None)
-
                 new = await self.buffer.get()
-                
-                #no replace data
-                good_lab ={k:v for k,v in self.labels.items() if k not in new}
-
-                #TODO: filter height values
-                #TODO: write ampitude averageing
-                #TODO: write zero cross period determination
-                #TODO: update current run with averaged
-                tlast = ts
-                ts = new["timestamp"]
-                self.start_time
-                if tlast is not None and self.control.drive_mode == 'wave':
-                    dt = ts - tlast
-                    #check data
-                    last_run = run_id
-                    run_id = self.run_num_id
-                    if last_run != run_id:
-                        avgs = {}
-                        last = {}
-
-                    ctl_st = self.control.start
-                    Tgap_st = self.control.wave.full_wave_time
-
-                    t_elps = (ts - ctl_st) - Tgap_st
-                    lp_a = (t_elps-dt)/t_elps
-                    lp_b = dt/t_elps
-                    Hps = self.control.wave.hs
-                    Tps = self.control.wave.ts
-                    
-                    if t_elps >= 0:
-
-                        for kv in ['z','e']:
-                            for num in range(1,5):
-                                prm = f'{kv}{num}'
-                                if prm in new:
-                                    
-                                    av = avgs[f'{prm}_lp'] = avgs.get(f'{prm}_lp',0)*0.1 + new[prm]*0.9
-                                    
-                                    avgs[f'{prm}_hs'] = avgs.get(f'{prm}_hs',Hps)*lp_a + abs(avgs[f'{prm}_lp']*lp_b*3.14159/2)
-
-                                    #zero cross
-                                    if prm in last:
-                                        lsav = last[prm]
-                                        if (av * lsav) < 0 and av > 0: #up crossing
-                                            if f'{prm}_ts' in last:
-                                                tlast = last[f'{prm}_ts']
-                                                zc_time = (ts - tlast)*2
-                                                if zc_time > 0.05:
-                                                    avgs[f'{prm}_ts'] = avgs.get(f'{prm}_ts',Tps)*lp_a + zc_time *lp_b
-                                            last[f'{prm}_ts'] = ts
-                                    last[prm] = av
-                        
-                        
-                        self.run_summary[run_id] = avgs.copy()
-                        self.run_summary[run_id].update({'run_id':run_id,'title':self.title,'Hs':Hps,'Ts':Tps,'t_measure':t_elps})
-                        self.run_summary[run_id].update(**good_lab)
-
-                    new.update(**avgs)
-                    
-                new.update(**good_lab)
+                self.process_sample(new)
+            except Exception as e:
+                log.error(str(e), exc_info=1)
 
-                self.last_time = ts
-                #This saves the data #TODO: sort out disk/exp memory data
-                self.cache[ts] = new
-                # if cache:
-                #     cache[ts] = new
-                self.unprocessed.append(ts) 
+    def process_sample(self,new):
+        """run averages for a new sample, then store it and hand it to the stream feeds"""
+        #TODO: filter height values
+        #TODO: write ampitude averageing
+        #TODO: write zero cross period determination
+        #TODO: update current run with averaged
+        tlast = self._proc_ts
+        ts = self._proc_ts = new["timestamp"]
+        if tlast is not None and self.control.drive_mode == 'wave':
+            dt = ts - tlast
+            #check data
+            last_run = self._proc_run
+            run_id = self._proc_run = self.run_num_id
+            if last_run != run_id:
+                self._proc_avgs = {}
+                self._proc_last = {}
+            avgs = self._proc_avgs
+            last = self._proc_last
+
+            ctl_st = self.control.start
+            Tgap_st = self.control.wave.full_wave_time
+
+            t_elps = (ts - ctl_st) - Tgap_st
+            lp_a = (t_elps-dt)/t_elps
+            lp_b = dt/t_elps
+            Hps = self.control.wave.hs
+            Tps = self.control.wave.ts
+            
+            if t_elps >= 0:
+
+                for kv in ['z','e']:
+                    for num in range(1,5):
+                        prm = f'{kv}{num}'
+                        if prm in new:
+                            
+                            av = avgs[f'{prm}_lp'] = avgs.get(f'{prm}_lp',0)*0.1 + new[prm]*0.9
+                            
+                            avgs[f'{prm}_hs'] = avgs.get(f'{prm}_hs',Hps)*lp_a + abs(avgs[f'{prm}_lp']*lp_b*3.14159/2)
+
+                            #zero cross
+                            if prm in last:
+                                lsav = last[prm]
+                                if (av * lsav) < 0 and av > 0: #up crossing
+                                    if f'{prm}_ts' in last:
+                                        tlast = last[f'{prm}_ts']
+                                        zc_time = (ts - tlast)*2
+                                        if zc_time > 0.05:
+                                            avgs[f'{prm}_ts'] = avgs.get(f'{prm}_ts',Tps)*lp_a + zc_time *lp_b
+                                    last[f'{prm}_ts'] = ts
+                            last[prm] = av
+                
+                
+                self.run_summary[run_id] = avgs.copy()
+                self.run_summary[run_id].update({'run_id':run_id,'run_uid':self.run_id,'title':self.title,'Hs':Hps,'Ts':Tps,'t_measure':t_elps})
+                self.run_summary[run_id].update({k:v for k,v in self.param_snapshot.items() if k not in new})
+
+            new.update(avgs)
+
+        self.last_time = ts
+        #This saves the data #TODO: sort out disk/exp memory data
+        new['seq'] = self.cache.append(new)
+        for feed in self.feeds:
+            feed.put(new)
+        if self.wal is not None:
+            self.wal.append(new.to_dict() if isinstance(new,sample_record) else new)
+        else:
+            self.unprocessed.put_nowait(ts)
 
+    async def wal_task(self):
+        """writes & fsyncs the segment log in batches off the event loop"""
+        while True:
+            try:
+                await asyncio.to_thread(self.wal.sync)
             except Exception as e:
-                log.error(str(e), exc_info=1)
+                log.error(f'segment log sync error: {e}')
+            await asyncio.sleep(wal_sync)
 
     async def poll_data(self):
-        """polls the piplates for new data, and outputs the raw measured in real units"""
-        alpha = 0.0
-        inttime = 0
+        """polls the piplates for new data on the scheduler's deadline grid, and outputs the raw measured in real units. `slot` numbers the deadline (gaps are skipped slots) and `late` is the lateness in seconds. With `FUSED_PIPELINE` the sample is processed & stored right here instead of queued for `process_data`"""
+        sched = self.scheduler
         while True:
             try:
-                ts = time.perf_counter()
                 if self.active:
+                    slot,late = await sched.wait()
+                    #run start / stop once per sample, before it's stamped with the run id
+                    self.track_run(time.perf_counter())
                     #get the current record
                     data = self.output_data()
                     if data:
-                        await self.buffer.put(data)
-
-                    await asyncio.sleep(self.poll_rate)
+                        data['slot'] = slot
+                        data['late'] = late
+                        if FUSED_PIPELINE:
+                            self.process_sample(data)
+                        else:
+                            await self.buffer.put(data)
                 else:
+                    sched.reset()
                     await asyncio.sleep(1)
 
             except Exception as e:
@@ -0,0 +1,180 @@
+"""
+Prioritized I2C bus: one thread owns the smbus and runs queued transactions lowest priority number first
+    FEEDBACK  actuator feedback (ADS1115)
+    IMU       MPU9250 reads
+    TEMP      Si7021 reads
+    CAL       calibration & setup
+
+Each smbus call is one transaction, so feedback waits at most for the single transaction already on the bus (plus other feedback), never for a whole IMU read sequence or a temperature conversion. `i2c_device` handles look like an smbus to drivers (blocking calls through the queue) and `call` awaits the same transactions from the loop.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from waveware.timing import lateness_histogram
+
+log = logging.getLogger('i2c')
+
+try:
+    from smbus2 import SMBus as SMBus2, i2c_msg
+except ImportError:
+    log.warning('smbus2 not installed, no plain multi byte i2c reads')
+    SMBus2 = i2c_msg = None
+
+FEEDBACK = 0
+IMU = 1
+TEMP = 2
+CAL = 3
+priority_names = {FEEDBACK:'feedback',IMU:'imu',TEMP:'temp',CAL:'cal'}
+
+def crc8(data,poly:int=0x31)->int:
+    """crc-8 (x8+x5+x4+1, init 0) as sent after Si7021 / Sensirion readings"""
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = ((crc<<1) ^ poly) & 0xFF if crc & 0x80 else (crc<<1) & 0xFF
+    return crc
+
+
+class device_stats:
+    """per device counters, wait is enqueue to start on the bus and busy is time on the bus (us histograms)"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait = lateness_histogram()
+        self.busy = lateness_histogram()
+        self.t0 = time.perf_counter()
+
+    def status(self)->dict:
+        dt = time.perf_counter() - self.t0
+        return {'count':self.count,'errors':self.errors,'rate':round(self.count/dt,2) if dt > 0 else 0.,
+                'bus_frac':round(self.busy.sum*1E-6/dt,4) if dt > 0 else 0.,
+                'wait':self.wait.summary(),'busy':self.busy.summary()}
+
+
+class i2c_scheduler:
+    """Owner thread of the bus `smb`, transactions are (priority,seq,device,fn,args,future) in a priority queue, seq keeps each priority first in first out.
+
+    `raw` is an optional smbus2 handle on the same bus for plain i2c messages, used from the owner thread only like `smb`.
+    """
+
+    def __init__(self,smb,raw=None,name:str='i2c'):
+        self.smbus = smb
+        self.raw = raw
+        self.name = name
+        self.queue = queue.PriorityQueue()
+        self.stats = {} #device: device_stats
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run,name=self.name,daemon=True)
+        self.thread.start()
+        log.info(f'i2c scheduler started')
+
+    def stop(self,timeout:float=1.):
+        if self.thread is None:
+            return
+        #sorts after every real priority, pending transactions finish first
+        self.queue.put((1<<30,next(self._seq),None,None,None,None,None))
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        while True:
+            prio,_,device,fn,args,futr,t_q = self.queue.get()
+            if fn is None:
+                return
+            if not futr.set_running_or_notify_cancel():
+                continue
+            st = self.stats.get(device,None) or self.stats.setdefault(device,device_stats())
+            t0 = time.perf_counter()
+            try:
+                res = fn(*args)
+            except Exception as e:
+                st.errors += 1
+                futr.set_exception(e)
+            else:
+                futr.set_result(res)
+            t1 = time.perf_counter()
+            st.count += 1
+            st.wait.record((t0-t_q)*1E6)
+            st.busy.record((t1-t0)*1E6)
+
+    #Submitting
+    def submit(self,device:str,priority:int,fn,*args)->concurrent.futures.Future:
+        """queues fn(*args) on the bus thread from any thread, a `lowered` block on the calling thread can only lower the priority"""
+        priority = max(priority,getattr(self._local,'floor',FEEDBACK))
+        futr = concurrent.futures.Future()
+        self.queue.put((priority,next(self._seq),device,fn,args,futr,time.perf_counter()))
+        return futr
+
+    def call_sync(self,device:str,priority:int,fn,*args,timeout:float=None):
+        """blocks the calling thread (not the loop's!) until the transaction is done"""
+        if threading.current_thread() is self.thread:
+            return fn(*args)
+        return self.submit(device,priority,fn,*args).result(timeout)
+
+    async def call(self,device:str,priority:int,fn,*args):
+        return await asyncio.wrap_future(self.submit(device,priority,fn,*args))
+
+    @contextlib.contextmanager
+    def lowered(self,priority:int=CAL):
+        """transactions submitted from this thread inside the block run at `priority` or lower, ie a calibration driving the imu handle"""
+        old = getattr(self._local,'floor',FEEDBACK)
+        self._local.floor = max(old,priority)
+        try:
+            yield
+        finally:
+            self._local.floor = old
+
+    def device(self,name:str,priority:int)->'i2c_device':
+        return i2c_device(self,name,priority)
+
+    def status(self)->dict:
+        return {'queued':self.queue.qsize(),'alive':self.thread is not None and self.thread.is_alive(),
+                'devices':{d:st.status() for d,st in self.stats.items()}}
+
+
+class i2c_device:
+    """smbus stand in for one device's driver, every smbus method call is a transaction on the scheduler at `priority`.
+
+    Plain calls block the calling thread (drivers run in worker threads), `await dev.call('read_byte',addr)` waits from the loop.
+    """
+
+    def __init__(self,sched:i2c_scheduler,name:str,priority:int):
+        self.sched = sched
+        self.name = name
+        self.priority = priority
+
+    def call(self,method:str,*args):
+        return self.sched.call(self.name,self.priority,getattr(self.sched.smbus,method),*args)
+
+    async def read(self,addr:int,n:int)->list:
+        """n bytes of one plain read (address phase, no register) as a single transaction, needs the scheduler's smbus2 handle"""
+        raw = self.sched.raw
+        assert raw is not None, 'plain i2c reads need smbus2'
+        def rd():
+            msg = i2c_msg.read(addr,n)
+            raw.i2c_rdwr(msg)
+            return list(msg)
+        return await self.sched.call(self.name,self.priority,rd)
+
+    def __getattr__(self,method):
+        fn = getattr(self.sched.smbus,method)
+        if not callable(fn):
+            return fn
+        def transaction(*args):
+            return self.sched.call_sync(self.name,self.priority,fn,*args)
+        transaction.__name__ = method
+        return transaction
@@ -0,0 +1,283 @@
+"""
+MPU9250 FIFO sampling & online fusion, alongside the imusensor driver which configures the chip and holds the calibration
+
+1. mpu_fifo: the chip samples accel & gyro into its 512 byte FIFO at a fixed output data rate, `read` drains it with block reads and converts the whole batch with numpy (the driver's scale, axis transform & calibration) into timestamped arrays, so the imu stream gets every sample instead of the newest one per poll.
+2. imu_fusion: Madgwick or Mahony orientation (accel & gyro) and a drift corrected double integration of the vertical acceleration into heave, sample by sample over each batch at a fixed cost per sample
+"""
+import logging
+import math
+import time
+
+import numpy as np
+
+log = logging.getLogger('imu')
+
+#MPU9250 registers
+SMPLRT_DIV = 0x19
+FIFO_EN = 0x23
+EXT_SENS_DATA_00 = 0x49
+USER_CTRL = 0x6A
+FIFO_COUNTH = 0x72
+FIFO_R_W = 0x74
+
+FIFO_ACCEL_GYRO = 0x78 #gyro x,y,z & accel into the fifo
+USER_FIFO_EN = 0x40
+USER_I2C_MST_EN = 0x20 #keeps the magnetometer in the external sensor registers
+USER_FIFO_RST = 0x04
+
+FIFO_SIZE = 512
+SAMPLE_BYTES = 12 #accel xyz then gyro xyz, big endian int16
+CHUNK_BYTES = 24 #smbus block reads top out at 32 bytes, two whole samples per transaction
+
+def fifo_divider(rate:float)->int:
+    """SMPLRT_DIV for the closest rate to `rate` Hz off the 1kHz internal rate (DLPF on)"""
+    return int(min(max(round(1000./rate)-1,0),255))
+
+
+class mpu_fifo:
+    """FIFO reader of the configured imusensor MPU9250 `imu`, `bus` is the smbus (or i2c_device) to read through"""
+
+    def __init__(self,imu,bus,rate:float=200.,addr:int=0x68):
+        self.imu = imu
+        self.bus = bus
+        self.addr = addr
+        self.div = fifo_divider(rate)
+        self.rate = 1000./(1+self.div)
+        self.period = 1./self.rate
+        self.last_t = None
+        self.stats = {'drains':0,'samples':0,'transactions':0,'overflows':0,'errors':0}
+
+    def setup(self):
+        """sets the sample rate and restarts the fifo with accel & gyro"""
+        self.bus.write_byte_data(self.addr,SMPLRT_DIV,self.div)
+        self.imu.CurrentSRD = self.div
+        self.reset()
+        log.info(f'mpu fifo at {self.rate:3.1f}Hz (div {self.div})')
+
+    def reset(self):
+        self.bus.write_byte_data(self.addr,USER_CTRL,USER_I2C_MST_EN)
+        self.bus.write_byte_data(self.addr,FIFO_EN,0)
+        self.bus.write_byte_data(self.addr,USER_CTRL,USER_I2C_MST_EN|USER_FIFO_RST)
+        self.bus.write_byte_data(self.addr,FIFO_EN,FIFO_ACCEL_GYRO)
+        self.bus.write_byte_data(self.addr,USER_CTRL,USER_I2C_MST_EN|USER_FIFO_EN)
+        self.last_t = None
+
+    def count(self)->int:
+        hi,lo = self.bus.read_i2c_block_data(self.addr,FIFO_COUNTH,2)
+        self.stats['transactions'] += 1
+        return ((hi&0x1F)<<8) | lo
+
+    def read_raw(self):
+        """(perf_counter at the count read,bytes) of the whole samples in the fifo, None after an overflow (the fifo is reset and the batch lost)"""
+        nbytes = self.count()
+        t = time.perf_counter()
+        if nbytes >= FIFO_SIZE - SAMPLE_BYTES:
+            #full, the oldest sample was overwritten part way so the byte alignment is gone
+            self.stats['overflows'] += 1
+            log.warning(f'mpu fifo overflow, resetting')
+            self.reset()
+            return t,None
+        nbytes -= nbytes % SAMPLE_BYTES
+        data = bytearray()
+        while len(data) < nbytes:
+            n = min(CHUNK_BYTES,nbytes-len(data))
+            data.extend(self.bus.read_i2c_block_data(self.addr,FIFO_R_W,n))
+            self.stats['transactions'] += 1
+        return t,bytes(data)
+
+    def convert(self,data:bytes):
+        """(accel (n,3) m/s2,gyro (n,3) rad/s) calibrated like imusensor's readSensor"""
+        imu = self.imu
+        raw = np.frombuffer(data,dtype='>i2').reshape(-1,6).astype(np.float64)
+        tm = imu.cfg.transformationMatrix.T
+        accel = ((raw[:,:3] @ tm)*imu.AccelScale - imu.AccelBias)*imu.Accels
+        gyro = (raw[:,3:] @ tm)*imu.GyroScale - imu.GyroBias
+        return accel,gyro
+
+    def times(self,n:int,t:float):
+        """sample times of a batch of n ending by t: continuing one period after the last batch while that stays within a period of t, else back from t (spread evenly after the last batch if that would overlap it)"""
+        times = t - self.period*np.arange(n-1,-1,-1)
+        if self.last_t is not None:
+            cont = self.last_t + self.period*np.arange(1,n+1)
+            if abs(cont[-1] - t) < self.period:
+                times = cont
+            elif times[0] <= self.last_t:
+                times = np.linspace(self.last_t,t,n+1)[1:]
+        self.last_t = float(times[-1])
+        return times
+
+    def read(self):
+        """(times,accel,gyro) of the samples since the last read, empty arrays when there are none"""
+        try:
+            t,data = self.read_raw()
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        self.stats['drains'] += 1
+        if not data:
+            return np.zeros(0),np.zeros((0,3)),np.zeros((0,3))
+        accel,gyro = self.convert(data)
+        self.stats['samples'] += len(accel)
+        return self.times(len(accel),t),accel,gyro
+
+    def read_mag(self):
+        """magnetometer (3,) uT from the external sensor registers the chip's i2c master fills, as readSensor"""
+        imu = self.imu
+        data = np.array(self.bus.read_i2c_block_data(self.addr,EXT_SENS_DATA_00,7)[:6]).astype(np.int16)
+        self.stats['transactions'] += 1
+        vals = (data[1::2]<<8) + data[::2]
+        if imu.Magtransform is None:
+            return ((vals)*imu.MagScale - imu.MagBias)*imu.Mags
+        return np.matmul(vals*imu.MagScale - imu.MagBias,imu.Magtransform)
+
+    def status(self)->dict:
+        return dict(self.stats,rate=self.rate)
+
+
+#Fusion
+fusion_methods = ('madgwick','mahony')
+GRAVITY = 9.807
+
+def quat_from_accel(ax,ay,az):
+    """level quaternion (yaw 0) of a resting accel reading, roll & pitch as imusensor's computeOrientation"""
+    roll = math.atan2(ay,az)
+    pitch = math.atan2(-ax,math.sqrt(ay*ay+az*az))
+    cr,sr = math.cos(roll/2),math.sin(roll/2)
+    cp,sp = math.cos(pitch/2),math.sin(pitch/2)
+    return [cr*cp,sr*cp,cr*sp,-sr*sp]
+
+
+class orientation_filter:
+    """Madgwick (gradient descent, `gain` is beta) or Mahony (complementary PI, `gain` is kp) on accel m/s2 & gyro rad/s, q = [w,x,y,z] rotates the sensor frame into the earth frame (z up)"""
+
+    def __init__(self,method:str='madgwick',gain:float=None,ki:float=0.):
+        assert method in fusion_methods, f'bad fusion method {method}! choose: {fusion_methods}'
+        self.method = method
+        self.gain = gain if gain is not None else (0.1 if method == 'madgwick' else 1.0)
+        self.ki = ki
+        self.q = None
+        self._int = [0.,0.,0.] #mahony integral feedback
+
+    def step(self,gx,gy,gz,ax,ay,az,dt):
+        if self.q is None:
+            self.q = quat_from_accel(ax,ay,az)
+            return self.q
+        if self.method == 'madgwick':
+            self._madgwick(gx,gy,gz,ax,ay,az,dt)
+        else:
+            self._mahony(gx,gy,gz,ax,ay,az,dt)
+        return self.q
+
+    def _madgwick(self,gx,gy,gz,ax,ay,az,dt):
+        q0,q1,q2,q3 = self.q
+        qd0 = 0.5*(-q1*gx - q2*gy - q3*gz)
+        qd1 = 0.5*(q0*gx + q2*gz - q3*gy)
+        qd2 = 0.5*(q0*gy - q1*gz + q3*gx)
+        qd3 = 0.5*(q0*gz + q1*gy - q2*gx)
+        an = math.sqrt(ax*ax+ay*ay+az*az)
+        if an > 0:
+            ax,ay,az = ax/an,ay/an,az/an
+            q0q0,q1q1,q2q2,q3q3 = q0*q0,q1*q1,q2*q2,q3*q3
+            s0 = 4*q0*q2q2 + 2*q2*ax + 4*q0*q1q1 - 2*q1*ay
+            s1 = 4*q1*q3q3 - 2*q3*ax + 4*q0q0*q1 - 2*q0*ay - 4*q1 + 8*q1*q1q1 + 8*q1*q2q2 + 4*q1*az
+            s2 = 4*q0q0*q2 + 2*q0*ax + 4*q2*q3q3 - 2*q3*ay - 4*q2 + 8*q2*q1q1 + 8*q2*q2q2 + 4*q2*az
+            s3 = 4*q1q1*q3 - 2*q1*ax + 4*q2q2*q3 - 2*q2*ay
+            sn = math.sqrt(s0*s0+s1*s1+s2*s2+s3*s3)
+            if sn > 0:
+                b = self.gain/sn
+                qd0 -= b*s0
+                qd1 -= b*s1
+                qd2 -= b*s2
+                qd3 -= b*s3
+        self._set(q0+qd0*dt,q1+qd1*dt,q2+qd2*dt,q3+qd3*dt)
+
+    def _mahony(self,gx,gy,gz,ax,ay,az,dt):
+        q0,q1,q2,q3 = self.q
+        an = math.sqrt(ax*ax+ay*ay+az*az)
+        if an > 0:
+            ax,ay,az = ax/an,ay/an,az/an
+            #estimated up in the sensor frame, error is its cross product with the measured
+            vx = 2*(q1*q3 - q0*q2)
+            vy = 2*(q0*q1 + q2*q3)
+            vz = q0*q0 - q1*q1 - q2*q2 + q3*q3
+            ex = ay*vz - az*vy
+            ey = az*vx - ax*vz
+            ez = ax*vy - ay*vx
+            if self.ki > 0:
+                i = self._int
+                i[0] += self.ki*ex*dt
+                i[1] += self.ki*ey*dt
+                i[2] += self.ki*ez*dt
+                gx,gy,gz = gx+i[0],gy+i[1],gz+i[2]
+            gx += self.gain*ex
+            gy += self.gain*ey
+            gz += self.gain*ez
+        h = 0.5*dt
+        self._set(q0 + h*(-q1*gx - q2*gy - q3*gz),
+                  q1 + h*(q0*gx + q2*gz - q3*gy),
+                  q2 + h*(q0*gy - q1*gz + q3*gx),
+                  q3 + h*(q0*gz + q1*gy - q2*gx))
+
+    def _set(self,q0,q1,q2,q3):
+        n = math.sqrt(q0*q0+q1*q1+q2*q2+q3*q3)
+        self.q = [q0/n,q1/n,q2/n,q3/n]
+
+    def euler(self):
+        """(roll,pitch,yaw) degrees, yaw is relative to the start as there's no magnetometer in the fusion"""
+        q0,q1,q2,q3 = self.q
+        roll = math.atan2(2*(q0*q1 + q2*q3),1 - 2*(q1*q1 + q2*q2))
+        pitch = math.asin(min(max(2*(q0*q2 - q3*q1),-1.),1.))
+        yaw = math.atan2(2*(q0*q3 + q1*q2),1 - 2*(q2*q2 + q3*q3))
+        return math.degrees(roll),math.degrees(pitch),math.degrees(yaw)
+
+    def vertical(self,ax,ay,az):
+        """earth frame up component of a sensor frame vector"""
+        q0,q1,q2,q3 = self.q
+        return 2*(q1*q3 - q0*q2)*ax + 2*(q0*q1 + q2*q3)*ay + (q0*q0 - q1*q1 - q2*q2 + q3*q3)*az
+
+
+class heave_integrator:
+    """Vertical acceleration (gravity removed) to displacement, the acceleration bias, velocity & displacement each leak back to zero with time constant `tau` s so the double integration doesn't drift, motion much faster than tau (waves) passes through and a start or bias step settles in a few tau"""
+
+    def __init__(self,tau:float=5.):
+        self.tau = tau
+        self.bias = 0.
+        self.v = 0.
+        self.z = 0.
+
+    def step(self,a,dt):
+        k = min(dt/self.tau,1.)
+        self.bias += (a - self.bias)*k
+        self.v += (a - self.bias)*dt
+        self.v -= self.v*k
+        self.z += self.v*dt
+        self.z -= self.z*k
+        return self.z
+
+
+class imu_fusion:
+    """Orientation & heave over batches of imu samples, `update` returns (n,4) roll,pitch,yaw (deg),heave (m) rows"""
+
+    def __init__(self,method:str='madgwick',gain:float=None,tau:float=5.,max_dt:float=0.1):
+        self.orient = orientation_filter(method,gain)
+        self.heave = heave_integrator(tau)
+        self.max_dt = max_dt
+        self.last_t = None
+        self.samples = 0
+
+    def update(self,times,accel,gyro):
+        n = len(times)
+        out = np.empty((n,4))
+        last = self.last_t
+        for i,(t,a,g) in enumerate(zip(np.asarray(times).tolist(),np.asarray(accel).tolist(),np.asarray(gyro).tolist())):
+            #a gap (or the first sample) only re-levels, nothing is integrated across it
+            dt = t - last if last is not None else 0.
+            if dt <= 0 or dt > self.max_dt:
+                dt = 0.
+            last = t
+            self.orient.step(g[0],g[1],g[2],a[0],a[1],a[2],dt)
+            out[i,:3] = self.orient.euler()
+            out[i,3] = self.heave.step(self.orient.vertical(a[0],a[1],a[2]) - GRAVITY,dt) if dt > 0 else self.heave.z
+        self.last_t = last
+        self.samples += n
+        return out
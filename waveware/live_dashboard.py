@@ -16,6 +16,8 @@ from dash.dependencies import Input, Output,State
 import sys
 
 import time
+import asyncio
+import threading
 import plotly
 import plotly.express as px
 import numpy as np
@@ -33,6 +35,73 @@ log = logging.getLogger("dashboard")
 
 POLL_INTERVAL = 1.0
 
+#local columns of the data server window, shared by every browser tab
+dash_cache = sample_store(window * 2 / poll_rate, max_age=window * 2)
+cache_lock = threading.Lock()
+stream_state = {'connected':False,'dropped':0,'seq':None,'lost':0}
+stream_fields = sorted(set(z_sensors+e_sensors+zgraph+vgraph+acclgryo))
+
+def add_columns(cols):
+    """extends the local cache with the samples after the sequence cursor, counting any gap as lost samples"""
+    with cache_lock:
+        cursor = stream_state['seq']
+        seq = cols['seq'].astype(np.int64)
+        if not len(seq):
+            return
+        if cursor is not None and seq[-1] <= cursor and cols['timestamp'][-1] > dash_cache.last_time:
+            log.info(f'data server sequence reset, clearing cache')
+            dash_cache.clear()
+            cursor = None
+
+        if cursor is not None:
+            keep = seq > cursor
+            if not keep.any():
+                return
+            if not keep.all():
+                cols = {k:v[keep] for k,v in cols.items()}
+                seq = seq[keep]
+            if seq[0] > cursor + 1:
+                stream_state['lost'] += int(seq[0] - cursor - 1)
+                log.info(f'lost samples {cursor+1}-{seq[0]-1}| total: {stream_state["lost"]}')
+
+        dash_cache.extend(cols)
+        stream_state['seq'] = int(seq[-1])
+
+def stream_listener():
+    """background thread keeping `dash_cache` filled from the data server `/stream` websocket so graph updates dont poll"""
+    import aiohttp
+
+    async def listen():
+        url = REMOTE_HOST.replace('http','ws',1)+'/stream'
+        params = {'format':'columns','fields':','.join(stream_fields)}
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(url,params=params) as ws:
+                        log.info(f'stream connected: {url}')
+                        #backfill the window, overlap with the stream is dropped by add_columns
+                        bparams = {'format':'columns'}
+                        if stream_state['seq'] is not None:
+                            bparams['since_seq'] = stream_state['seq']
+                        async with session.get(f"{REMOTE_HOST}/getdata",params=bparams) as resp:
+                            if resp.status == 200:
+                                cols,meta = decode_columns(await resp.read())
+                                add_columns(cols)
+                        stream_state['connected'] = True
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.BINARY:
+                                cols,meta = decode_columns(msg.data)
+                                add_columns(cols)
+                                stream_state['dropped'] = meta.get('dropped',0)
+                            elif msg.type == aiohttp.WSMsgType.ERROR:
+                                break
+            except Exception as e:
+                log.info(f'stream error: {e}')
+            stream_state['connected'] = False
+            await asyncio.sleep(POLL_INTERVAL)
+
+    asyncio.run(listen())
+
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 
 app = dash.Dash(
@@ -495,34 +564,47 @@ def update_graphs(n,on):
     begin = time.perf_counter()
     if on:
         try:
-            #TODO: add synchronization via diskcache... in background thread?
-            if memcache:
-                #we got data so lets do the query
-                max_ts = max(list(memcache.keys()))
-                new_data = requests.get(f"{REMOTE_HOST}/getdata?after={max_ts}")
-            else:
-                #no data, so ask for the full blast. yeet
-                new_data = requests.get(f"{REMOTE_HOST}/getdata")
+            #when the stream is live the cache is already current, otherwise poll
+            if stream_state['connected'] or not dash_max_points:
+                if not stream_state['connected']:
+                    params = {'format':'columns'}
+                    if stream_state['seq'] is not None:
+                        #we got data so lets do the query
+                        params['since_seq'] = stream_state['seq']
+                    #otherwise no data, so ask for the full blast. yeet
+                    new_data = requests.get(f"{REMOTE_HOST}/getdata",params=params)
+
+                    #Apply away
+                    if new_data.status_code == 420:
+                        raise dash.exceptions.PreventUpdate
+
+                    if new_data.status_code == 200:
+                        cols,meta = decode_columns(new_data.content)
+                        #add data to cache
+                        add_columns(cols)
+                    else:
+                        log.info(f'got bad response: {new_data}')
+
+                #dataframe / index
+                #tm = time.perf_counter()    
+                with cache_lock:
+                    if not dash_cache:
+                        raise dash.exceptions.PreventUpdate
+                    cols = dash_cache.to_columns(dash_cache.range())
+                if dash_max_points:
+                    cols = decimate(cols,dash_max_points,dash_decimate)
 
-            #Apply away
-            if new_data.status_code == 420:
-                raise dash.exceptions.PreventUpdate
-
-            if new_data.status_code == 200:
-                data = new_data.json()
-                #add data to cache
-                for ts,data in data.items():
-                    memcache[float(ts)] = data
             else:
-                log.info(f'got bad response: {new_data}')
-
-            #dataframe / index
-            #tm = time.perf_counter()    
-            data = list(memcache.values())
-            df = pd.DataFrame.from_dict(data)
+                #polling with decimation, the server reduces the whole window so payload & render are bounded
+                params = {'format':'columns','max_points':dash_max_points,'method':dash_decimate,'fields':','.join(stream_fields)}
+                new_data = requests.get(f"{REMOTE_HOST}/getdata",params=params)
+                if new_data.status_code != 200:
+                    if new_data.status_code != 420:
+                        log.info(f'got bad response: {new_data}')
+                    raise dash.exceptions.PreventUpdate
+                cols,meta = decode_columns(new_data.content)
 
-            df.set_index('timestamp')
-            df.sort_index()
+            df = pd.DataFrame(cols)
 
             #adjust to present
             
@@ -649,6 +731,9 @@ def main():
 
         log.info(f'serving dashboard on: {FW_HOST} with DEBUG={DEBUG}')
 
+        if DASH_STREAM:
+            threading.Thread(target=stream_listener,daemon=True).start()
+
         #FIXME: debug can cause zombie processes, thanks 70k per year software!
         #You can sometimes change this with PORT env var
         #On WSL zombies can permanently hang causing weird networking issues
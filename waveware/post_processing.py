@@ -37,6 +37,8 @@ from sympy import EX
 
 from waveware.config import *
 from waveware.data import *
+from waveware.uploads import load_json, load_manifest_segments, manifest_dirs
+from waveware import archive
 
 logging.basicConfig(level=20)
 log = logging.getLogger('post-processing')
@@ -67,11 +69,89 @@ def sync_from_s3():
     result = subprocess.run(f'aws s3 sync "{pth}" "{test_data}"',shell=True, text=True,env=os.environ)
     log.info(f'sync result: {result}')
 
-data_files = get_files('**/data_*.json')
+data_files = get_files('**/data_*.json*') #.json.gz / .json.zst when compressed
+manifest_tests = manifest_dirs(test_data) #columnar segment uploads
 input_files = get_files('**/set_input_*.json')
 zero_files = get_files('**/zero*.json')
 note_files = get_files('**/test_note*.json')
 maybe_note_files = get_files('**/session_results*.json') #notes labled wrong :(
+run_event_files = get_files('**/run_event_*.json')
+
+#compacted archive (see `wavecompact`), files it covers are read from it instead of the json
+archive_dir = os.environ.get('WAVEWARE_ARCHIVE_DIR',test_data.rstrip('/')+'_archive')
+archived = archive.archive_sources(archive_dir) if archive.pa is not None else set()
+if archived:
+    log.info(f'using archive {archive_dir} for {len(archived)} files')
+
+def data_uploads():
+    """archived uploads, json data uploads then the segments of each columnar manifest, all as {'upload_time':..,'data':{ts:row}}"""
+    if archived:
+        yield from archive.load_uploads(archive_dir)
+    for dat_fil in data_files:
+        if dat_fil not in archived:
+            yield load_json(os.path.join(test_data,dat_fil))
+    for test_dir in manifest_tests:
+        yield from load_manifest_segments(test_dir)
+
+def event_uploads(kind,files):
+    """(file,upload) of the archived events of a kind then the files not in the archive"""
+    if archived:
+        yield from archive.load_events(archive_dir,kind)
+    for fil in files:
+        if fil not in archived:
+            yield fil,load_json(os.path.join(test_data,fil))
+
+def iso_epoch(at:str)->float:
+    """utc epoch of an iso time, naive ones are utc"""
+    dt = datetime.datetime.fromisoformat(at)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+def load_run_events()->dict:
+    """{run_id: {'start':event,'stop':event}} from the uploaded run events"""
+    runs = {}
+    for fil,ev in event_uploads('run',run_event_files):
+        if ev.get('run_id',None) is not None:
+            runs.setdefault(int(ev['run_id']),{})[ev['kind']] = ev
+    return runs
+
+def group_runs(rows:list)->dict:
+    """run records of rows stamped with a `run_id`, grouped in one pass and keyed `run_<id>` in the `load_data` format, the run's start event supplies its input parameters and zeros / notes are attached by time"""
+    runs = load_run_events()
+    df = pd.DataFrame(rows)
+    df = df[df['run_id'].notna()].drop_duplicates('timestamp').sort_values('timestamp')
+    out = {}
+    for rid,grp in df.groupby('run_id',sort=True):
+        rid = int(rid)
+        evs = runs.get(rid,{})
+        st = evs.get('start',{})
+        sp = evs.get('stop',{})
+        t0 = st.get('utc',None) or (grp['utc'].min() if 'utc' in grp else rid/1000.)
+        t1 = sp.get('utc',None) or (grp['utc'].max() if 'utc' in grp else None)
+        start = datetime.datetime.fromtimestamp(t0,tz=datetime.timezone.utc)
+        end = datetime.datetime.fromtimestamp(t1,tz=datetime.timezone.utc) if t1 else None
+        params = st.get('params',None) or grp.iloc[0].to_dict()
+        out[f'run_{rid}'] = {'input':{'data':params,'asOf':str(start),'upload_time':str(start)},
+                              'start':start,'end':end,'span':(t1-t0) if t1 else None,
+                              't0':t0,'t1':t1 or np.inf,
+                              'notes':[],'cal':{},
+                              'records':dict(zip(grp['timestamp'],grp.to_dict('records')))}
+
+    #zeros & notes inside a run
+    keys = list(out.keys())
+    t0s = np.array([out[k]['t0'] for k in keys])
+    t1s = np.array([out[k]['t1'] for k in keys])
+    def run_at(t):
+        i = np.searchsorted(t0s,t,side='right') - 1
+        return keys[i] if i >= 0 and t <= t1s[i] else None
+    for zro_fil,dat in event_uploads('zero',zero_files):
+        if (key := run_at(iso_epoch(dat['upload_time']))) is not None:
+            out[key]['cal'][dat['upload_time']] = dat
+    for note_fil,dat in event_uploads('note',note_files+maybe_note_files):
+        if 'test_log' in dat and (key := run_at(iso_epoch(dat['at']))) is not None:
+            out[key]['notes'].append(dat['test_log'])
+    return out
 
 def load_data():
     #Determine DataPoints To Get
@@ -81,9 +161,7 @@ def load_data():
     data = {}
     rec_times = {}
     stop_times_ = []
-    for inpt_file in  input_files:
-        with open(os.path.join(test_data,inpt_file),'r') as fp:
-            inpt = json.load(fp)
+    for inpt_file,inpt in event_uploads('input',input_files):
         
         atime = datetime.datetime.fromisoformat(inpt['upload_time'])
 
@@ -150,9 +228,28 @@ def load_data():
     notes= {}
     #unassigned_data =  {}
     records = list(data.keys())
-    for dat_fil in data_files:
-        with open(os.path.join(test_data,dat_fil),'r') as fp:
-            dat = json.load(fp)
+    start_utc = (starts - np.datetime64(0,'s'))/np.timedelta64(1,'s')
+    end_utc = (ends - np.datetime64(0,'s'))/np.timedelta64(1,'s')
+    evented = []
+    for dat in data_uploads():
+        rows = list(dat['data'].values())
+        #rows that know their run are grouped after in one pass, the rest (older data, outside wave mode) match an input record by utc or upload time
+        evented.extend(r for r in rows if r.get('run_id',None) is not None)
+        rows = [r for r in rows if r.get('run_id',None) is None]
+        stamped = [r for r in rows if r.get('utc',None) is not None]
+        if stamped:
+            #rows stamped by the clock model go to the run started last before them
+            utc = np.array([r['utc'] for r in stamped],dtype=np.float64)
+            inx = np.searchsorted(start_utc,utc,side='right') - 1
+            for i,u,row in zip(inx,utc,stamped):
+                if i < 0 or i >= len(records) or not u <= end_utc[i]:
+                    continue
+                key_rec = records[i]
+                row.update(**data[key_rec]['input']['data'])
+                data[key_rec]['records'][row['timestamp']] = row.copy()
+            rows = [r for r in rows if r.get('utc',None) is None]
+        if not rows:
+            continue
 
         atime = datetime.datetime.fromisoformat(dat['upload_time'])
 
@@ -166,7 +263,7 @@ def load_data():
             for cnd in cond:
                 #TODO: fix record ordering issue?
                 key_rec = records[cnd]
-                for ts,row in dat['data'].items():
+                for row in rows:
                     row.update(**data[key_rec]['input']['data'])
                     data[key_rec]['records'][row['timestamp']] = row.copy()
 
@@ -174,6 +271,9 @@ def load_data():
         #    for ts,row in dat['data'].items():
         #        unassigned_data[row['timestamp' ]] = row
 
+    if evented:
+        data.update(group_runs(evented))
+
     #sort data
     rmv = []
     run_id = 0
@@ -209,11 +309,9 @@ def load_data():
         data.pop(rm)
 
     #Map Calibration Files While Running
+    #`records` stays the input file runs, in line with starts / ends (run_<id> records got their zeros & notes in group_runs)
     cals = {}
-    records = list(data.keys())
-    for zro_fil in zero_files:
-        with open(os.path.join(test_data,zro_fil),'r') as fp:
-            dat = json.load(fp)
+    for zro_fil,dat in event_uploads('zero',zero_files):
 
         atime = datetime.datetime.fromisoformat(dat['upload_time'])
 
@@ -248,9 +346,7 @@ def load_data():
             insert(key_rec,dat)    
             
             
-    for note_fil in (note_files+maybe_note_files):
-        with open(os.path.join(test_data,note_fil),'r') as fp:
-            dat = json.load(fp)
+    for note_fil,dat in event_uploads('note',note_files+maybe_note_files):
 
         if 'test_log' not in dat:
             log.info(f'skipping not log: {test_data}/{note_fil}| {dat}')
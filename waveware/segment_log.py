@@ -0,0 +1,235 @@
+"""
+Append only segment log (write ahead log) of processed samples on local disk, the uploader reads closed segments from here rather than memory
+
+Segments are `seg_<epoch ms>_<n>.wal` files of length prefixed frames:
+    length (uint32 le) | crc32 (uint32 le) | kind (1 byte) | json payload
+kind `S` is a sample row and `P` a {version:snapshot} parameter record, every segment repeats the snapshots seen so far so it can be read on its own.
+
+Frames are buffered and written + fsync'd in batches by `sync`, which also rotates the active segment by size or age. An uploaded segment is renamed `.sent` and the oldest of those are purged. After a crash the segments left behind are simply pending again, a torn last frame fails its length/crc check and is dropped.
+
+`event_log` keeps run start/stop events in the same frame format (kind `E`) in one file indexed by run id.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger('wal')
+
+frame_head = struct.Struct('<II')
+
+def encode_frame(kind:bytes,obj)->bytes:
+    body = kind + json.dumps(obj,default=str).encode()
+    return frame_head.pack(len(body),zlib.crc32(body)) + body
+
+def read_frames(buf:bytes):
+    """yields (kind,obj) of each whole valid frame, stopping at the first torn or corrupt one"""
+    at = 0
+    n = len(buf)
+    while at + frame_head.size <= n:
+        length,crc = frame_head.unpack_from(buf,at)
+        start = at + frame_head.size
+        body = buf[start:start+length]
+        if length < 1 or len(body) < length or zlib.crc32(body) != crc:
+            log.warning(f'segment log: bad frame at byte {at}/{n}, dropping the rest')
+            return
+        yield body[:1],json.loads(body[1:])
+        at = start + length
+
+def frames_end(buf:bytes)->int:
+    """byte offset just past the last whole valid frame"""
+    at = 0
+    n = len(buf)
+    while at + frame_head.size <= n:
+        length,crc = frame_head.unpack_from(buf,at)
+        body = buf[at+frame_head.size:at+frame_head.size+length]
+        if length < 1 or len(body) < length or zlib.crc32(body) != crc:
+            break
+        at += frame_head.size + length
+    return at
+
+def read_segment(path:str):
+    """the sample rows and parameter snapshots of one segment file"""
+    with open(path,'rb') as fp:
+        buf = fp.read()
+    rows = []
+    params = {}
+    for kind,obj in read_frames(buf):
+        if kind == b'S':
+            rows.append(obj)
+        elif kind == b'P':
+            params.update({int(k):v for k,v in obj.items()})
+    return rows,params
+
+def materialize(row:dict,params:dict)->dict:
+    """a row with the parameter snapshot of its `param_ver` filled in"""
+    ver = row.get('param_ver',None)
+    snap = params.get(int(ver),None) if ver is not None else None
+    if not snap:
+        return row
+    out = dict(snap)
+    out.update(row)
+    return out
+
+
+class segment_log:
+    """Writes sample rows to rotating segment files, `append` only buffers (called from the event loop) and `sync` does the disk io (run it in a thread)"""
+
+    def __init__(self,directory:str,max_bytes:int=4_000_000,max_age:float=10.,keep:int=100,params_fn=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.params_fn = params_fn #version -> snapshot
+        os.makedirs(directory,exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._pending = [] #frames not yet written
+        self._seg_params = set() #versions written to the active segment
+        self.active = None
+        self._fp = None
+        self._opened = None
+        self._size = 0
+        self.stats = {'appended':0,'synced':0,'segments':0,'uploaded':0,'replayed':0}
+
+        left = self.closed()
+        if left:
+            self.stats['replayed'] = len(left)
+            log.info(f'segment log has {len(left)} segments to replay in {directory}')
+
+    #Write
+    def append(self,row:dict):
+        ver = row.get('param_ver',None)
+        with self._lock:
+            if ver is not None and ver not in self._seg_params and self.params_fn is not None:
+                snap = self.params_fn(ver)
+                if snap:
+                    self._pending.append(encode_frame(b'P',{int(ver):dict(snap)}))
+                self._seg_params.add(ver)
+            self._pending.append(encode_frame(b'S',row))
+            self.stats['appended'] += 1
+
+    def _open(self):
+        self._opened = time.time()
+        self.stats['segments'] += 1
+        self.active = os.path.join(self.directory,f'seg_{int(self._opened*1000):015d}_{self.stats["segments"]:06d}.wal')
+        self._fp = open(self.active,'ab')
+        self._size = 0
+
+    def _close(self):
+        if self._fp is not None:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+        self._fp = None
+        self.active = None
+
+    def sync(self,rotate:bool=False):
+        """write buffered frames, fsync, then rotate if the segment is too big / old (or `rotate`)"""
+        with self._lock:
+            frames,self._pending = self._pending,[]
+            if self._fp is not None and (rotate or self._size >= self.max_bytes or time.time() - self._opened >= self.max_age):
+                self._close()
+            if self._fp is None and frames:
+                self._open()
+                #new segment repeats the snapshots seen so far
+                if self.params_fn is not None:
+                    snaps = {int(v):dict(s) for v in self._seg_params if (s := self.params_fn(v))}
+                    if snaps:
+                        frames.insert(0,encode_frame(b'P',snaps))
+            fp = self._fp
+
+        if frames and fp is not None:
+            data = b''.join(frames)
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+            self._size += len(data)
+            self.stats['synced'] += len(frames)
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._close()
+
+    #Upload
+    def closed(self)->list:
+        """segments waiting for upload, oldest first, excluding the one being written"""
+        names = sorted(f for f in os.listdir(self.directory) if f.endswith('.wal'))
+        paths = [os.path.join(self.directory,f) for f in names]
+        return [p for p in paths if p != self.active]
+
+    def mark_uploaded(self,path:str):
+        os.replace(path,path[:-len('.wal')]+'.sent')
+        self.stats['uploaded'] += 1
+        self.purge()
+
+    def purge(self):
+        sent = sorted(f for f in os.listdir(self.directory) if f.endswith('.sent'))
+        for f in sent[:max(len(sent)-self.keep,0)]:
+            os.remove(os.path.join(self.directory,f))
+
+    def status(self)->dict:
+        out = {'pending_segments':len(self.closed()),'buffered':len(self._pending),'active':os.path.basename(self.active) if self.active else None}
+        out.update(self.stats)
+        return out
+
+
+class event_log:
+    """Append only file of run events (kind `E` frames) with an index of runs by id, each event is written & fsync'd as it happens since they're rare and the run boundaries must survive a crash"""
+
+    def __init__(self,path:str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+        self._lock = threading.Lock()
+        self.events = []
+        self.runs = {} #run_id: {'start':event,'stop':event}
+        if os.path.exists(path):
+            with open(path,'rb') as fp:
+                buf = fp.read()
+            for kind,obj in read_frames(buf):
+                if kind == b'E':
+                    self._index(obj)
+            #cut a torn tail so new events follow the last good one
+            end = frames_end(buf)
+            if end < len(buf):
+                os.truncate(path,end)
+            log.info(f'event log has {len(self.events)} events / {len(self.runs)} runs in {path}')
+        self._fp = open(path,'ab')
+
+    def _index(self,event:dict):
+        event['n'] = len(self.events)
+        self.events.append(event)
+        rid = event.get('run_id',None)
+        if rid is not None:
+            self.runs.setdefault(rid,{})[event['kind']] = event
+
+    def append(self,event:dict)->dict:
+        with self._lock:
+            self._index(event)
+            self._fp.write(encode_frame(b'E',event))
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+        return event
+
+    def since(self,n:int=0)->list:
+        return self.events[n:]
+
+    def run_index(self)->list:
+        """one row per run: id, start/stop utc, sample seq range & parameter version"""
+        out = []
+        for rid,evs in self.runs.items():
+            st = evs.get('start',{})
+            sp = evs.get('stop',{})
+            out.append({'run_id':rid,'run_num':st.get('run_num',None),'title':st.get('title',None),
+                        'start_utc':st.get('utc',None),'stop_utc':sp.get('utc',None),
+                        'first_seq':st.get('seq',None),'last_seq':sp.get('seq',None),
+                        'param_ver':st.get('param_ver',None),'reason':sp.get('reason',None)})
+        return sorted(out,key=lambda r: r['run_id'])
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
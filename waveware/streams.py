@@ -0,0 +1,206 @@
+"""
+Per sensor sample streams at each source's native rate
+1. sensor_stream: fixed ring of (perf_counter time, values) a single source publishes into from its own loop / thread / callback
+2. stream_hub: the named streams of a rig, merges them into aligned frames on demand (latest values, or resampled to a time grid with sample & hold or linear interpolation) and hands out new samples for upload, the upload cursor only moves past them once they're sent
+"""
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger('streams')
+
+resample_methods = ('hold','linear')
+
+
+class sensor_stream:
+    """Ring of the last `capacity` samples of `fields` from one source, `total` counts every sample published and doubles as the read cursor.
+
+    With `on_change` a sample equal to the last one is only counted in `skipped`, for slow or mostly constant sources.
+    """
+
+    def __init__(self,name:str,fields:list,capacity:int=4096,on_change:bool=False):
+        self.name = name
+        self.fields = list(fields)
+        self.capacity = int(capacity)
+        self.on_change = on_change
+        self.times = np.full(self.capacity,np.nan)
+        self.values = np.full((self.capacity,len(self.fields)),np.nan)
+        self._lock = threading.Lock()
+        self.total = 0
+        self.skipped = 0
+        self._last = None
+
+    def publish(self,t:float,values):
+        """one sample of values (in field order) at perf_counter time t"""
+        if self.on_change:
+            values = tuple(values)
+            if values == self._last:
+                self.skipped += 1
+                return
+            self._last = values
+        with self._lock:
+            i = self.total % self.capacity
+            self.times[i] = t
+            self.values[i] = values
+            self.total += 1
+
+    def extend(self,times,values):
+        """a batch of samples, values shaped (n,fields) or (n,) for a single field"""
+        n = len(times)
+        if not n:
+            return
+        values = np.asarray(values,dtype=np.float64).reshape(n,len(self.fields))
+        times = np.asarray(times,dtype=np.float64)
+        with self._lock:
+            keep = min(n,self.capacity)
+            inx = (self.total + (n - keep) + np.arange(keep)) % self.capacity
+            self.times[inx] = times[n-keep:]
+            self.values[inx] = values[n-keep:]
+            self.total += n
+
+    def _slice(self,start:int):
+        """(first sample number,times,values) copies from absolute sample number start to now, oldest first"""
+        with self._lock:
+            start = max(start,self.total - self.capacity)
+            inx = np.arange(start,self.total) % self.capacity
+            return start,self.times[inx],self.values[inx]
+
+    def latest(self):
+        """(time,values) of the newest sample or None"""
+        with self._lock:
+            if not self.total:
+                return None
+            i = (self.total - 1) % self.capacity
+            return self.times[i],self.values[i].copy()
+
+    def since(self,cursor:int):
+        """(new cursor,times,values,lost) of the samples published after `cursor`, lost counts ones already overwritten"""
+        start,times,values = self._slice(cursor)
+        return start + len(times),times,values,start - cursor
+
+    def window(self,t0:float=None,t1:float=None):
+        """(times,values) held with t0 <= time <= t1"""
+        _,times,values = self._slice(0)
+        sel = np.ones(len(times),dtype=bool)
+        if t0 is not None:
+            sel &= times >= t0
+        if t1 is not None:
+            sel &= times <= t1
+        return times[sel],values[sel]
+
+    def rate(self)->float:
+        """average sample rate over the ring (Hz)"""
+        _,times,_ = self._slice(0)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return 0.
+        return float((len(times)-1)/(times[-1]-times[0]))
+
+    def status(self)->dict:
+        out = {'fields':self.fields,'total':self.total,'skipped':self.skipped,'held':min(self.total,self.capacity),'rate':round(self.rate(),2)}
+        last = self.latest()
+        out['age'] = round(time.perf_counter() - float(last[0]),4) if last is not None else None
+        return out
+
+
+class stream_hub:
+    """The streams of a rig by name, field names are unique across streams so merged frames are flat {field:value}"""
+
+    def __init__(self):
+        self.streams = {}
+        self.cursors = {} #name: drain cursor
+        self.lost = {}
+
+    def add(self,name:str,fields:list,capacity:int=4096,on_change:bool=False)->sensor_stream:
+        if name in self.streams:
+            return self.streams[name]
+        for other in self.streams.values():
+            dup = set(fields) & set(other.fields)
+            assert not dup, f'stream {name} fields {dup} already in {other.name}'
+        strm = self.streams[name] = sensor_stream(name,fields,capacity,on_change)
+        self.cursors[name] = 0
+        self.lost[name] = 0
+        return strm
+
+    def __contains__(self,name):
+        return name in self.streams
+
+    def __getitem__(self,name)->sensor_stream:
+        return self.streams[name]
+
+    def publish(self,name:str,t:float,values):
+        strm = self.streams.get(name,None)
+        if strm is not None:
+            strm.publish(t,values)
+
+    def _select(self,names):
+        if names is None:
+            return list(self.streams.values())
+        return [self.streams[n] for n in names if n in self.streams]
+
+    #Merge
+    def frame(self,names:list=None)->dict:
+        """latest value of every field, plus `<stream>_age` seconds since its newest sample"""
+        now = time.perf_counter()
+        out = {}
+        for strm in self._select(names):
+            last = strm.latest()
+            if last is None:
+                continue
+            t,values = last
+            out.update(zip(strm.fields,values.tolist()))
+            out[f'{strm.name}_age'] = now - float(t)
+        return out
+
+    def resample(self,t0:float,t1:float,period:float,names:list=None,method:str='hold')->dict:
+        """columns of every field on the grid t0,t0+period..t1 as `timestamp` + fields, `hold` takes the last sample at or before each time and `linear` interpolates, times before a stream's first held sample are nan"""
+        assert method in resample_methods, f'bad resample method {method}! choose: {resample_methods}'
+        n = max(int(math.floor((t1-t0)/period))+1,1)
+        grid = t0 + period*np.arange(n)
+        cols = {'timestamp':grid}
+        for strm in self._select(names):
+            times,values = strm.window(None,t1)
+            if not len(times):
+                for f in strm.fields:
+                    cols[f] = np.full(n,np.nan)
+                continue
+            inx = np.searchsorted(times,grid,side='right') - 1
+            valid = inx >= 0
+            for j,f in enumerate(strm.fields):
+                if method == 'linear':
+                    col = np.interp(grid,times,values[:,j])
+                else:
+                    col = values[np.maximum(inx,0),j]
+                cols[f] = np.where(valid,col,np.nan)
+        return cols
+
+    #Upload
+    def peek(self,name:str):
+        """(cursor,times,values) published since the upload cursor of `name`, which only moves on `advance(name,cursor)`"""
+        strm = self.streams[name]
+        cursor,times,values,lost = strm.since(self.cursors[name])
+        if lost:
+            #already overwritten, skip past them
+            self.cursors[name] += lost
+            self.lost[name] += lost
+            log.warning(f'stream {name} overwrote {lost} samples before upload')
+        return cursor,times,values
+
+    def advance(self,name:str,cursor:int):
+        """marks the samples before `cursor` (from `peek`) as uploaded"""
+        self.cursors[name] = max(self.cursors[name],cursor)
+
+    def drain(self,name:str):
+        """(times,values) published since the last drain of `name`"""
+        cursor,times,values = self.peek(name)
+        self.advance(name,cursor)
+        return times,values
+
+    def status(self)->dict:
+        out = {}
+        for name,strm in self.streams.items():
+            out[name] = st = strm.status()
+            st['lost'] = self.lost[name]
+        return out
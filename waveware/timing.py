@@ -0,0 +1,119 @@
+"""
+Timing helpers for acquisition loops
+1. lateness_histogram: HDR style (log-linear) histogram of microsecond latencies, constant relative precision over a wide range with fixed memory
+2. deadline_scheduler: waits for absolute deadlines t0 + slot*period so the sample period doesn't slip, late slots are skipped & counted instead
+"""
+import asyncio
+import logging
+import math
+import time
+
+import numpy as np
+
+log = logging.getLogger('timing')
+
+
+class lateness_histogram:
+    """Counts values (us) in buckets of 2**sub_bits linear steps per power of two, so every bucket is within ~1/2**(sub_bits-1) of its value up to max_us"""
+
+    def __init__(self,sub_bits:int=5,max_us:int=10_000_000):
+        self.sub_bits = sub_bits
+        self.sub = 1<<sub_bits
+        self.half = self.sub>>1
+        self.max_us = int(max_us)
+        self.counts = np.zeros(self._index(self.max_us)+1,dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def _index(self,v:int)->int:
+        if v < self.sub:
+            return v
+        e = v.bit_length() - self.sub_bits
+        return self.sub + (e-1)*self.half + ((v>>e) - self.half)
+
+    def _upper(self,i:int)->int:
+        """highest value counted in bucket i"""
+        if i < self.sub:
+            return i
+        j = i - self.sub
+        e = j//self.half + 1
+        m = j%self.half + self.half
+        return ((m+1)<<e) - 1
+
+    def record(self,us:float):
+        v = min(max(int(us),0),self.max_us)
+        self.counts[self._index(v)] += 1
+        self.total += 1
+        self.sum += v
+        self.max = max(self.max,v)
+
+    def percentile(self,p:float)->int:
+        if not self.total:
+            return 0
+        cum = np.cumsum(self.counts)
+        i = int(np.searchsorted(cum,math.ceil(self.total*p/100.)))
+        return min(self._upper(i),self.max)
+
+    def summary(self,percentiles=(50,90,99,99.9))->dict:
+        out = {'count':self.total,'max_us':self.max,'mean_us':self.sum/self.total if self.total else 0}
+        for p in percentiles:
+            out[f'p{p:g}_us'] = self.percentile(p)
+        return out
+
+    def buckets(self)->list:
+        """nonzero [upper us,count] pairs"""
+        inx = np.nonzero(self.counts)[0]
+        return [[self._upper(int(i)),int(self.counts[i])] for i in inx]
+
+
+class deadline_scheduler:
+    """Paces a loop on t0 + slot*period (perf_counter), each `wait` returns (slot,lateness s) for the slot it released.
+
+    When the loop falls a whole period behind the passed slots are skipped (counted in `missed`) so the samples stay on the slot grid, gaps in the slot number mark them.
+    """
+
+    def __init__(self,period:float,hist:lateness_histogram=None):
+        self.period = period
+        self.hist = hist if hist is not None else lateness_histogram()
+        self.reset()
+
+    def reset(self):
+        """restart the grid at the next wait"""
+        self.t0 = None
+        self.slot = 0
+        self.missed = 0
+
+    @property
+    def deadline(self):
+        return self.t0 + self.slot*self.period
+
+    async def wait(self):
+        now = time.perf_counter()
+        if self.t0 is None:
+            self.t0 = now
+            self.slot = 0
+            self.hist.record(0)
+            return 0,0.
+
+        self.slot += 1
+        behind = int((now - self.deadline)//self.period)
+        if behind > 0:
+            self.slot += behind
+            self.missed += behind
+
+        delay = self.deadline - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+        late = max(time.perf_counter() - self.deadline,0.)
+        self.hist.record(late*1E6)
+        return self.slot,late
+
+    def status(self)->dict:
+        out = {'period':self.period,'slot':self.slot,'missed':self.missed}
+        out.update(self.hist.summary())
+        return out
@@ -0,0 +1,316 @@
+"""
+S3 uploads through one long lived aiobotocore client owned by the event loop
+
+Bodies are json encoded & optionally compressed (gzip or zstd, which needs `zstandard`) in a worker thread, puts share the client's connection pool behind a concurrency limit and retry with exponential backoff. Compressed objects get a `.json.gz` / `.json.zst` key so `load_json` can read them back after an `aws s3 sync`.
+
+With the `parquet` or `arrow` upload format (needs `pyarrow`, the `archive` extra) sample batches are written as columnar segments instead:
+    {folder}/{test}/segments/seg_<epoch ms>_<n>.parquet
+with the parameter snapshots in the file metadata rather than on every row. Each segment gets an append only manifest part
+    {folder}/{test}/manifest/<segment name>.json
+with its key, time / sequence range, run ids and parameter versions, readers merge the parts of a test (and a legacy `manifest.json`) with `load_manifest`.
+
+Every object key ends in a monotonic `seg_<epoch ms>_<n>` name, so uploads in the same second never share a key.
+"""
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import time
+
+from waveware.config import *
+from waveware.data import rows_to_columns
+
+log = logging.getLogger('uploads')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+codec_ext = {'none':'.json','gzip':'.json.gz','zstd':'.json.zst'}
+segment_ext = {'parquet':'.parquet','arrow':'.arrow'}
+
+def compress(body:bytes,codec:str='none')->bytes:
+    if codec == 'gzip':
+        return gzip.compress(body,compresslevel=5)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return body
+
+def encode_body(data:dict,codec:str='none'):
+    """(compressed json body,raw json size)"""
+    body = json.dumps(data,default=str).encode()
+    return compress(body,codec),len(body)
+
+def decode_body(body:bytes):
+    """json from a plain, gzip or zstd body (by its magic bytes)"""
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    elif body[:4] == b'\x28\xb5\x2f\xfd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read .zst uploads')
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return json.loads(body)
+
+def load_json(path:str):
+    with open(path,'rb') as fp:
+        return decode_body(fp.read())
+
+
+#Columnar Segments
+def rows_to_table(rows:list,meta:dict):
+    """an arrow table of sample rows (numeric columns as float64, anything else as strings) with `meta` as json in the schema metadata"""
+    keys = list(dict.fromkeys(k for r in rows for k in r))
+    cols = rows_to_columns(rows,keys)
+    arrays = {}
+    for key,values in cols.items():
+        if values.dtype == object:
+            values = [v if v is None or isinstance(v,str) else json.dumps(v,default=str) for v in values]
+            arrays[key] = pa.array(values,type=pa.string())
+        else:
+            arrays[key] = pa.array(values,type=pa.float64())
+    table = pa.table(arrays)
+    return table.replace_schema_metadata({b'waveware':json.dumps(meta,default=str).encode()})
+
+def encode_segment(rows:list,meta:dict,fmt:str='parquet')->bytes:
+    table = rows_to_table(rows,meta)
+    sink = pa.BufferOutputStream()
+    if fmt == 'parquet':
+        pq.write_table(table,sink,compression='zstd')
+    else:
+        with pa.ipc.new_file(sink,table.schema,options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def decode_segment(body:bytes):
+    """(table,meta) of a parquet or arrow segment"""
+    buf = pa.py_buffer(body)
+    if body[:4] == b'PAR1':
+        table = pq.read_table(buf)
+    else:
+        table = pa.ipc.open_file(buf).read_all()
+    meta = json.loads((table.schema.metadata or {}).get(b'waveware',b'{}'))
+    return table,meta
+
+def segment_summary(rows:list,params:dict)->dict:
+    """manifest entry fields of a batch of rows"""
+    ts = [r['timestamp'] for r in rows]
+    seqs = [r['seq'] for r in rows if r.get('seq',None) is not None]
+    out = {'n':len(rows),'first_ts':min(ts),'last_ts':max(ts),
+            'first_seq':min(seqs) if seqs else None,'last_seq':max(seqs) if seqs else None}
+    out['run_ids'] = sorted({r['run_id'] for r in rows if r.get('run_id',None) is not None},key=str)
+    out['param_vers'] = sorted({int(r['param_ver']) for r in rows if r.get('param_ver',None) is not None})
+    out['modes'] = sorted({r['mode'] for r in rows if r.get('mode',None)})
+    utc = [r['utc'] for r in rows if r.get('utc',None) is not None]
+    if utc:
+        out['first_utc'] = min(utc)
+        out['last_utc'] = max(utc)
+    return out
+
+def manifest_dirs(root:str)->list:
+    """test directories of a synced folder with manifest parts (or a legacy manifest.json)"""
+    dirs = {os.path.dirname(f) for f in glob.glob(os.path.join(root,'**','manifest.json'),recursive=True)}
+    dirs.update(os.path.dirname(d) for d in glob.glob(os.path.join(root,'**','manifest'),recursive=True) if os.path.isdir(d))
+    return sorted(dirs)
+
+def load_manifest(test_dir:str)->dict:
+    """the merged manifest of a synced test directory, segment entries sorted by name (a part replaces a legacy entry of the same name)"""
+    segs = {}
+    legacy = os.path.join(test_dir,'manifest.json')
+    if os.path.exists(legacy):
+        with open(legacy,'r') as fp:
+            segs.update((s['name'],s) for s in json.load(fp)['segments'])
+    for fil in sorted(glob.glob(os.path.join(test_dir,'manifest','**','*.json'),recursive=True)):
+        with open(fil,'r') as fp:
+            entry = json.load(fp)
+        segs[entry['name']] = entry
+    return {'test':os.path.basename(test_dir),'segments':sorted(segs.values(),key=lambda s: s['name'])}
+
+def load_manifest_segments(test_dir:str):
+    """yields each segment of a synced test's manifest as `{'upload_time':..,'data':{ts:row}}` like a json data upload, rows with their parameters filled in"""
+    from waveware.segment_log import materialize
+    if pa is None:
+        log.warning(f'pyarrow not installed, skipping segments of {test_dir}')
+        return
+    manifest = load_manifest(test_dir)
+    for seg in manifest['segments']:
+        if seg.get('stream',None):
+            continue
+        path = os.path.join(test_dir,seg['path'])
+        if not os.path.exists(path):
+            log.info(f'missing segment {path}')
+            continue
+        with open(path,'rb') as fp:
+            table,meta = decode_segment(fp.read())
+        params = {int(k):v for k,v in meta.get('params',{}).items()}
+        rows = table.to_pylist()
+        yield {'upload_time':seg['upload_time'],'data':{r['timestamp']:materialize(r,params) for r in rows}}
+
+
+class s3_uploader:
+    """Owns the s3 client for the life of the loop, `put` encodes off loop then uploads with retries, `stats` counts puts, bytes & failures"""
+
+    def __init__(self,bucket:str=bucket,folder:str=folder,profile:str=aws_profile,codec:str=s3_codec,concurrency:int=s3_concurrency,retries:int=s3_retries,backoff:float=0.5,endpoint_url:str=s3_endpoint,region:str='us-east-1',fmt:str=upload_format):
+        assert codec in codec_ext, f'bad codec {codec}! choose: {list(codec_ext)}'
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError('the zstd upload codec needs zstandard, install it or set WAVEWARE_S3_CODEC=gzip/none')
+        if fmt in segment_ext and pa is None:
+            raise ImportError(f'the {fmt} upload format needs pyarrow, pip install waveware[archive] or set WAVEWARE_UPLOAD_FORMAT=json')
+        self.bucket = bucket
+        self.folder = folder
+        self.profile = profile
+        self.codec = codec
+        self.concurrency = max(int(concurrency),1)
+        self.retries = max(int(retries),1)
+        self.backoff = backoff
+        self.endpoint_url = endpoint_url
+        self.region = region
+
+        self.format = fmt
+        self._seg_n = 0
+
+        self.client = None
+        self._client_ctx = None
+        self._start_lock = None
+        self._sem = None
+        self.stats = {'puts':0,'failed':0,'retries':0,'raw_bytes':0,'sent_bytes':0,'put_time':0.}
+
+    @property
+    def enabled(self):
+        #S3 Happens by deault ON_RASPI=true or if WAVEWARE_FLDR_NAME==test
+        return ON_RASPI or self.folder.upper()=='TEST' or self.endpoint_url is not None
+
+    async def start(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+            self._sem = asyncio.Semaphore(self.concurrency)
+        async with self._start_lock:
+            if self.client is not None:
+                return self.client
+            from aiobotocore.session import AioSession
+            from aiobotocore.config import AioConfig
+            session = AioSession(profile=self.profile)
+            cfg = AioConfig(max_pool_connections=self.concurrency,retries={'max_attempts':1})
+            self._client_ctx = session.create_client('s3',region_name=self.region,endpoint_url=self.endpoint_url,config=cfg)
+            self.client = await self._client_ctx.__aenter__()
+            log.info(f's3 client up: {self.bucket}| {self.endpoint_url or "aws"}| codec: {self.codec} x{self.concurrency}')
+            return self.client
+
+    async def close(self):
+        if self._client_ctx is not None:
+            await self._client_ctx.__aexit__(None,None,None)
+        self.client = None
+        self._client_ctx = None
+
+    def key(self,test:str,title:str=None,codec:str='none',name:str=None):
+        """(upload time,key) of an object, `name` defaults to the next segment name"""
+        up_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        date = up_time.date()
+        if not title:
+            title = 'data'
+        name = name or self.segment_name()
+        return up_time,f"{self.folder}/{test}/{date}/{title}_{name}{codec_ext[codec]}"
+
+    async def _put_object(self,key:str,body:bytes,raw:int=0,**kw)->bool:
+        client = await self.start()
+        kw = dict(Bucket=self.bucket,Key=key,Body=body,**kw)
+        async with self._sem:
+            for attempt in range(self.retries):
+                t = time.perf_counter()
+                try:
+                    await client.put_object(**kw)
+                except Exception as e:
+                    if attempt + 1 >= self.retries:
+                        self.stats['failed'] += 1
+                        log.error(f'failed writing {key} after {self.retries} tries: {e}')
+                        return False
+                    self.stats['retries'] += 1
+                    delay = self.backoff * 2**attempt * (0.5 + random.random())
+                    log.info(f'retry {attempt+1} writing {key} in {delay:.2f}s: {e}')
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.stats['puts'] += 1
+                self.stats['put_time'] += time.perf_counter() - t
+                self.stats['sent_bytes'] += len(body)
+                self.stats['raw_bytes'] += raw
+                log.info(f"success writing {key}")
+                return True
+
+    async def put(self,test:str,data:dict,title:str=None,packed:bool=True,name:str=None)->bool:
+        """writes the dictionary to the bucket as json
+        :param data: a dictionary to write as json
+        :param title: default='data', use to log actions ect
+        :param packed: use the uploader codec, small event records are left plain
+        :param name: key suffix after the title (ie a segment log name), a new segment name by default
+        """
+        codec = self.codec if packed else 'none'
+        up_time,key = self.key(test,title,codec,name)
+        data["upload_time"] = str(up_time)
+
+        if not self.enabled:
+            log.info(f"mock writing s3...: {self.profile}|{title}|{len(data)}")
+            return True
+
+        body,raw = await asyncio.to_thread(encode_body,data,codec)
+        kw = {'ContentType':'application/json'}
+        if codec != 'none':
+            kw['ContentEncoding'] = codec
+        return await self._put_object(key,body,raw,**kw)
+
+    @property
+    def columnar(self):
+        return self.format in segment_ext
+
+    def segment_name(self):
+        """a monotonic name for batches that don't come from the segment log"""
+        self._seg_n += 1
+        return f'seg_{int(time.time()*1000):015d}_{self._seg_n:06d}'
+
+    async def put_segment(self,test:str,rows:list,params:dict,name:str=None,stream:str=None)->bool:
+        """writes a batch of rows as a columnar segment, then its manifest part
+        :param stream: a sensor stream's rows, kept under streams/<stream>/ and marked in the manifest entry
+        """
+        if not rows:
+            return True
+        name = name or self.segment_name()
+        up_time = str(datetime.datetime.now(tz=datetime.timezone.utc))
+        path = f'streams/{stream}/{name}{segment_ext[self.format]}' if stream else f'segments/{name}{segment_ext[self.format]}'
+        entry = {'name':f'{stream}/{name}' if stream else name,'path':path,'upload_time':up_time}
+        if stream:
+            entry['stream'] = stream
+        entry.update(segment_summary(rows,params))
+
+        if not self.enabled:
+            log.info(f"mock writing segment...: {test}|{name}|{len(rows)}")
+            return True
+
+        meta = {'test':test,'segment':name,'upload_time':up_time,'params':params}
+        body = await asyncio.to_thread(encode_segment,rows,meta,self.format)
+        entry['bytes'] = len(body)
+        ok = await self._put_object(f'{self.folder}/{test}/{path}',body,ContentType='application/octet-stream')
+        if ok:
+            ok = await self.put_manifest_part(test,entry)
+        return ok
+
+    async def put_manifest_part(self,test:str,entry:dict)->bool:
+        """writes a segment's manifest entry as its own object, nothing is rewritten so concurrent uploads can't race"""
+        body = json.dumps(entry,default=str).encode()
+        return await self._put_object(f'{self.folder}/{test}/manifest/{entry["name"]}.json',body,ContentType='application/json')
+
+    def status(self)->dict:
+        out = dict(self.stats)
+        out['codec'] = self.codec
+        out['format'] = self.format
+        out['avg_put_s'] = self.stats['put_time']/self.stats['puts'] if self.stats['puts'] else None
+        return out